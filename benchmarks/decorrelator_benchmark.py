@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Tue Oct 20 10:31:08 2026
+Benchmark suite for the decorrelators, the separation and the s3a presets.
+
+Every Decorrelator subclass, separate_audio and s3a_audio_decorrelator with each preset in 
+s3a_decorrelator.PRESETS are run on synthetic test signals from utils/test_tone_generator.py 
+(a chord, pink noise and a burst train of the noise) for each input length, sample rate and 
+input -> output channel configuration. The wall time (best of repeats), realtime factor 
+(seconds of audio per second) and peak memory allocated (from tracemalloc, in a separate run) are 
+saved as JSON with the library versions so runs can be compared, e.g. before and after an upgrade:
+
+python benchmarks/decorrelator_benchmark.py --output before.json
+python benchmarks/decorrelator_benchmark.py --output after.json --compare before.json
+
+With --compare the time of each case is printed relative to the earlier run and the script exits 
+with an error if any case is slower by more than --threshold.
+
+"""
+
+import argparse
+import fnmatch
+import json
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+import scipy
+import librosa
+
+from s3a_decorrelation_toolbox import decorr_toolbox as dt
+from s3a_decorrelation_toolbox import percussive_harmonic_decorrelator as phdc
+from s3a_decorrelation_toolbox import s3a_decorrelator as s3a
+from s3a_decorrelation_toolbox.utils import test_tone_generator as ttg
+
+
+# Arguments needed by decorrelators without defaults for all of them.
+DECORRELATOR_ARGUMENTS = {'Fink': dict(filterLength = 20)}
+# Presets with fixed routing for a number of input channels. They are run once for that number of inputs.
+PRESET_INPUTS = {'upmix_mono_LRCSLsRs': 1, 'upmix_stereo_LRCSLsRs': 2}
+
+DEFAULT_DURATIONS = (1.0, 10.0)
+DEFAULT_RATES = (44100, 48000)
+DEFAULT_CONFIGS = ('1x2', '2x6', '1x32')
+
+
+def decorrelator_classes(base = dt.Decorrelator):
+    # Every subclass of the Decorrelator, including subclasses of subclasses.
+    classes = []
+    for subclass in base.__subclasses__():
+        classes.append(subclass)
+        classes.extend(decorrelator_classes(subclass))
+
+    return classes
+
+
+def test_signal(duration, fs, numChans):
+    # Harmonic, noise and transient content so all three components of the separation have something in them.
+    # Each channel is the same signal delayed by a different amount.
+    chord = sum(ttg.generateSineWave(frequency, duration, fs) for frequency in (220.0, 277.2, 329.6)) / 3
+    noise = np.squeeze(ttg.generateNoise(duration, fs))
+    bursts = ttg.convertToBurstTrain(noise, onTime = 20, offTime = 230, attack = 1, decay = 15, fs = fs)
+    mono = 0.3*chord
+    mono[:len(noise)] += 0.3*noise
+    mono[:len(bursts)] += bursts
+    audio = np.column_stack([np.roll(mono, n * fs // 10) for n in range(numChans)])
+
+    return audio
+
+
+def cases(durations, rates, configs):
+    # (name, kind, duration, fs, numIn, numOut, function of the input audio) for every benchmark.
+    for duration in durations:
+        for fs in rates:
+            # Inputs already separated and fixed presets already run at this length and rate.
+            separated = set()
+            for config in configs:
+                numIn, numOut = (int(n) for n in config.split('x'))
+                for method in decorrelator_classes():
+                    arguments = DECORRELATOR_ARGUMENTS.get(method.__name__, dict())
+                    yield (method.__name__, 'decorrelator', duration, fs, numIn, numOut,
+                           lambda audio, method = method, arguments = arguments, fs = fs, numOut = numOut: 
+                               method(audio, fs = fs, numOutChans = numOut, **arguments).audio_out)
+                if numIn not in separated:
+                    separated.add(numIn)
+                    yield ('separate_audio', 'separation', duration, fs, numIn, numIn, phdc.separate_audio)
+                for preset in s3a.PRESETS:
+                    if preset in PRESET_INPUTS:
+                        if PRESET_INPUTS[preset] != numIn or preset in separated:
+                            continue
+                        separated.add(preset)
+                        arguments = s3a.preset_arguments(preset)
+                    else:
+                        arguments = s3a.preset_arguments(preset, num_out_chans = numOut)
+                    yield ('s3a ' + preset, 'preset', duration, fs, numIn, arguments.get('num_out_chans', 2),
+                           lambda audio, arguments = arguments, fs = fs: phdc.s3a_audio_decorrelator(audio, fs = fs, **arguments))
+
+
+def run_case(function, audio, repeats):
+    # Best time of repeats runs and the peak memory allocated during one more run.
+    # The first run is not timed so imports, numba compilation and caches set up on first use are not counted.
+    np.random.seed(0)
+    function(audio)
+    best = np.inf
+    for n in range(repeats):
+        np.random.seed(0)
+        start = time.perf_counter()
+        function(audio)
+        best = min(best, time.perf_counter() - start)
+
+    np.random.seed(0)
+    tracemalloc.start()
+    function(audio)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return best, peak
+
+
+def environment():
+    # Versions that can change the results between runs.
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output = True, text = True).stdout.strip()
+    except OSError:
+        commit = ''
+
+    return {'python': platform.python_version(), 'numpy': np.__version__, 'scipy': scipy.__version__, 
+            'librosa': librosa.__version__, 'platform': platform.platform(), 'processor': platform.processor(),
+            'commit': commit, 'date': time.strftime('%Y-%m-%d %H:%M:%S')}
+
+
+def case_key(result):
+    return (result['name'], result['duration'], result['fs'], result['in'], result['out'])
+
+
+def main(durations = DEFAULT_DURATIONS, rates = DEFAULT_RATES, configs = DEFAULT_CONFIGS, repeats = 3, only = '*', output = None, compare = None, threshold = 1.2):
+    results = []
+    signals = dict()
+    for name, kind, duration, fs, numIn, numOut, function in cases(durations, rates, configs):
+        if not fnmatch.fnmatch(name, only):
+            continue
+        if (duration, fs, numIn) not in signals:
+            signals[(duration, fs, numIn)] = test_signal(duration, fs, numIn)
+        result = {'name': name, 'kind': kind, 'duration': duration, 'fs': fs, 'in': numIn, 'out': numOut}
+        try:
+            seconds, peak = run_case(function, signals[(duration, fs, numIn)], repeats)
+            result.update(status = 'ok', seconds = seconds, realtime_factor = duration / seconds, peak_mb = peak / 2**20, error = '')
+        except Exception as error:
+            result.update(status = 'failed', seconds = None, realtime_factor = None, peak_mb = None, error = repr(error))
+        results.append(result)
+        print('{name:28s} {duration:5.1f} s {fs:6d} Hz {in:2d}x{out:<2d} '.format(**result) + 
+              ('{seconds:8.3f} s {realtime_factor:8.1f}x {peak_mb:8.1f} MB'.format(**result) if result['status'] == 'ok' else result['error']))
+
+    report = {'environment': environment(), 'repeats': repeats, 'results': results}
+    if output is not None:
+        with open(output, 'w') as f:
+            json.dump(report, f, indent = 1)
+
+    passed = True
+    if compare is not None:
+        passed = compare_results(results, compare, threshold)
+
+    return passed
+
+
+def compare_results(results, filename, threshold):
+    # Prints the time of each case relative to the run saved in filename. Returns False if any case is more than threshold times slower.
+    with open(filename) as f:
+        previous = {case_key(result): result for result in json.load(f)['results'] if result['status'] == 'ok'}
+
+    passed = True
+    print('\ncompared with {f}'.format(f = filename))
+    for result in results:
+        before = previous.get(case_key(result))
+        if before is None or result['status'] != 'ok':
+            continue
+        ratio = result['seconds'] / before['seconds']
+        slower = ratio > threshold
+        passed &= not slower
+        print('{name:28s} {duration:5.1f} s {fs:6d} Hz {in:2d}x{out:<2d} '.format(**result) + 
+              'time {r:5.2f}x  memory {m:5.2f}x  {s}'.format(r = ratio, m = result['peak_mb'] / max(before['peak_mb'], 1e-9), s = 'SLOWER' if slower else ''))
+
+    return passed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Benchmark the decorrelators, separation and s3a presets.')
+    parser.add_argument('--durations', type = float, nargs = '+', default = DEFAULT_DURATIONS, help = 'input lengths in seconds')
+    parser.add_argument('--rates', type = int, nargs = '+', default = DEFAULT_RATES, help = 'sample rates')
+    parser.add_argument('--configs', nargs = '+', default = DEFAULT_CONFIGS, help = 'channel configurations as inputs x outputs, e.g. 2x6')
+    parser.add_argument('--repeats', type = int, default = 3, help = 'number of timed runs of each case')
+    parser.add_argument('--only', default = '*', help = 'only run the cases with names matching this pattern, e.g. "s3a *"')
+    parser.add_argument('--output', default = None, help = 'JSON file to save the results to')
+    parser.add_argument('--compare', default = None, help = 'JSON results of an earlier run to compare with')
+    parser.add_argument('--threshold', type = float, default = 1.2, help = 'time ratio counted as a slow down')
+    args = parser.parse_args()
+
+    if not main(args.durations, args.rates, args.configs, args.repeats, args.only, args.output, args.compare, args.threshold):
+        sys.exit(1)
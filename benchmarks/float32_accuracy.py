@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 19:05:51 2026
+Checks the float32 processing mode against the float64 reference.
+
+Each decorrelator and the whole s3a_audio_decorrelator are run with the same seed in float64 and float32.
+The error of the float32 output relative to the float64 output is printed in dB with the run times and
+the size of the output. The script exits with an error if any error is above the tolerance.
+
+usage: python benchmarks/float32_accuracy.py [seconds of audio] [tolerance in dB]
+
+"""
+
+import sys
+import time
+
+import numpy as np
+
+from s3a_decorrelation_toolbox import decorr_toolbox as dt
+from s3a_decorrelation_toolbox import percussive_harmonic_decorrelator as phdc
+
+
+def relative_error_db(output, reference):
+    length = min(len(output), len(reference))
+    error = np.linalg.norm(output[:length].astype(np.float64) - reference[:length]) / np.linalg.norm(reference[:length])
+
+    return 20*np.log10(max(error, 1e-300))
+
+
+def compare(name, function, tolerance):
+    # Runs function(dtype) in both precisions and prints the comparison. Returns True if within tolerance.
+    times = dict()
+    outputs = dict()
+    for dtype in (np.float64, np.float32):
+        start = time.perf_counter()
+        outputs[dtype] = function(dtype)
+        times[dtype] = time.perf_counter() - start
+
+    error = relative_error_db(outputs[np.float32], outputs[np.float64])
+    passed = error <= tolerance and outputs[np.float32].dtype == np.float32
+    print('{n:24s} error {e:7.1f} dB  float64 {t64:6.3f} s {m64:6.1f} MB  float32 {t32:6.3f} s {m32:6.1f} MB  {r}'.format(
+          n = name, e = error, t64 = times[np.float64], t32 = times[np.float32],
+          m64 = outputs[np.float64].nbytes/2**20, m32 = outputs[np.float32].nbytes/2**20, r = 'ok' if passed else 'FAILED'))
+
+    return passed
+
+
+def main(duration = 10.0, tolerance = -100.0):
+    fs = 48000
+    rng = np.random.default_rng(0)
+    t = np.arange(int(duration*fs))/fs
+    audio = 0.3*np.sin(2*np.pi*440*t) + 0.05*rng.standard_normal(len(t))
+    audio[::fs//4] += 1.0
+    stereo = np.column_stack((audio, np.roll(audio, 1000)))
+
+    decorrelators = ((dt.AllPass, dict()), (dt.Lauridsen, dict()), (dt.AllPassLauridsen, dict()), (dt.Fink, dict(filterLength = 20)), 
+                     (dt.FreqLauridsen, dict()), (dt.VelvetNoise, dict()), (dt.FauxReverb, dict()), (dt.Copier, dict()), (dt.TransientPanner, dict()))
+    passed = True
+    for method, arguments in decorrelators:
+        passed &= compare(method.__name__, lambda dtype: method(stereo, numOutChans = 8, seed = 1, dtype = dtype, **arguments).audio_out, tolerance)
+
+    for preset, arguments in (('upmix', dict(transient_decorrelation_method = dt.Copier)), ('diffuse', dict())):
+        passed &= compare('s3a ' + preset, lambda dtype: phdc.s3a_audio_decorrelator(stereo, num_out_chans = 6, seed = 1, dtype = dtype, **arguments), tolerance)
+
+    return passed
+
+
+if __name__ == '__main__':
+    duration = float(sys.argv[1]) if len(sys.argv) > 1 else 10.0
+    tolerance = float(sys.argv[2]) if len(sys.argv) > 2 else -100.0
+    if not main(duration, tolerance):
+        sys.exit(1)
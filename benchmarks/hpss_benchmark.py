@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 17:12:40 2026
+Compares the speed and output of the hpss backends used by separate_mono_audio.
+
+For each FFT size the librosa and fast backends are timed on the same spectrogram,
+and the largest difference between their masks is printed. Finally the whole
+separation is timed with each backend.
+
+usage: python benchmarks/hpss_benchmark.py [seconds of audio] [threads]
+
+"""
+
+import sys
+import time
+
+import numpy as np
+import librosa
+
+from s3a_decorrelation_toolbox import percussive_harmonic_decorrelator as phdc
+
+
+def test_audio(duration, fs = 48000):
+    # Tone with noise and clicks so both harmonic and percussive filters have something to do.
+    rng = np.random.default_rng(0)
+    t = np.arange(int(duration*fs))/fs
+    audio = 0.3*np.sin(2*np.pi*440*t) + 0.05*rng.standard_normal(len(t))
+    audio[::fs//4] += 1.0
+
+    return audio
+
+
+def timed(function, *args, repeats = 3, **kwargs):
+    # Best of repeats runs.
+    best = np.inf
+    for n in range(repeats):
+        start = time.perf_counter()
+        result = function(*args, **kwargs)
+        best = min(best, time.perf_counter() - start)
+
+    return best, result
+
+
+def main(duration = 30.0, numThreads = None):
+    audio = test_audio(duration)
+    # Compile the running median before timing.
+    phdc.hpss_masks(np.ones((8, 64)), backend = 'fast')
+
+    print('{d:.0f} s of audio, {t} threads'.format(d = duration, t = numThreads or 1))
+    for nfft, margin in ((1024, (1.0, 2.14)), (2048, (3.0, 1.0))):
+        S = np.abs(librosa.stft(audio, n_fft = nfft))
+        timeLibrosa, masksLibrosa = timed(phdc.hpss_masks, S, margin = margin, backend = 'librosa')
+        timeFast, masksFast = timed(phdc.hpss_masks, S, margin = margin, backend = 'fast', numThreads = numThreads)
+        error = max(np.max(np.abs(fast - reference)) for fast, reference in zip(masksFast, masksLibrosa))
+        print('hpss {n:5d} {shape}: librosa {l:6.3f} s, fast {f:6.3f} s, speed up {s:5.1f}x, max mask difference {e:.1e}'.format(
+              n = nfft, shape = S.shape, l = timeLibrosa, f = timeFast, s = timeLibrosa/timeFast, e = error))
+
+    timeLibrosa, reference = timed(phdc.separate_mono_audio, audio, hpss_backend = 'librosa', repeats = 1)
+    for mode in ('reference', 'fast'):
+        timeFast, separated = timed(phdc.separate_mono_audio, audio, mode = mode, hpss_backend = 'fast', numThreads = numThreads, repeats = 1)
+        error = max(np.linalg.norm(separated[name][:len(reference[name])] - reference[name])/np.linalg.norm(reference[name]) for name in reference)
+        print('separate_mono_audio (mode {m}): librosa {l:6.3f} s, fast {f:6.3f} s, speed up {s:5.1f}x, max relative difference {e:.1e}'.format(
+              m = mode, l = timeLibrosa, f = timeFast, s = timeLibrosa/timeFast, e = error))
+
+
+if __name__ == '__main__':
+    duration = float(sys.argv[1]) if len(sys.argv) > 1 else 30.0
+    numThreads = int(sys.argv[2]) if len(sys.argv) > 2 else None
+    main(duration, numThreads)
@@ -1,4 +1,8 @@
 name = "s3a_decorrelator"
+from . import batch
 from . import decorr_toolbox
+from . import filter_cache
+from . import instrumentation
+from . import memmap_io
 from . import percussive_harmonic_decorrelator
 from . import s3a_decorrelator
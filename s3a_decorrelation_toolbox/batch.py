@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 15:40:12 2026
+Batch rendering of many files with the s3a_decorrelator from a job manifest.
+
+The manifest is a CSV or JSON file with one job per row/object. Each job has an input and an output
+filename and optionally a preset, duration, make_mono, seed, dtype and subtype (see s3a_decorrelator). Any other columns/keys are passed to
+the preset as overrides, e.g. num_out_chans or harmonic_decorrelation_arguments.
+In a CSV file the values are read as JSON where possible (6, [0, 1], {"filterLength": 10}) and as text otherwise.
+Decorrelation methods can be given by name, e.g. transient_decorrelation_method = Copier.
+Relative filenames are relative to the folder of the manifest.
+
+example manifest.csv:
+
+input,output,preset,num_out_chans
+in/track1.wav,out/track1.wav,upmix,6
+in/track2.wav,out/track2.wav,diffuse,
+
+The jobs are run on a pool of worker processes which are kept for the whole batch, so librosa is
+imported and the STFTs are set up once per worker rather than once per file. Jobs with a seed reuse
+their filters from the filter cache, which is shared between workers when cache_directory is given.
+Workers may design and save the same filters at the same time. The cache writes each file atomically,
+so a worker reads either a complete file or none and designs the filters itself.
+Outputs that are newer than their input are skipped unless force = True.
+
+"""
+
+import csv
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import soundfile as sf
+
+from . import decorr_toolbox as dt
+from . import filter_cache as fc
+from . import s3a_decorrelator as s3a
+
+
+JOB_SETTINGS = ('input', 'output', 'preset', 'duration', 'make_mono', 'dtype', 'subtype')
+REPORT_FIELDS = ('input', 'output', 'status', 'audio_seconds', 'render_seconds', 'realtime_factor', 'error')
+
+
+def s3a_batch(manifest, numWorkers = None, seed = None, cache_directory = None, force = False, report_file = None):
+    # Renders every job in the manifest (a filename or a list of job dictionaries).
+    # seed is used for the jobs that don't give their own seed, so they all share the same filters.
+    # Returns the report, a list with a dictionary of the status and timing of each job,
+    # which is also written as a CSV file to report_file if given.
+
+    if isinstance(manifest, str):
+        jobs = read_manifest(manifest)
+    else:
+        jobs = [dict(job) for job in manifest]
+
+    start = time.perf_counter()
+    report = [None] * len(jobs)
+    pending = []
+    for n, job in enumerate(jobs):
+        if seed is not None:
+            job.setdefault('seed', seed)
+        if not force and up_to_date(job['input'], job['output']):
+            report[n] = job_report(job, 'skipped')
+        else:
+            pending.append(n)
+
+    if numWorkers == 1 or len(pending) < 2:
+        init_worker(cache_directory)
+        for n in pending:
+            report[n] = render_job(jobs[n])
+    else:
+        with ProcessPoolExecutor(numWorkers, initializer = init_worker, initargs = (cache_directory,)) as pool:
+            for n, jobReport in zip(pending, pool.map(render_job, [jobs[n] for n in pending])):
+                report[n] = jobReport
+
+    total = time.perf_counter() - start
+    audioSeconds = sum(r['audio_seconds'] for r in report if r['status'] == 'rendered')
+    report.append({'input': 'total', 'output': '',
+                   'status': '{r} rendered, {s} skipped, {f} failed'.format(r = sum(r['status'] == 'rendered' for r in report),
+                                                                         s = sum(r['status'] == 'skipped' for r in report),
+                                                                         f = sum(r['status'] == 'failed' for r in report)),
+                   'audio_seconds': audioSeconds, 'render_seconds': total,
+                   'realtime_factor': audioSeconds / total if total > 0 else 0.0, 'error': ''})
+
+    if report_file is not None:
+        write_report(report, report_file)
+
+    return report
+
+
+def read_manifest(filename):
+    # Reads the jobs from a CSV or JSON manifest. A JSON manifest is a list of jobs or {"jobs": [...]}.
+    folder = os.path.dirname(os.path.abspath(filename))
+
+    if filename.lower().endswith('.json'):
+        with open(filename) as f:
+            jobs = json.load(f)
+        if isinstance(jobs, dict):
+            jobs = jobs['jobs']
+    else:
+        with open(filename, newline = '') as f:
+            jobs = [{key.strip(): parse_value(value) for key, value in row.items() if value is not None and value.strip() != ''}
+                    for row in csv.DictReader(f)]
+
+    for job in jobs:
+        if 'input' not in job or 'output' not in job:
+            raise ValueError('every job in {m} needs an input and an output, not {j}'.format(m = filename, j = job))
+        job['input'] = os.path.join(folder, str(job['input']))
+        job['output'] = os.path.join(folder, str(job['output']))
+
+    return jobs
+
+
+def parse_value(value):
+    # CSV values are JSON if possible, otherwise text.
+    try:
+        return json.loads(value)
+    except ValueError:
+        return value.strip()
+
+
+def up_to_date(input_file, output_file):
+    # The output doesn't need rendering again if it is newer than the input.
+    return os.path.exists(input_file) and os.path.exists(output_file) and os.path.getmtime(output_file) >= os.path.getmtime(input_file)
+
+
+def job_arguments(job):
+    # The arguments to s3a_audio_decorrelator for the job, with decorrelation methods given by name
+    # replaced by the decorr_toolbox classes and the worker filter cache added to seeded decorrelators.
+    overrides = {key: value for key, value in job.items() if key not in JOB_SETTINGS}
+    for key, value in overrides.items():
+        if key.endswith('_method') and isinstance(value, str):
+            overrides[key] = getattr(dt, value)
+
+    decorrelation_arguments = s3a.preset_arguments(job.get('preset', 'diffuse'), **overrides)
+    if workerCache is not None:
+        for component in ('transient', 'harmonic', 'noise'):
+            key = component + '_decorrelation_arguments'
+            decorrelation_arguments[key] = {'filter_cache': workerCache, **decorrelation_arguments.get(key, dict())}
+
+    return decorrelation_arguments
+
+
+# The filter cache of this worker, set by init_worker.
+workerCache = None
+
+
+def init_worker(cache_directory = None, fftSizes = (1024, 2048)):
+    # Runs once in each worker. Sets up the filter cache and the STFTs so later jobs reuse them.
+    global workerCache
+    if cache_directory is None:
+        workerCache = fc.default_cache
+    else:
+        workerCache = fc.FilterCache(directory = cache_directory)
+
+    import librosa
+    for nfft in fftSizes:
+        librosa.istft(librosa.stft(np.zeros(4 * nfft), n_fft = nfft))
+
+
+def render_job(job):
+    # Renders a single job and returns its report. Errors are reported rather than stopping the batch.
+    start = time.perf_counter()
+    try:
+        decorrelation_arguments = job_arguments(job)
+        fs = sf.info(job['input']).samplerate
+        outputFolder = os.path.dirname(job['output'])
+        if outputFolder != '':
+            os.makedirs(outputFolder, exist_ok = True)
+        audioOut = s3a.s3a_render(job['input'], job['output'], decorrelation_arguments,
+                                  duration = job.get('duration'), make_mono = job.get('make_mono', False),
+                                  dtype = job.get('dtype', 'float64'), subtype = job.get('subtype'))
+    except Exception as error:
+        return job_report(job, 'failed', render_seconds = time.perf_counter() - start, error = repr(error))
+
+    return job_report(job, 'rendered', audio_seconds = len(audioOut) / fs, render_seconds = time.perf_counter() - start)
+
+
+def job_report(job, status, audio_seconds = 0.0, render_seconds = 0.0, error = ''):
+    # realtime_factor is the number of seconds of audio rendered per second.
+    return {'input': job['input'], 'output': job['output'], 'status': status,
+            'audio_seconds': audio_seconds, 'render_seconds': render_seconds,
+            'realtime_factor': audio_seconds / render_seconds if render_seconds > 0 else 0.0, 'error': error}
+
+
+def write_report(report, filename):
+    with open(filename, 'w', newline = '') as f:
+        writer = csv.DictWriter(f, fieldnames = REPORT_FIELDS)
+        writer.writeheader()
+        writer.writerows(report)
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description = 'Render a manifest of files with the s3a_decorrelator.')
+    parser.add_argument('manifest', help = 'CSV or JSON job manifest')
+    parser.add_argument('--workers', type = int, default = None, help = 'number of worker processes (default: number of cores)')
+    parser.add_argument('--seed', type = int, default = None, help = 'seed for jobs without their own seed')
+    parser.add_argument('--cache', default = None, help = 'folder to keep the filters in')
+    parser.add_argument('--force', action = 'store_true', help = 'render outputs that are up to date')
+    parser.add_argument('--report', default = None, help = 'CSV file to write the timing report to')
+    args = parser.parse_args()
+
+    for r in s3a_batch(args.manifest, numWorkers = args.workers, seed = args.seed, cache_directory = args.cache,
+                       force = args.force, report_file = args.report):
+        print('{status:>10} {render_seconds:8.2f}s {realtime_factor:7.1f}x  {output} {error}'.format(**r))
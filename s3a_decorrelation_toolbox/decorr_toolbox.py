@@ -34,10 +34,21 @@ Example Usage:
 @author: Michael Cousins
 """
 from abc import ABCMeta, abstractmethod
+import copy
+import functools
+import logging
 
 import numpy as np
+from numpy.lib.stride_tricks import as_strided
 import librosa
 
+from . import filter_cache as fc
+from . import instrumentation
+from . import memmap_io
+from . import parallel
+
+logger = logging.getLogger(__name__)
+
 
 class Decorrelator(object):
     
@@ -47,22 +58,76 @@ class Decorrelator(object):
     # Therefore to creat more than one channel, the filters must be cascaded.
     # A default decorrelator object does not cascade filters.
     cascade = False
+    # Modules are run on this kind of pool when executor = 'auto'. See parallel.py
+    preferredExecutor = 'threads'
     
-    def __init__(self, audioIn, fs = 48000, numOutChans = 2, decorr_method = None):
+    def __init__(self, audioIn, fs = 48000, numOutChans = 2, decorr_method = None, convolution_method = 'auto', blockSize = 1024, numInChans = 1, seed = None, filter_cache = None, cache_filters = True, executor = None, numWorkers = None, dtype = np.float64, out = None, kernel = None, cascade_mode = 'composite'):
         self.decorr_method = decorr_method
         # Sampling frequency
         self.fs = fs
+        # Convolution engine used by the FIR decorrelators. See convolve() for the options.
+        self.convolution_method = convolution_method
         #Number of output channels.
         self.numOutChans = numOutChans
-        # Audio in as a 2D numpy array
-        self.audioIn = add_dimension(audioIn)
-        # Number of input channels.
-        self.numInChans = self.audioIn.shape[1]
-        self.audio_out = self.decorrelateAudio()
+        # Block length in samples used by process_block() when streaming.
+        self.blockSize = blockSize
+        # How cascaded decorrelators (e.g. Lauridsen) reach more than two outputs: 'composite' filters the audio once
+        # with the combined filter of each output, 'stages' decorrelates it a stage at a time. See decorrelationCascade()
+        if cascade_mode not in CASCADE_MODES:
+            raise ValueError('cascade_mode must be one of {c}, not {m}'.format(c = CASCADE_MODES, m = cascade_mode))
+        self.cascade_mode = cascade_mode
+        # Streaming filter state is created on the first call to process_block()
+        self.streamModules = None
+        # A decorrelation kernel (or its directory) provides the seed and the filters, see filter_cache.Kernel.
+        if isinstance(kernel, str):
+            kernel = fc.Kernel(kernel)
+        if kernel is not None:
+            if kernel.fs != fs:
+                raise ValueError('The kernel was designed for fs = {k}, not {f}'.format(k = kernel.fs, f = fs))
+            seed = kernel.seed
+            filter_cache = kernel.cache
+            cache_filters = True
+        self.kernel = kernel
+        # Integer seed for reproducible filters. Filters are only cached when a seed is given.
+        self.seed = seed
+        if filter_cache is None:
+            filter_cache = fc.default_cache
+        self.filter_cache = filter_cache
+        self.cache_filters = cache_filters
+        # Optional executor to decorrelate the modules of each input channel in parallel. Each task is sent 
+        # the input channel of its module only. Without a seed the filters are never cached, and the tasks 
+        # are given seeds drawn from the global random state so their filters differ, which are not cached either.
+        self.executor = executor
+        self.numWorkers = numWorkers
+        # Precision of the audio and filters. float32 halves the memory and speeds up the FFTs.
+        self.dtype = np.dtype(dtype)
+        # Random state used by the filter generators. See getFilters()
+        self.rng = np.random
+        self.module = 0
+        self.filterCall = 0
+        # Mean square of the whole input, see inputMeanSquare().
+        self.meanSquare = None
+        
+        if audioIn is None:
+            # Streaming mode. Nothing is processed until blocks are passed to process_block().
+            self.audioIn = None
+            self.numInChans = numInChans
+            self.audio_out = None
+        else:
+            # Audio in as a 2D numpy array
+            self.audioIn = add_dimension(audioIn).astype(self.dtype, copy = False)
+            # Number of input channels.
+            self.numInChans = self.audioIn.shape[1]
+            # out is an optional (length, numOutChans) array to write the output into, e.g. a memmap.
+            if out is not None and out.shape[1] != self.numOutChans:
+                raise ValueError('out must have {n} columns, not {s}'.format(n = self.numOutChans, s = out.shape[1]))
+            self.audio_out = self.decorrelateAudio(out)
 
 
-    def decorrelateAudio(self):
+    def decorrelateAudio(self, out = None):
         # Running this function generates the decorrelated audio.
+        # The output is written into out if given, a (length, numOutChans) array. Longer outputs are 
+        # truncated and shorter ones zero padded to its length.
         # It runs a selection of decorrelator modules based on the number of input channels.
         # Each decorrelator module is the decorrelate() function that is 
         # dependent on the specific decorrelator.
@@ -92,59 +157,106 @@ class Decorrelator(object):
         # Decorrelation from 3 input channels to 8 channel outputs requires 1x 2ch decorrelator module and 2x3 channel decorrelator module
         
         
-        AudioOut = []
+        with instrumentation.stage('decorrelate ' + type(self).__name__, self.audioIn.size):
+            return self.assembleModules(out)
 
+    def assembleModules(self, out = None):
+        # Runs the decorrelator modules, writing their outputs into out, see decorrelateAudio().
+        moduleOuts = self.moduleOutputs()
+        if self.executor is None and out is not None:
+            # The output length is known so each module is written straight into out.
+            for n, numOuts in enumerate(moduleOuts):
+                write_module(out, self.decorrelateModule(n, numOuts), sum(moduleOuts[:n]))
+            return out
+        elif self.executor is None:
+            AudioOut = [self.decorrelateModule(n, numOuts) for n, numOuts in enumerate(moduleOuts)]
+        else:
+            # The modules are independent so run in parallel, each on its own copy of the decorrelator.
+            # Without a seed the modules are seeded from the global random state so they still 
+            # get different random filters whichever process they run in, but are not cached.
+            # Each task is given its module's input channel rather than the whole input, 
+            # and the cascades the mean square of the whole input for their normalisation.
+            if self.cascade == True:
+                self.inputMeanSquare()
+            task = copy.copy(self)
+            task.executor = None
+            task.audioIn = None
+            task.rng = None # set again by startModule, the numpy.random module can't be pickled.
+            if task.seed is None:
+                task.seed = np.random.randint(2**31)
+                task.cache_filters = False
+            AudioOut = parallel.parallel_map(decorrelate_module, [(task, n, numOuts, self.audioIn[:,[n]]) for n, numOuts in enumerate(moduleOuts)], 
+                                             self.executor, self.numWorkers, prefer = self.preferredExecutor)
+            
+        #combine all the outputs in single output file
+        # The output is allocated once at the length of the longest module and the shorter ones are zero padded.
+        if out is None:
+            length = max(len(audio) for audio in AudioOut)
+            out = np.empty((length, self.numOutChans), dtype = self.dtype)
+        for n, audio in enumerate(AudioOut):
+            write_module(out, audio, sum(moduleOuts[:n]))
+
+        return out
+
+
+    def decorrelateModule(self, n, numOuts, audio = None):
+        # Decorrelate input channel n to numOuts outputs. audio is the channel, self.audioIn[:,n] by default.
+        self.startModule(n)
+        if audio is None:
+            audio = self.audioIn[:,n]
+        audio = audio.reshape(audio.shape[0],-1)
+
+        
+        if numOuts > 1:
+            # decorrelate either using a cascade of filters or a single multichannel filter bank.
+            if self.cascade == True:
+                #Decorrelate the input audio based on a cascade of different filter lengths
+                audioOutTemp = self.decorrelationCascade(audio, numOuts)
+                
+                
+            elif self.cascade == False:
+                #Directly Decorrelate all the Audio.
+                audioOutTemp = self.decorrelationDirect(audio, numOuts)
         
+        #In the case not all channels need to be decorrelated...
+        elif numOuts ==1:
+            audioOutTemp = audio
+        else:
+            logger.error('maybe too many inputs channels not enough output channels')
+
+        return audioOutTemp
+
+
+    def inputMeanSquare(self):
+        # Mean square of all the input channels, found once. 
+        # The input may be memory mapped so it is found a block at a time.
+        if self.meanSquare is None:
+            self.meanSquare = memmap_io.mean_square(self.audioIn)
+        return self.meanSquare
+
+
+    def startModule(self, n):
+        # Filters and random choices of each module are seeded separately.
+        self.module = n
+        self.filterCall = 0
+        if self.seed is None:
+            self.rng = np.random
+        else:
+            self.rng = np.random.default_rng([self.seed, n, 0])
+
+
+    def moduleOutputs(self):
+        # division into decorrelation modules.
+        # Returns the number of outputs of the decorrelator module for each input channel.
+        moduleOuts = []
         for n in range(self.numInChans):
-            
-            # division into decorrelation modules.
             if n < self.numOutChans%self.numInChans:
                 numOuts = self.numOutChans//self.numInChans + 1
             elif n >= self.numOutChans%self.numInChans:
                 numOuts = self.numOutChans//self.numInChans
-                
-            audio = self.audioIn[:,n]
-            audio = audio.reshape(audio.shape[0],-1)
-
-            
-            if numOuts > 1:
-                # decorrelate either using a cascade of filters or a single multichannel filter bank.
-                if self.cascade == True:
-                    #Decorrelate the input audio based on a cascade of different filter lengths
-                    audioOutTemp = self.decorrelationCascade(audio, numOuts)
-                    
-                    
-                elif self.cascade == False:
-                    #Directly Decorrelate all the Audio.
-                    audioOutTemp = self.decorrelationDirect(audio, numOuts)
-            
-            #In the case not all channels need to be decorrelated...
-            elif numOuts ==1:
-                audioOutTemp = audio
-            else:
-                print('error: maybe too many inputs channels not enough output channels')
-
-                       
-            # pad the shorter and add to the output.
-            AudioOut.append(audioOutTemp)
-            
-        #combine all the outputs in single output file
-        # pad the shorter arrays to match the longer.
-        length = 0
-        for n in AudioOut:
-            length = max (length, len(n))
-       
-        for n in range(len(AudioOut)):
-            #pad shorter arrays
-            AudioOut[n] = np.pad(AudioOut[n], [(0, length - len(AudioOut[n])), (0, 0)], mode='constant', constant_values=0)
-        AudioOutFinal = AudioOut[0]
-        
-        for n in range(len(AudioOut)-1):
-            AudioOutFinal = np.hstack((AudioOutFinal, AudioOut[n + 1]))
-            
-
-        return AudioOutFinal
+            moduleOuts.append(numOuts)
 
+        return moduleOuts
 
 
     def decorrelationDirect(self, audio, numOuts):
@@ -172,6 +284,20 @@ class Decorrelator(object):
         #          2 Full stages    2 Part stage Channel
     
     
+        if self.cascade_mode == 'composite':
+            # The whole tree as one filter per output, so the audio is filtered in a single batched pass.
+            audioOut = self.convolve(audio, self.compositeFilters(numOuts))
+        elif self.cascade_mode == 'stages':
+            audioOut = self.stageCascade(audio, numOuts)
+
+        # Normalise the output r.m.s to match the input. 
+        scale = np.sqrt(self.inputMeanSquare())/  np.sqrt(np.mean(np.square(np.sum(audioOut, axis=1))))
+        audioOut *= scale
+        
+        return audioOut
+
+    def stageCascade(self, audio, numOuts):
+        # Runs the cascade a stage at a time, each stage decorrelating all the channels of the previous one.
         numFullStages = int(np.floor(np.log2(numOuts)))
         partStageChans = numOuts-2**numFullStages
         # filter length will halve on each stage.
@@ -185,22 +311,206 @@ class Decorrelator(object):
             filterLength = filterLength/2
 
         if partStageChans > 0:
+            # The part stage outputs are followed by the remaining channels of the previous stage, zero padded.
             audioOutTemp = self.decorrelate(audio[:,:partStageChans], filterLength)
-            audioOut = np.pad(audio[:,partStageChans:], ((0, len(audioOutTemp)-len(audioOut)), (0, 0)), 'constant')
-            audioOut = np.concatenate((audioOutTemp,audioOut), axis=1)
+            audioOut = np.zeros((len(audioOutTemp), audioOutTemp.shape[1] + audio.shape[1] - partStageChans), dtype = audioOutTemp.dtype)
+            audioOut[:,:audioOutTemp.shape[1]] = audioOutTemp
+            audioOut[:len(audio),audioOutTemp.shape[1]:] = audio[:,partStageChans:]
 
-        # Normalise the output r.m.s to match the input. 
-        scale = np.sqrt(np.mean(np.square(self.audioIn)))/  np.sqrt(np.mean(np.square(np.sum(audioOut, axis=1))))
-        audioOut = audioOut*scale
-        
         return audioOut
+
+    def compositeFilters(self, numOuts):
+        # Filters from the input to each of the numOuts outputs of the cascade, cached for seeded decorrelators.
+        if self.seed is None or not self.cache_filters:
+            return cascade_response(self.cascadeStages(numOuts))
+        key = (type(self).__name__, 'compositeFilters', self.fs, self.filterLength, numOuts, self.seed, self.module)
+        Filters = self.filter_cache.filters(key, lambda: cascade_response(self.cascadeStages(numOuts)))
+
+        return Filters
     
+    def process_block(self, block):
+        # Streaming mode. Decorrelates a single block of (blockSize, numInChans) samples and returns 
+        # a (blockSize, numOutChans) block. The filter tails are carried over to the following blocks 
+        # using uniformly partitioned convolution so the latency is only the block length and memory is fixed.
+        # Streaming uses the same module structure as decorrelateAudio() but the r.m.s normalisation is
+        # calculated from the filters (unity gain of the mono downmix for white noise) rather than the signal.
+        block = add_dimension(block)
+        if block.shape != (self.blockSize, self.numInChans):
+            raise ValueError('Blocks must be {b} samples by {c} channels, not {s}'.format(b = self.blockSize, c = self.numInChans, s = block.shape))
+        if self.streamModules is None:
+            self.streamModules = self.initStream()
+
+        with instrumentation.stage('process_block ' + type(self).__name__, block.size):
+            blockOut = np.zeros((self.blockSize, self.numOutChans))
+            chan = 0
+            for n, stages in enumerate(self.streamModules):
+                audio = block[:,[n]]
+                for stage in stages:
+                    audio = stage.process(audio)
+                blockOut[:,chan:chan+audio.shape[1]] = audio
+                chan += audio.shape[1]
+
+        return blockOut
+
+    def flush(self):
+        # Streaming mode. Returns the remaining filter tails after the last block and resets the stream.
+        # Shorter tails are zero padded, equivalent to the padding in decorrelateAudio().
+        if self.streamModules is None:
+            return np.zeros((0, self.numOutChans))
+
+        tailLength = max(sum(stage.tailLength for stage in stages) for stages in self.streamModules)
+        numBlocks = int(np.ceil(tailLength / self.blockSize))
+        silence = np.zeros((self.blockSize, self.numInChans))
+        tail = np.zeros((numBlocks * self.blockSize, self.numOutChans))
+        for n in range(numBlocks):
+            tail[n*self.blockSize:(n+1)*self.blockSize] = self.process_block(silence)
+
+        for stages in self.streamModules:
+            for stage in stages:
+                stage.reset()
+
+        return tail[:tailLength]
+
+    def initStream(self):
+        # Generate the filters for each decorrelator module as a chain of partitioned convolvers.
+        streamModules = []
+        for n, numOuts in enumerate(self.moduleOutputs()):
+            self.startModule(n)
+            if numOuts > 1:
+                if self.cascade == True:
+                    stages = self.streamCascade(numOuts)
+                elif self.cascade == False:
+                    stages = [self.streamConvolver(numOuts)]
+            #In the case not all channels need to be decorrelated...
+            elif numOuts == 1:
+                stages = []
+            else:
+                raise ValueError('error: maybe too many inputs channels not enough output channels')
+            streamModules.append(stages)
+
+        return streamModules
+
+    def streamCascade(self, numOuts):
+        # Streaming equivalent of decorrelationCascade(). Each stage is a partitioned convolver 
+        # with an input map giving the channel of the previous stage that feeds each filter.
+        stageFilters = self.cascadeStages(numOuts)
+
+        # Normalise the downmix of the complete cascade using its impulse response.
+        stageFilters[-1] = (stageFilters[-1][0]*downmix_gain(cascade_response(stageFilters)), stageFilters[-1][1])
+
+        stages = [stream_convolver(Filters, self.blockSize, inputMap = inputMap, method = self.convolution_method, spectrumCache = self.spectrumCache()) for Filters, inputMap in stageFilters]
+
+        return stages
+
+    def cascadeStages(self, numOuts):
+        # The (filters, inputMap) of each stage of the cascade. Output k of a stage is channel inputMap[k] 
+        # of the previous stage filtered by filters[:,k], in the same channel order as stageCascade().
+        numFullStages = int(np.floor(np.log2(numOuts)))
+        partStageChans = numOuts-2**numFullStages
+        filterLength = self.filterLength
+        numChans = 1
+        stageFilters = []
+
+        for n in range(numFullStages):
+            Filters = self.getFilters(self.genFilter, filterLength)
+            stageFilters.append((np.repeat(Filters, numChans, axis=1), np.tile(np.arange(numChans), 2)))
+            numChans = numChans*2
+            filterLength = filterLength/2
+
+        if partStageChans > 0:
+            Filters = self.getFilters(self.genFilter, filterLength)
+            # Channels that are not decorrelated in the part stage pass straight through.
+            passThrough = np.zeros((len(Filters), numChans-partStageChans))
+            passThrough[0,:] = 1
+            stageFilters.append((np.hstack((np.repeat(Filters, partStageChans, axis=1), passThrough)),
+                                 np.concatenate((np.tile(np.arange(partStageChans), 2), np.arange(partStageChans, numChans)))))
+
+        return stageFilters
+
+    def streamConvolver(self, numOuts):
+        # Convolver from one input to numOuts outputs used for streaming.
+        convolver = stream_convolver(self.streamFilters(numOuts), self.blockSize, method = self.convolution_method, spectrumCache = self.spectrumCache())
+        return convolver
+
+    def streamFilters(self, numOuts):
+        """"Filters from one input to numOuts outputs used for streaming."""
+        raise NotImplementedError('{d} does not support streaming'.format(d = type(self).__name__))
+
+    def moduleFilters(self, numOuts):
+        # Filters from one input to the numOuts outputs of a module, normalised as when streaming.
+        if self.cascade == True:
+            Filters = cascade_response(self.cascadeStages(numOuts))
+            return Filters*downmix_gain(Filters)
+        return self.streamFilters(numOuts)
+
+    def stftFilters(self, nfft, hop = None):
+        # STFT domain mode. Returns (gains, inputChannels) where gains is (numDelays, nfft//2+1, numOutChans) for an
+        # STFT of size nfft with frames every hop samples (default nfft//4). Output k is then the sum over q of the
+        # STFT of input channel inputChannels[k] delayed by q frames and multiplied bin by bin by gains[q,:,k], 
+        # so each filter is a per bin change of phase and gain (e.g. random phase for AllPass, complementary 
+        # combs for Lauridsen) on a few delayed frames. See frame_responses().
+        if hop is None:
+            hop = nfft//4
+        moduleGains = []
+        inputChannels = []
+        for n, numOuts in enumerate(self.moduleOutputs()):
+            self.startModule(n)
+            if numOuts > 1:
+                try:
+                    Filters = self.moduleFilters(numOuts)
+                except NotImplementedError:
+                    raise NotImplementedError('{d} can not decorrelate in the STFT domain'.format(d = type(self).__name__)) from None
+            else:
+                Filters = np.ones((1, numOuts))
+            moduleGains.append(frame_responses(Filters, nfft, hop))
+            inputChannels += [n]*numOuts
+
+        # Modules with shorter filters need fewer delayed frames.
+        numDelays = max(len(gains) for gains in moduleGains)
+        gains = np.zeros((numDelays, nfft//2+1, len(inputChannels)), dtype = complex)
+        chan = 0
+        for moduleGain in moduleGains:
+            gains[:len(moduleGain),:,chan:chan+moduleGain.shape[2]] = moduleGain
+            chan += moduleGain.shape[2]
+
+        return gains, np.array(inputChannels, dtype=int)
+
     def ms2samp (self, filterLength):
         NumSamples = int((filterLength / 1000) * self.fs)
 
         return NumSamples
     
+    def convolve(self, audio, filters):
+        # All FIR filtering is routed through the convolution engine so long filters can use the FFT methods.
+        # Only the partitioned method is set up by the decorrelator's blockSize, the others choose their own blocks.
+        blockSize = self.blockSize if self.convolution_method == 'partitioned' else None
+        audioOut = convolve(audio, filters.astype(self.dtype, copy = False), method = self.convolution_method, blockSize = blockSize, spectrumCache = self.spectrumCache())
+
+        return audioOut
+
+    def spectrumCache(self):
+        # Seeded filters are reused so their spectra are cached too.
+        if self.seed is None or not self.cache_filters:
+            return None
+        return self.filter_cache
 
+    def getFilters(self, generator, *args):
+        # Generate filters by calling generator(*args) which draws its random numbers from self.rng.
+        # Without a seed the global numpy random state is used.
+        # With a seed each call has its own random state derived from the seed, module and call number 
+        # so the filters are reproducible and can be cached under the same parameters.
+        self.filterCall += 1
+        if self.seed is None:
+            self.rng = np.random
+            return design_filters(generator, args)
+
+        self.rng = np.random.default_rng([self.seed, self.module, self.filterCall])
+        if not self.cache_filters:
+            return design_filters(generator, args)
+        key = (type(self).__name__, generator.__name__, self.fs) + args + (self.seed, self.module, self.filterCall)
+        Filters = self.filter_cache.filters(key, lambda: design_filters(generator, args))
+
+        return Filters
     
     @abstractmethod
     def decorrelate():
@@ -223,31 +533,21 @@ class AllPass(Decorrelator):
 
     def decorrelate(self, audio, numOuts):
         """"Decorrelate using AllPass"""
-        Filters = self.genAllPass(self.filterLength, numOuts)
+        Filters = self.getFilters(self.genAllPass, self.filterLength, numOuts)
 
-        audioOut = np.zeros((len(audio)+self.ms2samp(self.filterLength)-1, numOuts))
-        for n in range(numOuts):
-            audioOut[:,n] = np.convolve(np.squeeze(audio),Filters[:,n])
+        audioOut = self.convolve(audio, Filters)
     
         scale = np.sqrt(np.mean(np.square(audio)))/  np.sqrt(np.mean(np.square(np.sum(audioOut, axis=1))))
-        audioOut = audioOut*scale
+        audioOut *= scale
         return audioOut  
         
+    def streamFilters(self, numOuts):
+        Filters = self.getFilters(self.genAllPass, self.filterLength, numOuts)
+        return Filters*downmix_gain(Filters)
+        
     def genAllPass(self, filterLength , numChans):
         #Filterlength in ms. Default is generally ok for Stereo based on minimal artefacts.
-        filterLength = self.ms2samp (filterLength)
-        
-        Filters = np.zeros((filterLength,numChans))
-       
-        for n in range(numChans):
-            
-            phases=np.random.uniform(low = 0,high = 2*np.pi, size = filterLength//2)
-            a=np.zeros(filterLength,dtype=np.complex)
-            a[1:filterLength//2 + 1] = np.exp(np.multiply(1j,phases))
-            a[-(filterLength//2) :] =a[-(filterLength//2) :] + np.exp(np.flipud(np.multiply(-1j,phases)))
-            a[0] = 0
-            Filters[:,n]=np.fft.ifft(a).real
-        
+        Filters = allpass_filters(self.ms2samp(filterLength), numChans, self.rng)
     
         return Filters
 
@@ -266,13 +566,11 @@ class Lauridsen(Decorrelator):
     def decorrelate(self, audio, filterLength):
         """"Decorrelate using Lauridsen. Returns double the number of inputs"""
 
-        Filters = self.genFilter(filterLength)
+        Filters = self.getFilters(self.genFilter, filterLength)
         numInChans = audio.shape[1]
-        numOutChans = (numInChans)*2
-        audioDouble= np.concatenate((audio,audio), axis=1)
-        audioOut = np.pad(audioDouble, ((0, len(Filters)-1), (0, 0)), 'constant')
-        for ch in range(numOutChans):
-            audioOut[:,ch] = np.convolve(audioDouble[:,ch],Filters[:,ch//numInChans])
+        # Output channel ch is input channel ch % numInChans filtered by Filters[:,ch//numInChans]
+        # Each input channel is transformed once and used for both filters.
+        audioOut = self.convolve(audio, np.repeat(Filters, numInChans, axis=1))
         return audioOut
 
 
@@ -319,7 +617,7 @@ class Fink(Lauridsen):
 
         w = 1 #Stereo width parameter
         
-        b = np.random.normal(0, 25, D);
+        b = self.rng.normal(0, 25, D);
 
         b = 0.5 + np.arctan(b* w**2) / np.pi;
         
@@ -344,28 +642,13 @@ class FreqLauridsen(Lauridsen):
         
     def genFilter(self, filterLength = 8.4427):
         #Filter length is the number of periods for the delay.
-        #Generate a sine sweep by iteratively advancing the phase and choosing a new sample value based on the current desired frequency.
         length = int(np.ceil(self.fs/20*filterLength))
-        intermediateLen = length+self.fs
-        previousphase = 0   #variable to hold the current phase of the sine sweep
-        SineSweep = np.zeros (intermediateLen);
-        
-        for n in range (1,intermediateLen-1):
-            t=n/self.fs#%delay from the beginining of the sweep
-            f=filterLength*self.fs/n #frequency at sample n is given by...fs x alpha 
-            SineSweep[n] = np.sin(2*np.pi*f*t+previousphase)#calculate value n of the sinesweep
-            previousphase = (2*np.pi*f/self.fs)+previousphase
-        
-        #Equlise to give a flat frequency response esp for short filter lengths.
-        C=np.fft.fft(SineSweep)
-        zz=np.multiply(np.ones(len(C)),np.exp(np.multiply(1j,np.angle(C))))#Restore the linear frequency response
-        YY=np.fft.ifft(zz)#Restore the impulse response now with correct frequency response.
         
         # Filter length is determined by the filterlength required for 20Hz.
         
         if length > self.fs:
-            print('The Filter is over 1 second long ({m} seconds)'.format( m=length/self.fs))
-        CousinsFilter = np.real(YY[0:length])# truncate the filter. the real is only needed at very short filter lengths. not sure why at the moment.
+            logger.warning('The Filter is over 1 second long (%s seconds)', length/self.fs)
+        CousinsFilter = equalised_sine_sweep(filterLength, self.fs)[0:length]# truncate the filter.
     
         #Turn the sine sweep into a pair of complementary comb filters.
         Filters = np.zeros((length,2))
@@ -376,37 +659,123 @@ class FreqLauridsen(Lauridsen):
         return Filters  
 
 
+@functools.lru_cache(maxsize = 32)
+def equalised_sine_sweep(filterLength, fs):
+    # Sine sweep used by FreqLauridsen, equalised to a flat frequency response. Cached as it is deterministic, so it is returned read only.
+    # The sweep's frequency at sample n is f = filterLength*fs/n and the phase advances by 2*pi*f/fs each sample.
+    # The phase is the cumulative sum of those advances, equivalent to advancing it one sample at a time.
+    intermediateLen = int(np.ceil(fs/20*filterLength))+fs
+    n = np.arange(1, intermediateLen-1)
+    t = n/fs #delay from the beginining of the sweep
+    f = filterLength*fs/n #frequency at sample n is given by...fs x alpha 
+    previousphase = np.concatenate(([0], np.cumsum(2*np.pi*f/fs)[:-1]))
+    SineSweep = np.zeros(intermediateLen)
+    SineSweep[n] = np.sin(2*np.pi*f*t+previousphase)
+    
+    #Equlise to give a flat frequency response esp for short filter lengths.
+    C = np.fft.rfft(SineSweep)
+    zz = np.exp(np.multiply(1j,np.angle(C)))#Restore the linear frequency response
+    Sweep = np.fft.irfft(zz, intermediateLen)#Restore the impulse response now with correct frequency response.
+    Sweep.setflags(write = False)
+
+    return Sweep
+
+
 
 
 class TransientPanner(Decorrelator):
     
     cascade = False
+    # Onset detection uses librosa which is faster in separate processes.
+    preferredExecutor = 'processes'
     
-    def __init__(self, audioIn, panning_method = 'random', **kwargs):
+    def __init__(self, audioIn, panning_method = 'random', crossfade = 0, onsets = None, **kwargs):
         
         self.panning_method = panning_method
+        # Optional list of the onset sample positions of each input channel, e.g. from the separation
+        # (see percussive_harmonic_decorrelator.transient_onsets, an approximation of librosa's detection on a 
+        # different frame grid). Otherwise the onsets are detected here with librosa.onset.onset_detect.
+        self.onsets = onsets
+        # Length in ms of the equal power crossfade before each transient that moves to a new loudspeaker.
+        self.crossfade = crossfade
+        # Loudspeaker of the last transient and random state of each module when processing in chunks.
+        self.lastChannels = None
+        self.moduleRngs = None
         super().__init__(audioIn, **kwargs)
 
     def decorrelate(self, audioIn, numOuts):
         #detect onsets 
         audioIn = np.squeeze(audioIn)
-        onset_frames = librosa.onset.onset_detect(y=audioIn, sr=self.fs, backtrack=True)
-        onset_samples = librosa.frames_to_samples(onset_frames)
+        if self.onsets is None:
+            # librosa's onset detection with its default frames, as process_chunk().
+            with instrumentation.stage('onset_detect', len(audioIn)):
+                onset_frames = librosa.onset.onset_detect(y=audioIn, sr=self.fs, backtrack=True)
+            onset_samples = librosa.frames_to_samples(onset_frames)
+        else:
+            onset_samples = np.asarray(self.onsets[self.module], dtype=int)
         #select a random loudspeaker for each detected transient.
-        selectChannel = self.transposition(numTrans=len(onset_frames), numChans = numOuts )
-        audioOut = np.zeros((len(audioIn),numOuts))
+        selectChannel = self.transposition(numTrans=len(onset_samples), numChans = numOuts )
         #Divide the input audio based on the onsets and pan to loudspeaker.
-        for x in range(len(onset_frames)-1):
-            audioOut[onset_samples[x]:(onset_samples[x+1]),selectChannel[x]] = audioIn[onset_samples[x]:(onset_samples[x+1])]
+        # Each transient lasts until the next one, the last until the end. The audio before the first transient is 
+        # spread over all the loudspeakers.
+        boundaries = np.concatenate(([0], np.minimum(onset_samples, len(audioIn)), [len(audioIn)]))
+        audioOut = route_segments(audioIn, boundaries, np.concatenate(([-1], selectChannel)), numOuts, self.ms2samp(self.crossfade))
+        return audioOut
+    
+    def process_chunk(self, audioIn, start, length, onsets = None):
+        # Chunked mode for long signals. Pans the transients in audioIn[start:start+length] and returns 
+        # a (length, numOutChans) chunk. Onsets are detected over the whole of audioIn so it should include 
+        # some context either side of the chunk. The loudspeaker of the last transient is carried over to 
+        # the start of the next chunk so transients that cross the chunk boundary are not split.
+        # onsets optionally gives the onset sample positions in audioIn of each module instead, 
+        # e.g. from percussive_harmonic_decorrelator.OnsetEnvelope, and then audioIn needs no context.
+        audioIn = add_dimension(audioIn)
+        if self.lastChannels is None:
+            self.lastChannels = [None]*self.numInChans
+            # Each module draws its loudspeakers from its own random state (see startModule()), continued from chunk to chunk.
+            self.moduleRngs = []
+            for n in range(self.numInChans):
+                self.startModule(n)
+                self.moduleRngs.append(self.rng)
+
+        audioOut = np.zeros((length, self.numOutChans))
+        chan = 0
+        for n, numOuts in enumerate(self.moduleOutputs()):
+            audio = audioIn[:,n]
+            self.module = n
+            self.rng = self.moduleRngs[n]
+            if numOuts > 1 and onsets is not None:
+                onset_samples = np.asarray(onsets[n], dtype=int)
+            elif numOuts > 1:
+                # Otherwise librosa's onset detection with its default frames, as decorrelate() without onsets.
+                # The onsets given to the constructor are not used as they are for the whole signal rather than this chunk.
+                with instrumentation.stage('onset_detect', len(audio)):
+                    onset_frames = librosa.onset.onset_detect(y=audio, sr=self.fs, backtrack=True)
+                onset_samples = librosa.frames_to_samples(onset_frames)
+            if numOuts > 1:
+                onset_samples = onset_samples[(onset_samples >= start) & (onset_samples < start + length)]
+                selectChannel = self.transposition(numTrans=len(onset_samples), numChans = numOuts)
+                
+                # The start of the chunk continues the last transient of the previous chunk, 
+                # or is spread over all the loudspeakers before the first transient.
+                boundaries = np.concatenate(([start], onset_samples, [start + length])) - start
+                channels = np.concatenate(([-1 if self.lastChannels[n] is None else self.lastChannels[n]], selectChannel))
+                audioOut[:, chan:chan + numOuts] = route_segments(audio[start:start + length], boundaries, channels, numOuts, self.ms2samp(self.crossfade))
+                if channels[-1] >= 0:
+                    self.lastChannels[n] = channels[-1]
+            elif numOuts == 1:
+                audioOut[:, chan] = audio[start:start + length]
+            chan += numOuts
+
         return audioOut
     
     def transposition (self, numTrans, numChans = 2 ):
         
         if self.panning_method == 'random':
-            selectChannel = np.random.randint(numChans, size=numTrans)
+            selectChannel = random_integers(self.rng, numChans, size=numTrans)
         elif self.panning_method == 'frequency':
         #TODO change this to division based on the ferquency content of the transients.
-            selectChannel = np.random.randint(numChans, size=numTrans)
+            selectChannel = random_integers(self.rng, numChans, size=numTrans)
             
         return selectChannel
     
@@ -421,19 +790,71 @@ class FauxReverb(Decorrelator):
     
 
     def decorrelate(self, audioIn, numOuts ):
-        lr= self.reverbTime*self.fs
-        noises = np.random.randn(lr, numOuts)
-        audioOut = np.zeros((len(audioIn)+lr-1,numOuts))        
-        window = np.exp((-np.linspace(1,lr, num=lr))*(-np.log10(0.001)/lr));
-    
-        for x in range(numOuts):
-            Filter = noises[:,x]*window
-            audioOut[:,x] = np.convolve(audioIn, Filter)
+        # The long noise tails use non-uniform partitioned convolution, see partitioned_convolve(). 
+        # Each segment is convolved with convolution_method.
+        method = 'auto' if self.convolution_method == 'partitioned' else self.convolution_method
+        audioOut = partitioned_convolve(audioIn, self.reverbSegments(numOuts), self.blockSize, filterLength = self.reverbLength(), 
+                                        method = method, spectrumCache = self.spectrumCache())
         
         scale = np.sqrt(np.mean(np.square(audioIn)))/  np.sqrt(np.mean(np.square(np.sum(audioOut, axis=1))))
-        audioOut = audioOut*scale    
+        audioOut *= scale
         return audioOut
 
+    def streamConvolver(self, numOuts):
+        # Non-uniform partitioned convolver with the same segments as decorrelate(). 
+        # The downmix gain is summed over the segments as they are generated.
+        power = []
+        reverbSegments = self.reverbSegments(numOuts)
+        def segment(offset, length):
+            Filters = reverbSegments(offset, length)
+            power.append(np.sum(np.square(np.sum(Filters, axis=1))))
+            return Filters
+        convolver = NonUniformConvolver(segment, self.blockSize, filterLength = self.reverbLength(), spectrumCache = self.spectrumCache())
+        convolver.gain = 1/np.sqrt(sum(power))
+        return convolver
+
+    def reverbLength(self):
+        return int(self.reverbTime*self.fs)
+
+    def reverbSegments(self, numOuts):
+        # Function giving the taps offset to offset+length of the filters. 
+        # The noise is generated (and cached) in fixed chunks of REVERB_CHUNK_LENGTH taps when it is needed, each
+        # with its own random state from the seed, module and chunk index. The segments are sliced from the chunks 
+        # so the filters are the same however they are partitioned, i.e. for any blockSize.
+        # Without a seed the chunks share one random seed drawn here so they still make up one filter.
+        seed = self.seed if self.seed is not None else np.random.randint(2**31)
+        module = self.module
+        def reverbChunk(chunk):
+            rng = np.random.default_rng([seed, module, 0, chunk])
+            generate = lambda: self.genReverb(self.reverbTime, numOuts, chunk*REVERB_CHUNK_LENGTH, REVERB_CHUNK_LENGTH, rng = rng)
+            if self.seed is None or not self.cache_filters:
+                return generate()
+            key = (type(self).__name__, 'reverbChunk', self.fs, self.reverbTime, numOuts, chunk, seed, module)
+            return self.filter_cache.filters(key, generate)
+        def reverbSegment(offset, length):
+            first = offset//REVERB_CHUNK_LENGTH
+            last = (offset+length-1)//REVERB_CHUNK_LENGTH
+            noise = np.vstack([reverbChunk(chunk) for chunk in range(first, last+1)])
+            Filters = noise[offset-first*REVERB_CHUNK_LENGTH:offset-first*REVERB_CHUNK_LENGTH+length]
+            return Filters.astype(self.dtype, copy = False)
+        return reverbSegment
+
+    def genReverb(self, reverbTime, numOuts, offset = 0, length = None, rng = None):
+        # White noise with an exponential decay reaching -60dB after reverbTime.
+        # Only the taps offset to offset+length are generated (all of them by default).
+        # The noise is drawn from rng, self.rng by default.
+        if rng is None:
+            rng = self.rng
+        lr= int(reverbTime*self.fs)
+        if length is None:
+            length = lr - offset
+        n = np.arange(offset, min(offset + length, lr))
+        noises = rng.standard_normal((len(n), numOuts))
+        window = np.exp((-(n + 1))*(-np.log10(0.001)/lr));
+    
+        Filters = noises*add_dimension(window)
+        return Filters
+
 
 class Copier(Decorrelator):
     
@@ -451,9 +872,14 @@ class Copier(Decorrelator):
         #Normailise gains assuming incoherent summing. (technically faulse but usuually sounds alright)
         # Equivalent of -3dB panning as opposed to 6dB panning
         gain = 1/ np.sqrt(numOuts)
-        audioOut = audioOut*gain    
+        audioOut *= gain
         return audioOut
 
+    def streamFilters(self, numOuts):
+        # A single tap filter for each loudspeaker with the same gain as decorrelate()
+        Filters = np.full((1, numOuts), 1/ np.sqrt(numOuts))
+        return Filters
+
 
 
 class VelvetNoise(Decorrelator):
@@ -468,38 +894,723 @@ class VelvetNoise(Decorrelator):
 
     def decorrelate(self, audioIn, numOuts ):
         
-        audioOut = np.zeros((len(audioIn)+self.filterLength-1,numOuts))
-        Filters = self.genvelvetnoise(filterLength=self.filterLength, density = self.density)
+        indices, signs = self.getFilters(self.genvelvetimpulses, self.filterLength, self.density, numOuts)
         
-        for x in range(numOuts):
-            Filter = Filters[:,x]
-            audioOut[:,x] = np.convolve(audioIn, Filter)
+        if self.convolution_method == 'sparse' or (self.convolution_method == 'auto' and select_sparse(indices, signs)):
+            # Velvet noise only has M = filterLength/Td nonzero taps so is filtered with M signed shifted adds.
+            with instrumentation.stage('convolution sparse', len(audioIn) * numOuts):
+                audioOut = sparse_convolve(audioIn, indices, signs.astype(self.dtype), self.filterLength)
+        else:
+            audioOut = self.convolve(audioIn, sparse_to_dense(indices, signs, self.filterLength))
                 
         scale = np.sqrt(np.mean(np.square(audioIn)))/  np.sqrt(np.mean(np.square(np.sum(audioOut, axis=1))))
-        audioOut = audioOut*scale
+        audioOut *= scale
         
         return audioOut      
     
-    def genvelvetnoise(self, filterLength=442, density = 3000):
-        Filters = np.zeros((self.filterLength,self.numChans))
-        Td = self.fs/density #average period.
-        M = int(np.floor(filterLength/Td))#Total NUmber of Impulses
-        
-        for n in range(self.numChans):
-            #phases=np.random.uniform(low = 0,high = 2*np.pi, size = filterLength//2-1)
-            r1 = np.random.uniform(low=0,high=1, size = M)
-            r2 = np.random.uniform(low=0,high=1, size = M)
-            s = (2*np.round(r1)) -1  # Amplitude of the impulse
-            k = np.zeros(filterLength)
-            for m in range(M):
-                k[m] = round((m*Td + r2[m]*(Td-1))) #Index of impulse number m
-            x = np.zeros(filterLength)
-            for m in range(M):
-                x[int(k[m])] = s[m]
-            Filters[:,n]=x
+    def streamFilters(self, numOuts):
+        indices, signs = self.getFilters(self.genvelvetimpulses, self.filterLength, self.density, numOuts)
+        Filters = sparse_to_dense(indices, signs, self.filterLength)
+        return Filters*downmix_gain(Filters)
+
+    def streamConvolver(self, numOuts):
+        indices, signs = self.getFilters(self.genvelvetimpulses, self.filterLength, self.density, numOuts)
+        gain = downmix_gain(sparse_to_dense(indices, signs, self.filterLength))
+        if self.convolution_method in ('auto', 'sparse'):
+            convolver = SparseConvolver(indices, signs*gain, self.filterLength, self.blockSize)
+        else:
+            convolver = PartitionedConvolver(sparse_to_dense(indices, signs*gain, self.filterLength), self.blockSize, spectrumCache = self.spectrumCache())
+        return convolver
+    
+    def genvelvetnoise(self, filterLength=442, density = 3000, numChans = 1):
+        # Dense (filterLength, numChans) velvet noise filters.
+        indices, signs = self.genvelvetimpulses(filterLength = filterLength, density = density, numChans = numChans)
+        Filters = sparse_to_dense(indices, signs, filterLength)
             
         return Filters
     
+    def genvelvetimpulses(self, filterLength=442, density = 3000, numChans = 1):
+        # Velvet noise filters stored as the (index, sign) pairs of their impulses, each (M, numChans).
+        indices, signs = velvet_impulses(filterLength, density, numChans, self.fs, self.rng)
+            
+        return indices, signs
+    
 def add_dimension (signal):
     signal = signal.reshape(signal.shape[0],-1)
     return signal
+
+
+def allpass_filters(filterLength, numChans, rng):
+    # (filterLength, numChans) random phase all pass filters with unit magnitude at every frequency but DC.
+    # rng is a numpy.random.Generator (or the numpy.random module). All the channels are made with one 
+    # inverse FFT of the (bins, numChans) spectra, and the phases are drawn in the same order as one channel 
+    # at a time so the filters don't depend on how they are batched.
+    phases = rng.uniform(low = 0, high = 2*np.pi, size = (numChans, filterLength//2)).T
+    spectra = np.zeros((filterLength//2 + 1, numChans), dtype=complex)
+    spectra[1:] = np.exp(1j*phases)
+    if filterLength % 2 == 0:
+        # The Nyquist bin is the sum of the positive and negative frequency phasors.
+        spectra[-1] = 2*np.cos(phases[-1])
+    Filters = np.fft.irfft(spectra, filterLength, axis=0)
+
+    return Filters
+
+
+def velvet_impulses(filterLength, density, numChans, fs, rng):
+    # (index, sign) pairs of the M = filterLength/Td impulses of velvet noise filters, each (M, numChans).
+    # One impulse with a random sign is placed at a random position in each period of Td = fs/density samples.
+    # rng is a numpy.random.Generator (or the numpy.random module). The random numbers are drawn in the 
+    # same order as one channel at a time.
+    Td = fs/density #average period.
+    M = int(np.floor(filterLength/Td))#Total NUmber of Impulses
+    r = rng.uniform(low=0, high=1, size = (numChans, 2, M))
+    signs = (2*np.round(r[:,0].T)) -1  # Amplitude of the impulse
+    indices = np.round(add_dimension(np.arange(M))*Td + r[:,1].T*(Td-1)).astype(int) #Index of impulse number m
+
+    return indices, signs
+
+
+def route_segments(audio, boundaries, channels, numOuts, fadeLength = 0):
+    # Routes each segment audio[boundaries[k]:boundaries[k+1]] of the 1D audio to output channels[k] of a 
+    # (len(audio), numOuts) array in one vectorised step from a channel index for every sample.
+    # Channel -1 spreads the segment over all the outputs with equal power.
+    # fadeLength > 0 crossfades with equal power over the fadeLength samples before each change of channel
+    # (shortened if the previous segment is shorter), so each transient itself starts at full level.
+    channels = np.asarray(channels, dtype=int)
+    boundaries = np.asarray(boundaries, dtype=int)
+    channelIndex = np.repeat(channels, np.diff(boundaries))
+    audioOut = np.zeros((len(audio), numOuts), dtype = audio.dtype)
+    gains = None
+
+    if fadeLength > 0 and len(channels) > 1:
+        onsets = boundaries[1:-1]
+        fadeStart = np.maximum(onsets - fadeLength, boundaries[:-2])
+        fading = (channels[:-1] != channels[1:]) & (channels[:-1] >= 0) & (channels[1:] >= 0)
+        # Sample positions of all the fades at once, masked to the fade of each onset.
+        positions = add_dimension(onsets) - fadeLength + np.arange(fadeLength)
+        mask = (positions >= add_dimension(fadeStart)) & add_dimension(fading)
+        phase = (positions - add_dimension(fadeStart) + 0.5) / add_dimension(np.maximum(onsets - fadeStart, 1)) * np.pi/2
+        positions = positions[mask]
+        gains = np.ones(len(audio), dtype = audio.dtype)
+        gains[positions] = np.cos(phase[mask])
+        audioOut[positions, np.broadcast_to(add_dimension(channels[1:]), mask.shape)[mask]] = audio[positions] * np.sin(phase[mask])
+
+    # Scatter every sample into its channel through the flat index of the C ordered output.
+    # The spread segments are scattered to channel 0 then overwritten.
+    flatIndex = np.arange(len(audio)) * numOuts
+    flatIndex += np.maximum(channelIndex, 0)
+    audioOut.reshape(-1)[flatIndex] = audio if gains is None else audio * gains
+    for k in np.flatnonzero(channels < 0):
+        audioOut[boundaries[k]:boundaries[k+1]] = audio[boundaries[k]:boundaries[k+1], np.newaxis] / np.sqrt(numOuts)
+
+    return audioOut
+
+
+def random_integers(rng, high, size):
+    # Random integers from the numpy.random module or a numpy.random.Generator
+    if isinstance(rng, np.random.Generator):
+        return rng.integers(high, size=size)
+    return rng.randint(high, size=size)
+
+
+def build_kernel(directory, decorrelation_method, numInChans = 1, numOutChans = 2, fs = 48000, seed = 0, blockSize = 1024, **arguments):
+    # Designs the filters of a decorrelator once and saves them as a decorrelation kernel in directory 
+    # with the spectra of their partitions for streaming with blockSize, see filter_cache.Kernel.
+    # arguments are the arguments of decorrelation_method (a class or its name), e.g. filterLength.
+    # Returns the loaded kernel.
+    if isinstance(decorrelation_method, str):
+        decorrelation_method = globals()[decorrelation_method]
+    cache = fc.FilterCache(maxsize = np.inf, directory = directory)
+    settings = dict(fs = fs, numOutChans = numOutChans, seed = seed, blockSize = blockSize)
+
+    # Decorrelating a block with an impulse designs the filters of every module and cascade stage.
+    impulse = np.zeros((blockSize, numInChans))
+    impulse[0] = 1
+    decorrelation_method(impulse, convolution_method = 'direct', filter_cache = cache, **settings, **arguments)
+    # Streaming uses the same filters and also needs the spectra of their partitions.
+    try:
+        decorrelation_method(None, numInChans = numInChans, filter_cache = cache, **settings, **arguments).initStream()
+    except NotImplementedError:
+        pass
+
+    fc.write_kernel(directory, dict(decorrelator = decorrelation_method.__name__, arguments = arguments, numInChans = numInChans, **settings))
+
+    return fc.Kernel(directory)
+
+
+def from_kernel(kernel, audioIn, **kwargs):
+    # Creates the decorrelator saved in kernel (a Kernel or its directory) with the settings it was built with.
+    # audioIn = None creates it in streaming mode. kwargs override the saved settings.
+    if isinstance(kernel, str):
+        kernel = fc.Kernel(kernel)
+    settings = kernel.settings
+    arguments = dict(fs = settings['fs'], numOutChans = settings['numOutChans'], blockSize = settings['blockSize'], **settings['arguments'])
+    if audioIn is None:
+        arguments['numInChans'] = settings['numInChans']
+
+    return globals()[settings['decorrelator']](audioIn, kernel = kernel, **{**arguments, **kwargs})
+
+
+def cascade_response(stageFilters):
+    # Impulse response from the input to each output of a cascade of (filters, inputMap) stages, 
+    # the stage filters convolved along each path through the tree.
+    response = np.ones((1, 1))
+    for Filters, inputMap in stageFilters:
+        response = convolve(response[:,inputMap], Filters)
+
+    return response
+
+
+def frame_responses(filters, nfft, hop):
+    # Filters split for STFT domain filtering, as (numDelays, nfft//2+1, numFilters) per bin gains. 
+    # Partition q holds the taps within hop/2 of a delay of q frames (q*hop samples). Delaying the STFT by q frames
+    # is an exact delay of the signal, so only the remaining delay of at most hop/2 is applied within each frame,
+    # as the FFT of the partition centred on sample 0, which keeps the circular wrap within the frames small.
+    filters = add_dimension(filters)
+    numDelays = (len(filters) + hop//2 - 1)//hop + 1
+    padded = np.zeros((numDelays*hop, filters.shape[1]))
+    padded[hop//2:hop//2+len(filters)] = filters
+    partitions = np.zeros((numDelays, nfft, filters.shape[1]))
+    partitions[:,:hop] = padded.reshape(numDelays, hop, -1)
+    response = np.fft.rfft(np.roll(partitions, -(hop//2), axis=1), axis=1)
+
+    return response
+
+
+def design_filters(generator, args):
+    # generator(*args), timed as the filter_design stage. Cached filters are not designed again so aren't counted.
+    with instrumentation.stage('filter_design'):
+        return generator(*args)
+
+
+def write_module(out, audio, chan):
+    # Copies the output of a decorrelator module into columns chan onwards of out, zero padding or truncating it.
+    length = min(len(audio), len(out))
+    out[:length, chan:chan+audio.shape[1]] = audio[:length]
+    out[length:, chan:chan+audio.shape[1]] = 0
+
+
+def decorrelate_module(decorrelator, n, numOuts, audio):
+    # Task run by the executor on audio, input channel n. 
+    # Each task works on its own copy so the module state is not shared between threads.
+    audioOut = copy.copy(decorrelator).decorrelateModule(n, numOuts, audio)
+
+    return audioOut
+
+
+# Ways cascaded decorrelators reach more than two outputs, see decorrelationCascade().
+CASCADE_MODES = ('composite', 'stages')
+
+
+#==============================================================================
+# Convolution engine
+#
+# Every FIR decorrelator filters through convolve(). The method can be selected
+# with the convolution_method argument of any Decorrelator:
+#
+#   'direct'        time domain np.convolve, O(N.L). Best for very short filters.
+#   'fft'           a single FFT over the whole signal, O(N log N).
+#   'overlap_add'   block FFT convolution, O(N log L). Bounded FFT size.
+#   'overlap_save'  as overlap_add but discards the circular wrap instead of adding tails.
+#   'sparse'        a signed shifted add per nonzero tap, O(N.M) for M nonzero taps (e.g. velvet noise).
+#   'partitioned'   non-uniformly partitioned convolution (see partitioned_convolve()), the offline equivalent
+#                   of streaming. The first partitions are blockSize taps (the decorrelator's blockSize, 
+#                   1024 when convolve() is called without one) and later ones double up to MAX_PARTITION_SIZE.
+#   'auto'          chooses one of the above from the signal and filter lengths and the number of nonzero taps,
+#                   so the two tap Lauridsen comb filters are run as a delay and add whatever the delay.
+#==============================================================================
+
+CONVOLUTION_METHODS = ('auto', 'direct', 'fft', 'overlap_add', 'overlap_save', 'sparse', 'partitioned')
+
+# Filters up to this many taps are cheaper to run directly in the time domain.
+DIRECT_MAX_TAPS = 64
+
+# Sparse filters with up to this many nonzero taps in total are cheaper as shifted adds than with the batched FFT.
+SPARSE_MAX_TAPS = 128
+# Sparse filters sharing up to this many delays (e.g. cascaded Lauridsen combs) are cheaper as a mix of delayed copies.
+SPARSE_MAX_DELAYS = 32
+# 'auto' only treats filters as sparse when no more than this fraction of their taps are nonzero.
+SPARSE_MAX_DENSITY = 0.25
+
+# Non-uniform partitioning: the number of partitions of each size before the size doubles, and the largest size.
+PARTITIONS_PER_SIZE = 4
+MAX_PARTITION_SIZE = 8192
+
+# FauxReverb noise is drawn in chunks of this many taps, independent of the partitioning.
+REVERB_CHUNK_LENGTH = 8192
+
+
+def convolve(audio, filters, method = 'auto', blockSize = None, spectrumCache = None):
+    # Convolve the audio with each column of filters.
+    # Output channel k is audio column k % numInChans filtered by filters[:,k], so the number of filters
+    # must be a multiple of the number of audio channels. A single audio column is used for every filter
+    # (1 to many channel upmix) and each audio column is only transformed once however many filters use it.
+    # The output is the full convolution, len(audio)+len(filters)-1 samples long, 
+    # in float32 if both the audio and filters are float32 and float64 otherwise.
+    # spectrumCache is an optional FilterCache to reuse the spectra of the filters.
+    audio = add_dimension(audio)
+    filters = add_dimension(filters)
+    if filters.shape[1] % audio.shape[1] != 0:
+        raise ValueError('The number of filters ({n}) must be a multiple of the number of audio channels ({m})'.format(n = filters.shape[1], m = audio.shape[1]))
+
+    if method == 'auto':
+        method = select_convolution_method(len(audio), len(filters), select_sparse_filters(filters))
+
+    with instrumentation.stage('convolution ' + method, len(audio) * filters.shape[1]):
+        return convolve_method(audio, filters, method, blockSize, spectrumCache)
+
+
+def convolve_method(audio, filters, method, blockSize = None, spectrumCache = None):
+    # Convolution with the given method, see convolve().
+    if method == 'direct':
+        audioOut = direct_convolve(audio, filters)
+    elif method == 'fft':
+        audioOut = fft_convolve(audio, filters, spectrumCache = spectrumCache)
+    elif method == 'overlap_add':
+        audioOut = overlap_add_convolve(audio, filters, blockSize = blockSize, spectrumCache = spectrumCache)
+    elif method == 'overlap_save':
+        audioOut = overlap_save_convolve(audio, filters, blockSize = blockSize, spectrumCache = spectrumCache)
+    elif method == 'sparse':
+        indices, gains = dense_to_sparse(filters)
+        audioOut = sparse_convolve(audio, indices, gains, len(filters))
+    elif method == 'partitioned':
+        audioOut = partitioned_convolve(audio, filters, blockSize = blockSize or 1024, spectrumCache = spectrumCache)
+    else:
+        raise ValueError('Unknown convolution method {m}. Choose from {c}'.format(m = method, c = CONVOLUTION_METHODS))
+
+    return audioOut
+
+
+def select_convolution_method(audioLength, filterLength, sparse = False):
+    # Sparse filters (see select_sparse_filters()) are shifted adds.
+    # Short filters (or signals) are fastest in the time domain.
+    # When the signal is not much longer than the filter a single FFT is cheapest,
+    # otherwise the signal is split into blocks of a few filter lengths.
+    if sparse:
+        method = 'sparse'
+    elif min(audioLength, filterLength) <= DIRECT_MAX_TAPS:
+        method = 'direct'
+    elif audioLength <= 4 * filterLength:
+        method = 'fft'
+    else:
+        method = 'overlap_add'
+
+    return method
+
+
+def next_pow2(n):
+    return int(2**np.ceil(np.log2(max(n, 1))))
+
+
+def default_block_size(filterLength):
+    # Number of input samples per block so that the FFT is around 4 filter lengths.
+    nfft = next_pow2(4 * filterLength)
+    blockSize = nfft - filterLength + 1
+
+    return blockSize
+
+
+def filter_spectra(filters, nfft, spectrumCache = None):
+    # Stacked (nfft//2+1, numFilters) spectrum matrix of the filters.
+    if spectrumCache is None:
+        spectra = np.fft.rfft(add_dimension(filters), nfft, axis=0)
+    else:
+        spectra = spectrumCache.spectra(add_dimension(filters), nfft)
+
+    return spectra
+
+
+def multiply_spectra(audioSpectra, filterSpectra):
+    # Multiply every filter spectrum with the spectrum of its audio channel in a single vectorised call.
+    # audioSpectra is (bins, numInChans) and is repeated across the (bins, numFilters) filter spectra.
+    numRepeats = filterSpectra.shape[1] // audioSpectra.shape[1]
+    if numRepeats == 1:
+        product = audioSpectra * filterSpectra
+    else:
+        product = (audioSpectra[:,np.newaxis,:] * filterSpectra.reshape(len(filterSpectra), numRepeats, -1)).reshape(filterSpectra.shape)
+
+    return product
+
+
+def direct_convolve(audio, filters):
+    numOuts = filters.shape[1]
+    audioOut = np.zeros((len(audio)+len(filters)-1, numOuts), dtype = np.result_type(audio, filters))
+    for n in range(numOuts):
+        audioOut[:,n] = np.convolve(audio[:,n % audio.shape[1]], filters[:,n])
+
+    return audioOut
+
+
+def fft_convolve(audio, filters, spectrumCache = None):
+    outLength = len(audio)+len(filters)-1
+    nfft = next_pow2(outLength)
+    audioSpectra = np.fft.rfft(audio, nfft, axis=0)
+    audioOut = np.fft.irfft(multiply_spectra(audioSpectra, filter_spectra(filters, nfft, spectrumCache)), nfft, axis=0)[:outLength]
+
+    return audioOut
+
+
+def overlap_add_convolve(audio, filters, blockSize = None, spectrumCache = None):
+    # Each block of input is convolved separately and the filter tails are added to the following block.
+    # Each block of audio is transformed once and filtered by all the filters at the same time.
+    filterLength = len(filters)
+    if blockSize is None:
+        blockSize = default_block_size(filterLength)
+    nfft = next_pow2(blockSize + filterLength - 1)
+    filterSpectra = filter_spectra(filters, nfft, spectrumCache)
+    audioOut = np.zeros((len(audio)+filterLength-1, filters.shape[1]), dtype = np.result_type(audio, filters))
+
+    for start in range(0, len(audio), blockSize):
+        block = audio[start:start+blockSize]
+        blockSpectra = multiply_spectra(np.fft.rfft(block, nfft, axis=0), filterSpectra)
+        blockOut = np.fft.irfft(blockSpectra, nfft, axis=0)[:len(block)+filterLength-1]
+        audioOut[start:start+len(blockOut)] += blockOut
+
+    return audioOut
+
+
+def overlap_save_convolve(audio, filters, blockSize = None, spectrumCache = None):
+    # Each FFT frame overlaps the previous by filterLength-1 samples.
+    # The first filterLength-1 samples of each frame are corrupted by the circular convolution and discarded.
+    filterLength = len(filters)
+    if blockSize is None:
+        blockSize = default_block_size(filterLength)
+    nfft = next_pow2(blockSize + filterLength - 1)
+    blockSize = nfft - filterLength + 1
+    filterSpectra = filter_spectra(filters, nfft, spectrumCache)
+    outLength = len(audio)+filterLength-1
+    audioOut = np.zeros((outLength, filters.shape[1]), dtype = np.result_type(audio, filters))
+    frame = np.zeros((nfft, audio.shape[1]), dtype = audio.dtype)
+
+    for start in range(0, outLength, blockSize):
+        # frame holds the input from start-(filterLength-1), zero outside the signal.
+        frame[:] = 0
+        first = start - (filterLength - 1)
+        segment = audio[max(first, 0):first+nfft]
+        frame[max(-first, 0):max(-first, 0)+len(segment)] = segment
+        frameSpectra = multiply_spectra(np.fft.rfft(frame, axis=0), filterSpectra)
+        frameOut = np.fft.irfft(frameSpectra, nfft, axis=0)[filterLength-1:]
+        numValid = min(blockSize, outLength - start)
+        audioOut[start:start+numValid] = frameOut[:numValid]
+
+    return audioOut
+
+
+def partition_layout(filterLength, blockSize, maxBlockSize = MAX_PARTITION_SIZE, partitionsPerSize = PARTITIONS_PER_SIZE):
+    # Non-uniform partitioning of filterLength taps as a list of (offset, length, partitionSize) segments.
+    # The head is partitionsPerSize partitions of blockSize taps for low latency, then the partition size 
+    # doubles every partitionsPerSize partitions up to maxBlockSize, which is used for the rest of the tail.
+    # Each segment starts at least its partition size minus blockSize taps in, so it has a whole 
+    # partition of input before its output is needed and adds no latency.
+    layout = []
+    offset = 0
+    size = blockSize
+    while offset < filterLength:
+        if size < maxBlockSize:
+            length = min(partitionsPerSize*size, filterLength - offset)
+        else:
+            length = filterLength - offset
+        layout.append((offset, length, size))
+        offset += length
+        if 2*size <= maxBlockSize:
+            size = 2*size
+
+    return layout
+
+
+def partitioned_convolve(audio, filters, blockSize = 1024, filterLength = None, method = 'auto', spectrumCache = None, 
+                         maxBlockSize = MAX_PARTITION_SIZE, partitionsPerSize = PARTITIONS_PER_SIZE):
+    # Offline convolution with the same non-uniform partitions as NonUniformConvolver, so long filters 
+    # never need one FFT the length of the whole filter. Each segment is convolved with method (see convolve()) 
+    # and added to the output at its offset.
+    # filters is a (filterLength, numFilters) array or a function filters(offset, length) returning those taps,
+    # so long filters can be generated a segment at a time rather than held in memory whole.
+    audio = add_dimension(audio)
+    if not callable(filters):
+        taps = add_dimension(filters)
+        filterLength = len(taps)
+        filters = lambda offset, length: taps[offset:offset+length]
+
+    audioOut = None
+    for offset, length, partitionSize in partition_layout(filterLength, blockSize, maxBlockSize, partitionsPerSize):
+        segmentOut = convolve(audio, filters(offset, length), method = method, spectrumCache = spectrumCache)
+        if audioOut is None:
+            audioOut = np.zeros((len(audio)+filterLength-1, segmentOut.shape[1]), dtype = segmentOut.dtype)
+        audioOut[offset:offset+len(segmentOut)] += segmentOut
+
+    return audioOut
+
+
+def dense_to_sparse(filters):
+    # (index, gain) pairs of the nonzero taps of each filter, each (M, numFilters).
+    # Filters with fewer than M nonzero taps are padded with zero gains.
+    filters = add_dimension(filters)
+    numTaps = np.count_nonzero(filters, axis=0)
+    indices = np.zeros((max(numTaps.max(), 1), filters.shape[1]), dtype=int)
+    gains = np.zeros(indices.shape, dtype = filters.dtype)
+    for n in range(filters.shape[1]):
+        nonzero = np.flatnonzero(filters[:,n])
+        indices[:len(nonzero),n] = nonzero
+        gains[:len(nonzero),n] = filters[nonzero,n]
+
+    return indices, gains
+
+
+def sparse_to_dense(indices, gains, filterLength):
+    filters = np.zeros((filterLength, indices.shape[1]))
+    np.add.at(filters, (indices, np.arange(indices.shape[1])), gains)
+
+    return filters
+
+
+def select_sparse(indices, gains):
+    # Each nonzero tap costs a pass over the signal whereas the batched FFT shares the input transform 
+    # between all the outputs, so sparse filtering is only faster for a small total number of taps.
+    sparse = np.count_nonzero(gains) <= SPARSE_MAX_TAPS
+
+    return sparse
+
+
+def select_sparse_filters(filters):
+    # True for dense filters that are cheaper to run with sparse_convolve(): mostly zero and with either
+    # a small total number of nonzero taps or a few delays shared between all the filters.
+    numTaps = np.count_nonzero(filters)
+    numDelays = np.count_nonzero(np.any(filters, axis=1))
+    sparse = numTaps <= SPARSE_MAX_DENSITY * filters.size and (numTaps <= SPARSE_MAX_TAPS or numDelays <= SPARSE_MAX_DELAYS)
+
+    return sparse
+
+
+def sparse_convolve(audio, indices, gains, filterLength, blockSize = 32768):
+    # Convolution with sparse filters given as (index, gain) pairs of their nonzero taps.
+    # Each tap is a single scaled and shifted add of the input so the cost only depends on the number of taps.
+    # The input is filtered in blocks so the accumulator stays in cache.
+    # Outputs of one input that share their delays (e.g. the cascaded Lauridsen combs) are filtered together
+    # with delay_mix_convolve() so each delay is only applied once.
+    # Output channel k is audio column k % numInChans as in convolve().
+    audio = add_dimension(audio)
+    numOuts = indices.shape[1]
+    audioOut = np.zeros((len(audio)+filterLength-1, numOuts), dtype = np.result_type(audio, gains))
+    accumulator = np.zeros(blockSize+filterLength-1, dtype = audioOut.dtype)
+    for chan in range(audio.shape[1]):
+        outs = np.arange(chan, numOuts, audio.shape[1])
+        x = np.ascontiguousarray(audio[:,chan])
+        numTaps = np.count_nonzero(gains[:,outs])
+        if numTaps > 0 and 2 * len(np.unique(indices[:,outs][gains[:,outs] != 0])) <= numTaps:
+            delay_mix_convolve(x, indices[:,outs], gains[:,outs], filterLength, out = audioOut[:,chan::audio.shape[1]])
+            continue
+        for n in outs:
+            for start in range(0, len(x), blockSize):
+                block = x[start:start+blockSize]
+                accumulator[:] = 0
+                for index, gain in zip(indices[:,n], gains[:,n]):
+                    add_tap(accumulator[index:index+len(block)], block, gain)
+                audioOut[start:start+len(block)+filterLength-1, n] += accumulator[:len(block)+filterLength-1]
+
+    return audioOut
+
+
+def delay_mix_convolve(x, indices, gains, filterLength, blockSize = 4096, out = None):
+    # Filters the single channel x with sparse filters that share a few delays.
+    # Each block of the delayed copies of x is gathered into a (numDelays, blockSize) matrix 
+    # and mixed into all the outputs with one matrix product of the tap gains.
+    # out is an optional (len(x)+filterLength-1, numFilters) array, or view, for the output. It is overwritten, not added to.
+    delays = np.unique(indices[gains != 0])
+    mix = np.zeros((len(delays), indices.shape[1]), dtype = np.result_type(x, gains))
+    # Zero gain padding taps may fall on any row.
+    np.add.at(mix, (np.searchsorted(delays, indices).clip(0, len(delays)-1), np.arange(indices.shape[1])), gains)
+    padded = np.zeros(len(x)+2*(filterLength-1), dtype = mix.dtype)
+    padded[filterLength-1:filterLength-1+len(x)] = x
+    audioOut = out
+    if audioOut is None:
+        audioOut = np.empty((len(x)+filterLength-1, indices.shape[1]), dtype = mix.dtype)
+    delayed = np.empty((len(delays), blockSize), dtype = mix.dtype)
+    for start in range(0, len(audioOut), blockSize):
+        n = min(blockSize, len(audioOut)-start)
+        # Output sample m of the tap at delay d is x[m-d], sample m-d+filterLength-1 of the padded input.
+        for row, offset in enumerate(start+filterLength-1-delays):
+            delayed[row,:n] = padded[offset:offset+n]
+        audioOut[start:start+n] = np.dot(delayed[:,:n].T, mix)
+
+    return audioOut
+
+
+def add_tap(accumulator, x, gain):
+    # In place accumulator += gain*x avoiding the multiply for the +-1 taps of velvet noise.
+    if gain == 1:
+        accumulator += x
+    elif gain == -1:
+        accumulator -= x
+    elif gain != 0:
+        accumulator += gain*x
+
+
+def downmix_gain(filters):
+    # Gain that normalises the sum of all the filter outputs to unity power gain for white noise.
+    # Used in place of the signal dependent r.m.s normalisation when streaming.
+    gain = 1/np.sqrt(np.sum(np.square(np.sum(filters, axis=1))))
+
+    return gain
+
+
+def stream_convolver(filters, blockSize, inputMap = None, method = 'auto', spectrumCache = None):
+    # Streaming convolver for filters. Sparse filters (see select_convolution_method()) use a SparseConvolver,
+    # which only keeps the input history and adds a shifted slice of it per tap, the rest a PartitionedConvolver.
+    filters = add_dimension(filters)
+    if method == 'sparse' or (method == 'auto' and select_sparse_filters(filters)):
+        indices, gains = dense_to_sparse(filters)
+        convolver = SparseConvolver(indices, gains, len(filters), blockSize, inputMap = inputMap)
+    else:
+        convolver = PartitionedConvolver(filters, blockSize, inputMap = inputMap, spectrumCache = spectrumCache)
+
+    return convolver
+
+
+class PartitionedConvolver(object):
+    # Uniformly partitioned overlap-save convolution for streaming.
+    # The filters are split into partitions of blockSize taps. Each input block is transformed once 
+    # into a frequency domain delay line and multiplied with all the partitions at once, so each block 
+    # costs one FFT, one inverse FFT per output and a fixed amount of memory whatever the filter length.
+    # The output block is the filtered input block with no latency beyond the block length.
+    # Output k is input channel inputMap[k] filtered by filters[:,k]. By default all filters share one input.
+    # spectrumCache is an optional FilterCache to reuse the spectra of the partitions.
+
+    def __init__(self, filters, blockSize, inputMap = None, spectrumCache = None):
+        filters = add_dimension(filters)
+        if inputMap is None:
+            inputMap = np.zeros(filters.shape[1], dtype=int)
+        self.inputMap = np.asarray(inputMap)
+        self.numInChans = int(self.inputMap.max()) + 1
+        self.blockSize = blockSize
+        self.filterLength = len(filters)
+        self.tailLength = self.filterLength - 1
+        self.numPartitions = int(np.ceil(self.filterLength / blockSize))
+
+        partitions = np.zeros((self.numPartitions*blockSize, filters.shape[1]))
+        partitions[:self.filterLength] = filters
+        partitions = partitions.reshape(self.numPartitions, blockSize, filters.shape[1])
+        if spectrumCache is None:
+            self.filterSpectra = np.fft.rfft(partitions, 2*blockSize, axis=1)
+        else:
+            self.filterSpectra = spectrumCache.spectra(partitions, 2*blockSize, axis=1)
+        self.reset()
+
+    def reset(self):
+        # Clear the input history.
+        self.frame = np.zeros((2*self.blockSize, self.numInChans))
+        self.inputSpectra = np.zeros((self.numPartitions, self.blockSize + 1, self.numInChans), dtype=complex)
+        self.position = 0
+
+    def process(self, block):
+        block = add_dimension(block)
+        if block.shape != (self.blockSize, self.numInChans):
+            raise ValueError('Blocks must be {b} samples by {c} channels, not {s}'.format(b = self.blockSize, c = self.numInChans, s = block.shape))
+
+        # Slide the input frame on by a block and add its spectrum to the delay line.
+        self.frame[:self.blockSize] = self.frame[self.blockSize:]
+        self.frame[self.blockSize:] = block
+        self.position = (self.position + 1) % self.numPartitions
+        self.inputSpectra[self.position] = np.fft.rfft(self.frame, axis=0)
+
+        # Partition p filters the input from p blocks ago.
+        delayLine = (self.position - np.arange(self.numPartitions)) % self.numPartitions
+        spectra = np.einsum('pbk,pbk->bk', self.inputSpectra[delayLine][:,:,self.inputMap], self.filterSpectra)
+        blockOut = np.fft.irfft(spectra, 2*self.blockSize, axis=0)[self.blockSize:]
+
+        return blockOut
+
+
+class NonUniformConvolver(object):
+    # Non-uniformly partitioned convolution for streaming long filters from a single input.
+    # The head of the filters is split into partitions of blockSize taps so the latency is only the block length,
+    # and the tail into larger partitions (see partition_layout()) which need fewer, more efficient FFTs.
+    # Each segment of equal partitions is a PartitionedConvolver run every time a whole partition of input 
+    # has arrived, and its output is added into an output buffer at the segment offset.
+    # filters is a (filterLength, numOuts) array or a function filters(offset, length) as in partitioned_convolve(). 
+    # Only the spectra are kept, so generated filters are never held whole in the time domain.
+    # The output is scaled by gain.
+
+    def __init__(self, filters, blockSize, filterLength = None, gain = 1, spectrumCache = None, 
+                 maxBlockSize = MAX_PARTITION_SIZE, partitionsPerSize = PARTITIONS_PER_SIZE):
+        if not callable(filters):
+            taps = add_dimension(filters)
+            filterLength = len(taps)
+            filters = lambda offset, length: taps[offset:offset+length]
+        self.numInChans = 1
+        self.blockSize = blockSize
+        self.filterLength = filterLength
+        self.tailLength = filterLength - 1
+        self.gain = gain
+        self.segments = []
+        for offset, length, partitionSize in partition_layout(filterLength, blockSize, maxBlockSize, partitionsPerSize):
+            self.segments.append((offset, PartitionedConvolver(filters(offset, length), partitionSize, spectrumCache = spectrumCache)))
+        self.numOuts = self.segments[0][1].filterSpectra.shape[2]
+        self.reset()
+
+    def reset(self):
+        # Clear the input history and the pending output.
+        for offset, convolver in self.segments:
+            convolver.reset()
+        self.inputBuffer = np.zeros((max(convolver.blockSize for offset, convolver in self.segments), 1))
+        self.outputBuffer = np.zeros((max(offset for offset, convolver in self.segments) + self.blockSize, self.numOuts))
+        self.numSamples = 0
+
+    def process(self, block):
+        block = add_dimension(block)
+        if block.shape != (self.blockSize, self.numInChans):
+            raise ValueError('Blocks must be {b} samples by {c} channels, not {s}'.format(b = self.blockSize, c = self.numInChans, s = block.shape))
+
+        self.inputBuffer[:-self.blockSize] = self.inputBuffer[self.blockSize:]
+        self.inputBuffer[-self.blockSize:] = block
+        self.numSamples += self.blockSize
+
+        for offset, convolver in self.segments:
+            if self.numSamples % convolver.blockSize == 0:
+                # The output of the last partition of input starts offset samples after it, 
+                # which is offset - partitionSize + blockSize samples after the start of this block.
+                start = offset - convolver.blockSize + self.blockSize
+                self.outputBuffer[start:start+convolver.blockSize] += convolver.process(self.inputBuffer[-convolver.blockSize:])
+
+        blockOut = self.outputBuffer[:self.blockSize] * self.gain
+        self.outputBuffer[:-self.blockSize] = self.outputBuffer[self.blockSize:]
+        self.outputBuffer[-self.blockSize:] = 0
+
+        return blockOut
+
+
+class SparseConvolver(object):
+    # Streaming equivalent of sparse_convolve() with the same interface as PartitionedConvolver.
+    # The input history is kept for the length of the filters and each tap adds a shifted slice of it.
+    # The taps of all the outputs are gathered and summed in a single vectorised call per block.
+
+    def __init__(self, indices, gains, filterLength, blockSize, inputMap = None):
+        if inputMap is None:
+            inputMap = np.zeros(indices.shape[1], dtype=int)
+        self.inputMap = np.asarray(inputMap)
+        self.numInChans = int(self.inputMap.max()) + 1
+        self.indices = indices
+        self.gains = gains
+        self.blockSize = blockSize
+        self.filterLength = filterLength
+        self.tailLength = filterLength - 1
+        self.reset()
+
+    def reset(self):
+        # Clear the input history.
+        self.history = np.zeros((self.tailLength + self.blockSize, self.numInChans))
+
+    def process(self, block):
+        block = add_dimension(block)
+        if block.shape != (self.blockSize, self.numInChans):
+            raise ValueError('Blocks must be {b} samples by {c} channels, not {s}'.format(b = self.blockSize, c = self.numInChans, s = block.shape))
+
+        self.history[:self.tailLength] = self.history[self.blockSize:]
+        self.history[self.tailLength:] = block
+        # View of every blockSize window of the history then gather the windows of all taps in one call.
+        stride = self.history.strides
+        windows = as_strided(self.history, (self.tailLength+1, self.numInChans, self.blockSize), (stride[0], stride[1], stride[0]))
+        taps = windows[self.tailLength-self.indices, self.inputMap]
+        blockOut = np.einsum('mkb,mk->bk', taps, self.gains)
+
+        return blockOut
+
@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 10:12:40 2026
+Filter bank cache for the decorrelation toolbox.
+
+Decorrelators generate their filters from random numbers every time they are created.
+When a decorrelator is given a seed its filters are reproducible, so they can be kept and reused
+by later decorrelators with the same settings instead of being designed again.
+
+The cache holds the filters and their FFT spectra in memory with least recently used eviction and
+can optionally save them as .npy files in a directory so they are reused by later jobs.
+
+Filters are keyed by the decorrelator, generating method, sampling frequency, method parameters,
+seed and position in the decorrelator. Spectra are keyed by the filter values and FFT size.
+
+Example Usage:
+    cache = fc.FilterCache(directory = '/folder/filter_cache')
+    decorrelator = dt.AllPass(audioIn, numOutChans = 8, seed = 1, filter_cache = cache)
+
+A decorrelation kernel is a directory holding everything needed to run one decorrelator setup without
+designing any filters: the filters and partitioned spectra as .npy files and a kernel.json file with the
+decorrelator, its arguments, fs, seed (and routing for an s3a setup). Kernels are built once with
+dt.build_kernel() or phdc.build_s3a_kernel() and loaded with Kernel(), which memory maps the files.
+
+Example Usage:
+    dt.build_kernel('/folder/allpass8', dt.AllPass, numOutChans = 8, seed = 1)
+    decorrelator = dt.from_kernel('/folder/allpass8', audioIn)
+
+"""
+
+import os
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+class FilterCache(object):
+
+    def __init__(self, maxsize = 64, directory = None, mmap_mode = None, read_only = False):
+        # Maximum number of filter sets and spectra kept in memory.
+        self.maxsize = maxsize
+        # Optional directory for .npy copies of everything cached.
+        self.directory = directory
+        # mmap_mode = 'r' memory maps the files rather than reading them. 
+        # A read only cache never adds files to the directory.
+        self.mmap_mode = mmap_mode
+        self.read_only = read_only
+        if directory is not None and not read_only:
+            os.makedirs(directory, exist_ok = True)
+        self.entries = OrderedDict()
+        self.lock = threading.RLock()
+
+    def __getstate__(self):
+        # Only the settings are copied to other processes, not the cached arrays.
+        return dict(maxsize = self.maxsize, directory = self.directory, mmap_mode = self.mmap_mode, read_only = self.read_only)
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def filters(self, key, generator):
+        # Filters for key, generated by calling generator() if they have not been cached.
+        name = 'filters_{h}'.format(h = key_hash(key))
+        return self.lookup(name, generator)
+
+    def spectra(self, filters, nfft, axis = 0):
+        # FFT spectra of filters along axis, calculated if they have not been cached.
+        name = 'spectra_{n}_{a}_{h}'.format(n = nfft, a = axis, h = array_hash(filters))
+        return self.lookup(name, lambda: np.fft.rfft(filters, nfft, axis = axis))
+
+    def lookup(self, name, generator):
+        with self.lock:
+            if name in self.entries:
+                self.entries.move_to_end(name)
+                return self.entries[name]
+
+        value = self.load(name)
+        if value is None:
+            value = generator()
+            self.save(name, value)
+
+        # Cached values are shared so must not be modified.
+        for array in as_tuple(value):
+            array.setflags(write = False)
+
+        with self.lock:
+            self.entries[name] = value
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last = False)
+
+        return value
+
+    def load(self, name):
+        # A file that can't be read (e.g. being replaced by another process) is treated as not cached.
+        if self.directory is None:
+            return None
+        filename = os.path.join(self.directory, name)
+        try:
+            if os.path.exists(filename + '.npy'):
+                return np.load(filename + '.npy', mmap_mode = self.mmap_mode)
+            # Generators returning several arrays are saved as one file per array.
+            arrays = []
+            while os.path.exists('{f}.{n}.npy'.format(f = filename, n = len(arrays))):
+                arrays.append(np.load('{f}.{n}.npy'.format(f = filename, n = len(arrays)), mmap_mode = self.mmap_mode))
+        except (OSError, ValueError, EOFError):
+            return None
+        if len(arrays) > 0:
+            return tuple(arrays)
+        return None
+
+    def save(self, name, value):
+        # Each file is written to a temporary file in the directory and renamed into place, so other processes 
+        # sharing the directory never see a partly written file. The arrays of a tuple are saved in reverse order 
+        # so the first file, which load() looks for, only appears once the others are complete.
+        if self.directory is None or self.read_only:
+            return
+        filename = os.path.join(self.directory, name)
+        if isinstance(value, tuple):
+            for n in reversed(range(len(value))):
+                save_array('{f}.{n}.npy'.format(f = filename, n = n), value[n])
+        else:
+            save_array(filename + '.npy', value)
+
+    def clear(self):
+        # Empty the in memory cache. Files on disk are kept.
+        self.entries.clear()
+
+
+class Kernel(object):
+    # A decorrelation kernel loaded from directory. settings are the contents of kernel.json and cache 
+    # is a read only FilterCache of the memory mapped filters and spectra. 
+    # Filters that are not in the kernel (e.g. for a different number of outputs) are designed as usual but not saved.
+
+    def __init__(self, directory, maxsize = 64):
+        with open(os.path.join(directory, KERNEL_FILE)) as f:
+            self.settings = json.load(f)
+        if self.settings.get('format') != KERNEL_FORMAT or self.settings.get('version', 0) > KERNEL_VERSION:
+            raise ValueError('{d} is not a version {v} decorrelation kernel'.format(d = directory, v = KERNEL_VERSION))
+        self.directory = directory
+        self.seed = self.settings['seed']
+        self.fs = self.settings['fs']
+        self.cache = FilterCache(maxsize = maxsize, directory = directory, mmap_mode = 'r', read_only = True)
+
+
+def write_kernel(directory, settings):
+    # Writes kernel.json with the settings of the kernel and the list of its files.
+    files = sorted(name for name in os.listdir(directory) if name.endswith('.npy'))
+    settings = dict(format = KERNEL_FORMAT, version = KERNEL_VERSION, **settings, files = files)
+    with open(os.path.join(directory, KERNEL_FILE), 'w') as f:
+        json.dump(settings, f, indent = 1)
+
+
+def save_array(filename, array):
+    # Atomic np.save: written to a temporary file, unique to the process and thread, then renamed to filename.
+    temporary = '{f}.{p}.{t}.tmp'.format(f = filename, p = os.getpid(), t = threading.get_ident())
+    try:
+        with open(temporary, 'wb') as f:
+            np.save(f, array)
+        os.replace(temporary, filename)
+    except BaseException:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+        raise
+
+
+def as_tuple(value):
+    if isinstance(value, tuple):
+        return value
+    return (value,)
+
+
+def key_hash(key):
+    return hashlib.sha1(repr(key).encode()).hexdigest()
+
+
+def array_hash(array):
+    array = np.ascontiguousarray(array)
+    digest = hashlib.sha1(array.tobytes())
+    digest.update(repr((array.shape, array.dtype.str)).encode())
+    return digest.hexdigest()
+
+
+KERNEL_FILE = 'kernel.json'
+KERNEL_FORMAT = 's3a_decorrelation_kernel'
+KERNEL_VERSION = 1
+
+# Cache shared by all decorrelators that are not given their own.
+default_cache = FilterCache()
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Tue Oct 20 14:52:17 2026
+Opt in timing of the stages of a render.
+
+The separation, decorrelators and file reading/writing mark their stages (stft, hpss, istft, onset_detect,
+filter_design, convolution, write_output...) with stage(). Nothing is recorded unless a profile is active,
+in which case stage() only returns a shared do nothing context, so the stages cost close to nothing normally.
+Within profile() each stage records its duration, the number of samples it processed and, with memory = True,
+the peak bytes allocated (from tracemalloc, which slows python code down). Records are kept in the report
+and passed to an optional callback as each stage finishes. They are also logged at DEBUG level.
+
+Stages run in worker processes (executor = ProcessPoolExecutor) are not recorded. Threads are, but
+their allocations can't be told apart so memory is best profiled without an executor.
+
+Example Usage:
+    with instrumentation.profile(memory = True) as report:
+        s3a.s3a_decorrelator('/folder/input_file.wav', '/folder/output_file.wav', preset = 'upmix')
+    print(report.format())
+
+"""
+
+import contextlib
+import logging
+import threading
+import time
+import tracemalloc
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# The active profile, None when disabled.
+activeProfile = None
+
+NULL_STAGE = contextlib.nullcontext()
+
+
+def stage(name, samples = 0):
+    # Context manager timing the code in its block as stage name, e.g. with stage('stft', len(audio)): ...
+    # samples is the number of samples processed, counted over all channels.
+    if activeProfile is None:
+        return NULL_STAGE
+    return activeProfile.stage(name, samples)
+
+
+@contextlib.contextmanager
+def profile(callback = None, memory = False):
+    # Records the stages run in its block and yields the Report.
+    # callback(record) is called as each stage finishes. memory = True also records the bytes allocated.
+    global activeProfile
+    if activeProfile is not None:
+        raise ValueError('A profile is already running')
+    report = Report(callback = callback, memory = memory)
+    startedTracing = memory and not tracemalloc.is_tracing()
+    if startedTracing:
+        tracemalloc.start()
+    activeProfile = report
+    try:
+        yield report
+    finally:
+        activeProfile = None
+        if startedTracing:
+            tracemalloc.stop()
+
+
+class Report(object):
+    # The stages recorded by a profile. Each record is a dictionary of the stage name, its parent stage,
+    # the thread it ran in, seconds, samples and bytes (peak allocated above the start, None without memory).
+
+    def __init__(self, callback = None, memory = False):
+        self.callback = callback
+        self.memory = memory
+        self.records = []
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    @contextlib.contextmanager
+    def stage(self, name, samples = 0):
+        stack = self.local.__dict__.setdefault('stack', [])
+        frame = {'stage': name, 'parent': stack[-1]['stage'] if stack else None}
+        if self.memory:
+            frame['start'] = frame['peak'] = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+        stack.append(frame)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            stack.pop()
+            allocated = None
+            if self.memory:
+                # Each stage keeps the peak of its children, as they reset the tracemalloc peak.
+                peak = max(frame['peak'], tracemalloc.get_traced_memory()[1])
+                allocated = peak - frame['start']
+                if stack:
+                    stack[-1]['peak'] = max(stack[-1]['peak'], peak)
+                tracemalloc.reset_peak()
+            self.add({'stage': name, 'parent': frame['parent'], 'thread': threading.current_thread().name,
+                      'seconds': seconds, 'samples': samples, 'bytes': allocated})
+
+    def add(self, record):
+        with self.lock:
+            self.records.append(record)
+        logger.debug('%(stage)s: %(seconds).6f s, %(samples)d samples, %(bytes)s bytes', record)
+        if self.callback is not None:
+            self.callback(record)
+
+    def summary(self):
+        # Totals for each stage: number of calls, seconds, samples and the largest bytes allocated.
+        totals = OrderedDict()
+        for record in self.records:
+            total = totals.setdefault(record['stage'], {'calls': 0, 'seconds': 0.0, 'samples': 0, 'bytes': None})
+            total['calls'] += 1
+            total['seconds'] += record['seconds']
+            total['samples'] += record['samples']
+            if record['bytes'] is not None:
+                total['bytes'] = max(total['bytes'] or 0, record['bytes'])
+
+        return totals
+
+    def format(self):
+        # The summary as a table. Nested stages are included in the times of the stages they run in.
+        lines = ['{s:32s} {c:>6s} {t:>10s} {n:>12s} {m:>10s}'.format(s = 'stage', c = 'calls', t = 'seconds', n = 'samples', m = 'MB')]
+        for name, total in self.summary().items():
+            lines.append('{s:32s} {calls:6d} {seconds:10.4f} {samples:12d} {m:>10s}'.format(
+                         s = name, m = '' if total['bytes'] is None else '{b:.1f}'.format(b = total['bytes']/2**20), **total))
+
+        return '\n'.join(lines)
@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Oct 19 09:20:44 2026
+Memory mapped audio for files larger than RAM.
+
+Inputs can be .npy files, raw interleaved sample files or WAV/RF64 files with 16 or 32 bit integer
+or 32/64 bit float samples, which are mapped rather than read. 24 bit WAV/RF64 files can't be mapped
+as numpy arrays, so they are converted a block at a time to a temporary 32 bit integer file. Working buffers (the separated
+components and the decorrelator outputs) are kept in temporary memory mapped files in column
+(channel) major order so each channel is contiguous on disk, and the output is written to a
+memory mapped WAV/RF64 file. Conversions between layouts are done in blocks of frames so the
+file access is sequential and only a block at a time is held in memory.
+
+"""
+
+import os
+import struct
+import tempfile
+
+import numpy as np
+
+
+# Default number of frames copied at a time.
+BLOCK_FRAMES = 2**16
+
+# (format, bits per sample) of the WAV sample formats that can be memory mapped.
+WAV_DTYPES = {(1, 16): '<i2', (1, 32): '<i4', (3, 32): '<f4', (3, 64): '<f8'}
+# 24 bit integer samples, which are converted to 32 bit when they are opened.
+PCM_24 = (1, 24)
+# soundfile subtype of each.
+WAV_SUBTYPES = {'PCM_16': (1, 16), 'PCM_32': (1, 32), 'FLOAT': (3, 32), 'DOUBLE': (3, 64)}
+
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+# Tail of the KSDATAFORMAT_SUBTYPE GUIDs, after the format code.
+GUID_TAIL = b'\x00\x00\x00\x00\x10\x00\x80\x00\x00\xaa\x00\x38\x9b\x71'
+
+
+def open_input(filename, channels = None, dtype = 'float32', offset = 0, directory = None):
+    # Memory maps an input file. Returns (audio, fs), fs is None for .npy and raw files.
+    # Raw files are interleaved samples of the given dtype starting offset bytes into the file.
+    # 24 bit WAV files are converted to a temporary file in directory, see wav_memmap().
+    extension = os.path.splitext(filename)[1].lower()
+    if extension == '.npy':
+        audio = np.load(filename, mmap_mode = 'r')
+        fs = None
+    elif extension in ('.wav', '.rf64'):
+        audio, fs = wav_memmap(filename, directory = directory)
+    else:
+        if channels is None:
+            raise ValueError('The number of channels of the raw file {f} must be given'.format(f = filename))
+        audio = np.memmap(filename, dtype = dtype, mode = 'r', offset = offset)
+        audio = audio[:len(audio) - len(audio) % channels].reshape(-1, channels)
+        fs = None
+
+    if audio.ndim == 1:
+        audio = audio.reshape(-1, 1)
+
+    return audio, fs
+
+
+def temp_memmap(shape, dtype = np.float64, directory = None):
+    # Zeroed array in a temporary file in directory (the system temporary folder by default).
+    # The array is column major so each channel is contiguous. The file is deleted when the array is.
+    return np.memmap(tempfile.TemporaryFile(dir = directory), dtype = dtype, mode = 'w+', shape = shape, order = 'F')
+
+
+def channel_major(audio, dtype = np.float64, directory = None, blockFrames = BLOCK_FRAMES):
+    # Copies interleaved audio (e.g. a mapped file) to a column major temporary memmap in blocks of frames.
+    # Integer samples are scaled to +-1 as soundfile does.
+    output = temp_memmap(audio.shape, dtype = dtype, directory = directory)
+    copy_blocks(audio, output, blockFrames = blockFrames)
+
+    return output
+
+
+def copy_blocks(source, destination, blockFrames = BLOCK_FRAMES):
+    # destination[:] = source a block of frames at a time, converting between integer and float samples.
+    # Integer samples are scaled by the ratio of the full scale values, so +-1 as floats is full scale.
+    # Samples are clipped to the range of an integer destination.
+    scale = 1.0
+    if np.issubdtype(source.dtype, np.integer):
+        scale /= 2**(8*source.dtype.itemsize - 1)
+    if np.issubdtype(destination.dtype, np.integer):
+        scale *= 2**(8*destination.dtype.itemsize - 1)
+        limits = np.iinfo(destination.dtype)
+
+    for start in range(0, len(destination), blockFrames):
+        block = source[start:start + blockFrames]
+        if np.issubdtype(destination.dtype, np.integer):
+            block = np.clip(np.round(block * scale), limits.min, limits.max)
+        elif scale != 1.0:
+            block = block * scale
+        destination[start:start + blockFrames] = block
+
+
+def wav_memmap(filename, mode = 'r', directory = None):
+    # Memory maps the samples of a WAV or RF64 file as a (frames, channels) array. Returns (audio, fs).
+    # 24 bit samples are read a block at a time into a temporary memmap of 32 bit integers in directory
+    # (see temp_memmap()), so those can only be read.
+    with open(filename, 'rb') as f:
+        riff, riffSize, wave = struct.unpack('<4sI4s', f.read(12))
+        if riff not in (b'RIFF', b'RF64') or wave != b'WAVE':
+            raise ValueError('{f} is not a WAV or RF64 file'.format(f = filename))
+        dataSize64 = None
+        fmt = None
+        while True:
+            header = f.read(8)
+            if len(header) < 8:
+                raise ValueError('No data chunk in {f}'.format(f = filename))
+            chunk, size = struct.unpack('<4sI', header)
+            if chunk == b'ds64':
+                riffSize64, dataSize64 = struct.unpack('<QQ', f.read(16))
+                f.seek(size - 16, 1)
+            elif chunk == b'fmt ':
+                fmt = f.read(size)
+            elif chunk == b'data':
+                offset = f.tell()
+                if size == 0xFFFFFFFF and dataSize64 is not None:
+                    size = dataSize64
+                break
+            else:
+                f.seek(size, 1)
+            # Chunks are word aligned.
+            if size % 2 == 1:
+                f.seek(1, 1)
+
+    formatTag, channels, fs, byteRate, blockAlign, bits = struct.unpack('<HHIIHH', fmt[:16])
+    if formatTag == WAVE_FORMAT_EXTENSIBLE:
+        formatTag = struct.unpack('<H', fmt[24:26])[0]
+    if (formatTag, bits) not in WAV_DTYPES and not ((formatTag, bits) == PCM_24 and mode == 'r'):
+        raise ValueError('{f} has {b} bit samples of format {t} which cannot be memory mapped, use soundfile instead'.format(f = filename, b = bits, t = formatTag))
+
+    # The data size may be unset in files that were not closed properly.
+    size = min(size, os.path.getsize(filename) - offset)
+    if (formatTag, bits) == PCM_24:
+        samples = np.memmap(filename, dtype = np.uint8, mode = 'r', offset = offset, shape = (size // blockAlign, channels, 3))
+        return pcm24_to_int32(samples, directory), fs
+    audio = np.memmap(filename, dtype = WAV_DTYPES[(formatTag, bits)], mode = mode, offset = offset, shape = (size // blockAlign, channels))
+
+    return audio, fs
+
+
+def pcm24_to_int32(samples, directory = None, blockFrames = BLOCK_FRAMES):
+    # Converts (frames, channels, 3) little endian 24 bit samples to a temporary memmap of 32 bit integers 
+    # a block of frames at a time. The samples are the top 3 bytes so full scale is the same.
+    audio = temp_memmap(samples.shape[:2], dtype = np.int32, directory = directory)
+    for start in range(0, len(audio), blockFrames):
+        block = samples[start:start + blockFrames].astype(np.uint32)
+        audio[start:start + blockFrames] = (block[...,0] << 8 | block[...,1] << 16 | block[...,2] << 24).view(np.int32)
+
+    return audio
+
+
+def create_wav_memmap(filename, frames, channels, fs, subtype = 'FLOAT'):
+    # Creates a WAV file (RF64 if larger than 4GB) for frames x channels samples of subtype
+    # ('PCM_16', 'PCM_32', 'FLOAT' or 'DOUBLE') and returns its samples memory mapped for writing.
+    if subtype not in WAV_SUBTYPES:
+        raise ValueError('subtype must be one of {s} to memory map the output, not {t}'.format(s = tuple(WAV_SUBTYPES), t = subtype))
+    formatTag, bits = WAV_SUBTYPES[subtype]
+    blockAlign = channels * bits // 8
+    dataSize = frames * blockAlign
+
+    fmt = struct.pack('<HHIIHHHHI', WAVE_FORMAT_EXTENSIBLE, channels, fs, fs * blockAlign, blockAlign, bits, 22, bits, 0)
+    fmt += struct.pack('<H', formatTag) + GUID_TAIL
+    headerSize = 12 + 36 + 8 + len(fmt) + 8
+    rf64 = headerSize + dataSize > 0xFFFFFFFF
+
+    with open(filename, 'wb') as f:
+        if rf64:
+            f.write(struct.pack('<4sI4s', b'RF64', 0xFFFFFFFF, b'WAVE'))
+            f.write(struct.pack('<4sIQQQI', b'ds64', 28, headerSize - 8 + dataSize, dataSize, frames, 0))
+        else:
+            # A JUNK chunk the size of ds64 keeps the header the same size either way.
+            f.write(struct.pack('<4sI4s', b'RIFF', headerSize - 8 + dataSize, b'WAVE'))
+            f.write(struct.pack('<4sI', b'JUNK', 28) + bytes(28))
+        f.write(struct.pack('<4sI', b'fmt ', len(fmt)) + fmt)
+        f.write(struct.pack('<4sI', b'data', 0xFFFFFFFF if rf64 else dataSize))
+        f.truncate(headerSize + dataSize)
+
+    audio, fs = wav_memmap(filename, mode = 'r+')
+
+    return audio
+
+
+def write_wav(filename, audio, fs, subtype = 'FLOAT', blockFrames = BLOCK_FRAMES):
+    # Writes audio (e.g. a column major memmap) to a memory mapped WAV/RF64 file in sequential blocks of frames.
+    output = create_wav_memmap(filename, len(audio), audio.shape[1], fs, subtype = subtype)
+    copy_blocks(audio, output, blockFrames = blockFrames)
+    output.flush()
+
+    return output
+
+
+def mean_square(audio, blockFrames = BLOCK_FRAMES):
+    # np.mean(np.square(audio)) a block of frames at a time, so memmaps are not loaded whole.
+    total = 0.0
+    for start in range(0, len(audio), blockFrames):
+        block = audio[start:start + blockFrames]
+        total += np.sum(np.square(block, dtype = np.float64))
+
+    return total / max(audio.size, 1)
@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 11:02:18 2026
+Tools for running independent parts of the decorrelation in parallel.
+
+Decorrelator modules (one per input channel), the separation of each channel and the transient,
+harmonic and noise decorrelators are all independent so can be spread across cores.
+
+The executor argument accepted by the decorrelators, separate_audio and s3a_audio_decorrelator can be:
+
+None: run serially (default).
+'threads': a thread pool. Best for the numpy/FFT filtering which releases the GIL.
+'processes': a process pool. Best for the librosa separation and onset detection.
+'auto': threads or processes depending on what is being run.
+Any concurrent.futures.Executor, e.g. to share one pool between calls.
+
+numWorkers sets the number of workers of the pools that are created (default is the number of cores).
+Random numbers are drawn from per task seeds so parallel results do not depend on scheduling.
+
+"""
+
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+import numpy as np
+
+
+def parallel_map(function, argsList, executor = None, numWorkers = None, prefer = 'threads'):
+    # Returns [function(*args) for args in argsList], running the calls on the executor.
+    # prefer is the kind of pool to use when executor is 'auto'.
+    if executor is None or len(argsList) < 2:
+        return [function(*args) for args in argsList]
+
+    if executor == 'auto':
+        executor = prefer
+
+    if executor == 'threads':
+        with ThreadPoolExecutor(numWorkers) as pool:
+            results = list(pool.map(function, *zip(*argsList)))
+    elif executor == 'processes':
+        with ProcessPoolExecutor(numWorkers) as pool:
+            results = list(pool.map(function, *zip(*argsList)))
+    elif isinstance(executor, str):
+        raise ValueError("executor must be None, 'threads', 'processes', 'auto' or an Executor, not {e}".format(e = executor))
+    else:
+        results = list(executor.map(function, *zip(*argsList)))
+
+    return results
+
+
+def task_seeds(seed, numTasks):
+    # Independent integer seeds for numTasks tasks derived from seed.
+    # Without a seed they are drawn from the global numpy random state, so numpy.random.seed() still applies.
+    if seed is None:
+        seed = np.random.randint(2**31)
+    seeds = [int(s.generate_state(1)[0]) for s in np.random.SeedSequence(seed).spawn(numTasks)]
+
+    return seeds
@@ -16,39 +16,270 @@ components and then to process these separately using decorrelators in the decor
 
 from __future__ import print_function
 
+import os
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
+from numpy.lib.stride_tricks import as_strided
+import scipy.ndimage
+import scipy.signal
 
 import librosa
 import librosa.display
 from . import decorr_toolbox as dt
+from . import filter_cache as fc
+from . import instrumentation
+from . import memmap_io
+from . import parallel
+
+# numba is installed with librosa. Without it the fast hpss backend uses scipy's median filter.
+try:
+    import numba
+except ImportError:
+    numba = None
+
+HPSS_BACKENDS = ('librosa', 'fast')
+
+# Domain the harmonic and noise components are decorrelated in by s3a_audio_decorrelator.
+DECORRELATION_DOMAINS = ('time', 'stft')
 
 
 def separate_mono_audio(audio, 
                       fftTrans = 1024, 
                       fftHarm = 2048, 
                       marginTrans = 2.14, 
-                      marginHarm = 3.0):
+                      marginHarm = 3.0,
+                      mode = 'reference',
+                      hpss_backend = 'fast',
+                      numThreads = None,
+                      onsets = False,
+                      fs = 48000,
+                      spectrograms = False):
     
     #Separates mono audio file into transients harmonic and noise components. based on given settings.
+    # mode = 'fast' uses separate_mono_audio_fast() instead.
+    # hpss_backend and numThreads select how the median filtering is done, see hpss(). 
+    # hpss_backend = 'librosa' gives the exact reference output.
+    # onsets = True also returns the sample positions of the transients found from the transient spectrogram 
+    # as 'Onsets' (see transient_onsets), which TransientPanner can use instead of detecting them again.
+    # spectrograms = True returns the harmonic and noise STFTs (size fftHarm) as 'HarmonicSpectrogram' and 
+    # 'NoiseSpectrogram' in place of their signals, for STFT domain decorrelation (see decorrelate_spectrograms).
+    hpssArguments = dict(backend = hpss_backend, numThreads = numThreads)
+    if mode == 'fast':
+        return separate_mono_audio_fast(audio, fftTrans = fftTrans, fftHarm = fftHarm, marginTrans = marginTrans, marginHarm = marginHarm, 
+                                        onsets = onsets, fs = fs, spectrograms = spectrograms, **hpssArguments)
+    elif mode != 'reference':
+        raise ValueError("separation mode must be 'reference' or 'fast', not {m}".format(m = mode))
     
-    D_stage1 = librosa.stft(audio,n_fft=fftTrans)
-    D_harmonic1, D_transient = librosa.decompose.hpss(D_stage1, 
-                                                      margin=(1.0, marginTrans))
-    Transients = librosa.istft(D_transient)
+    length = len(audio)
+    with instrumentation.stage('stft', length):
+        D_stage1 = librosa.stft(audio,n_fft=fftTrans)
+    with instrumentation.stage('hpss', length):
+        D_harmonic1, D_transient = hpss(D_stage1, 
+                                        margin=(1.0, marginTrans), **hpssArguments)
+    with instrumentation.stage('istft', length):
+        Transients = librosa.istft(D_transient)
     #TODO simplify using the transient and harmonic component extraction from librosa rather than the hpss which does both and isnt needed. Find out how to select the fft length
     
     D_residual1 = D_stage1 - D_transient #Residual 1 is everything except the Transients
-    Residual1 = librosa.istft(D_residual1)
+    with instrumentation.stage('istft', length):
+        Residual1 = librosa.istft(D_residual1)
   
-    D_2 = librosa.stft(Residual1,n_fft=fftHarm)
-    D_harmonic2, D_percussive2 = librosa.decompose.hpss(D_2, 
-                                                        margin=(marginHarm, 1.0))
+    with instrumentation.stage('stft', length):
+        D_2 = librosa.stft(Residual1,n_fft=fftHarm)
+    with instrumentation.stage('hpss', length):
+        D_harmonic2, D_percussive2 = hpss(D_2, 
+                                          margin=(marginHarm, 1.0), **hpssArguments)
     D_Noise = D_2 - D_harmonic2
     
-    Harmonic = librosa.istft(D_harmonic2)
-    Noise = librosa.istft(D_Noise)    
+    if spectrograms:
+        components = {'Transients':Transients, 'HarmonicSpectrogram':D_harmonic2, 'NoiseSpectrogram':D_Noise}
+    else:
+        with instrumentation.stage('istft', 2*length):
+            Harmonic = librosa.istft(D_harmonic2)
+            Noise = librosa.istft(D_Noise)    
+    
+        components = {'Transients':Transients, 'Harmonic':Harmonic ,'Noise':Noise }
+    if onsets:
+        components['Onsets'] = transient_onsets(D_transient, fs, fftTrans)
+
+    return components
+
+
+def separate_mono_audio_fast(audio, 
+                             fftTrans = 1024, 
+                             fftHarm = 2048, 
+                             marginTrans = 2.14, 
+                             marginHarm = 3.0,
+                             backend = 'fast',
+                             numThreads = None,
+                             onsets = False,
+                             fs = 48000,
+                             spectrograms = False):
     
-    return {'Transients':Transients, 'Harmonic':Harmonic ,'Noise':Noise }
+    # Faster version of separate_mono_audio() with fewer FFTs.
+    # Only the masks are taken from hpss, which saves computing the phase and the unused component of each stage.
+    # The residual and the noise are found by subtracting in the time domain rather than by another istft, 
+    # and when both stages use the same FFT size the masked spectrogram is reused rather than taking a second stft.
+    # All components are the same length as the input and Transients + Harmonic + Noise = audio.
+    # The result is close to but not exactly the same as separate_mono_audio().
+    length = len(audio)
+
+    with instrumentation.stage('stft', length):
+        D_stage1 = librosa.stft(audio, n_fft = fftTrans)
+    with instrumentation.stage('hpss', length):
+        maskHarm1, maskTrans = hpss_masks(np.abs(D_stage1), margin = (1.0, marginTrans), backend = backend, numThreads = numThreads)
+    D_transient = D_stage1 * maskTrans
+    with instrumentation.stage('istft', length):
+        Transients = librosa.istft(D_transient, n_fft = fftTrans, length = length)
+
+    Residual1 = audio - Transients #Residual 1 is everything except the Transients
+    if fftHarm == fftTrans:
+        D_2 = D_stage1 - D_transient
+    else:
+        with instrumentation.stage('stft', length):
+            D_2 = librosa.stft(Residual1, n_fft = fftHarm)
+    with instrumentation.stage('hpss', length):
+        maskHarm2, maskPerc2 = hpss_masks(np.abs(D_2), margin = (marginHarm, 1.0), backend = backend, numThreads = numThreads)
+
+    if spectrograms:
+        D_harmonic2 = D_2 * maskHarm2
+        components = {'Transients':Transients, 'HarmonicSpectrogram':D_harmonic2, 'NoiseSpectrogram':D_2 - D_harmonic2}
+    else:
+        with instrumentation.stage('istft', length):
+            Harmonic = librosa.istft(D_2 * maskHarm2, n_fft = fftHarm, length = length)
+        Noise = Residual1 - Harmonic
+
+        components = {'Transients':Transients, 'Harmonic':Harmonic ,'Noise':Noise }
+    if onsets:
+        components['Onsets'] = transient_onsets(D_transient, fs, fftTrans)
+
+    return components
+
+
+def transient_onsets(D_transient, fs = 48000, nfft = 1024):
+    # Sample positions of the onsets in the transient spectrogram D_transient (an stft of size nfft).
+    # An approximation of librosa.onset.onset_detect(backtrack = True) on the transients: the same peak picking
+    # and backtracking, but the onset strength is taken from a mel projection of D_transient on its own frame grid
+    # (hop nfft//4, 256 samples by default) rather than from a new spectrogram with librosa's defaults (n_fft 2048,
+    # hop 512). The onsets are not the same. They are typically within a couple of librosa frames (about 1024 samples)
+    # of librosa's, and the finer grid can report extra weak onsets.
+    hop = nfft//4
+    with instrumentation.stage('onset_detect', D_transient.shape[1]*hop):
+        melSpectrogram = librosa.feature.melspectrogram(S = np.abs(D_transient)**2, sr = fs, n_fft = nfft)
+        envelope = librosa.onset.onset_strength(S = librosa.power_to_db(melSpectrogram), sr = fs)
+        onset_frames = librosa.onset.onset_detect(onset_envelope = envelope, sr = fs, hop_length = hop, backtrack = True)
+
+    return librosa.frames_to_samples(onset_frames, hop_length = hop)
+
+
+def hpss(D, margin = 1.0, kernel_size = 31, backend = 'fast', numThreads = None):
+    # Harmonic percussive source separation of the spectrogram D, as librosa.decompose.hpss().
+    # backend = 'librosa' uses librosa.decompose.hpss. 
+    # backend = 'fast' computes the same median filters with running medians on float32 magnitudes, 
+    # split across numThreads threads (default 1), so the masks match to float32 precision.
+    if backend == 'librosa':
+        return librosa.decompose.hpss(D, margin = margin, kernel_size = kernel_size)
+
+    maskHarm, maskPerc = hpss_masks(np.abs(D), margin = margin, kernel_size = kernel_size, backend = backend, numThreads = numThreads)
+
+    return D * maskHarm, D * maskPerc
+
+
+def hpss_masks(S, margin = 1.0, kernel_size = 31, backend = 'fast', numThreads = None):
+    # Harmonic and percussive soft masks of the magnitude spectrogram S (frequency x frames).
+    if backend == 'librosa':
+        return librosa.decompose.hpss(S, margin = margin, kernel_size = kernel_size, mask = True)
+    elif backend != 'fast':
+        raise ValueError('hpss backend must be one of {b}, not {s}'.format(b = HPSS_BACKENDS, s = backend))
+
+    if np.isscalar(margin):
+        marginHarm = marginPerc = margin
+    else:
+        marginHarm, marginPerc = margin
+    if np.isscalar(kernel_size):
+        winHarm = winPerc = kernel_size
+    else:
+        winHarm, winPerc = kernel_size
+
+    S = S.astype(np.float32)
+    harm = median_filter(S, winHarm, axis = -1, numThreads = numThreads)
+    perc = median_filter(S, winPerc, axis = -2, numThreads = numThreads)
+
+    # Soft masks as librosa.decompose.hpss
+    split_zeros = marginHarm == 1 and marginPerc == 1
+    maskHarm = librosa.util.softmask(harm, perc * marginHarm, power = 2.0, split_zeros = split_zeros)
+    maskPerc = librosa.util.softmask(perc, harm * marginPerc, power = 2.0, split_zeros = split_zeros)
+
+    return maskHarm, maskPerc
+
+
+def median_filter(S, kernel_size, axis = -1, numThreads = None):
+    # Median filter of length kernel_size along one axis of the 2D array S with reflected edges.
+    # Same as scipy.ndimage.median_filter(mode = 'reflect') with a 1D kernel along axis.
+    # The rows are filtered independently so are split across numThreads threads.
+    if axis in (0, -2):
+        return median_filter(S.T, kernel_size, axis = -1, numThreads = numThreads).T
+
+    S = np.ascontiguousarray(S)
+    filtered = np.empty_like(S)
+    def filterRows(rows):
+        if numba is None:
+            filtered[rows] = scipy.ndimage.median_filter(S[rows], size = (1, kernel_size), mode = 'reflect')
+        else:
+            running_median(S[rows], kernel_size, filtered[rows])
+
+    if numThreads is None or numThreads < 2:
+        filterRows(slice(None))
+    else:
+        bounds = np.linspace(0, len(S), numThreads + 1).astype(int)
+        with ThreadPoolExecutor(numThreads) as pool:
+            list(pool.map(filterRows, [slice(start, stop) for start, stop in zip(bounds[:-1], bounds[1:])]))
+
+    return filtered
+
+
+if numba is not None:
+    @numba.njit(nogil = True, cache = True)
+    def running_median(x, k, out):
+        # Running median of length k along each row of x, written to out.
+        # A sorted copy of the window is kept and updated by moving the outgoing sample 
+        # to the position of the incoming one, so each step costs at most k moves rather than a sort.
+        n = x.shape[1]
+        lo = k//2
+        window = np.empty(k, x.dtype)
+        for r in range(x.shape[0]):
+            row = x[r]
+            for j in range(k):
+                idx = (j - lo) % (2*n)
+                if idx >= n:
+                    idx = 2*n - 1 - idx
+                window[j] = row[idx]
+            window.sort()
+            out[r, 0] = window[lo]
+            for i in range(1, n):
+                # Outgoing and incoming samples, reflected at the edges.
+                idx = (i - 1 - lo) % (2*n)
+                if idx >= n:
+                    idx = 2*n - 1 - idx
+                old = row[idx]
+                idx = (i + k - 1 - lo) % (2*n)
+                if idx >= n:
+                    idx = 2*n - 1 - idx
+                new = row[idx]
+
+                p = np.searchsorted(window, old)
+                if new > old:
+                    while p < k - 1 and window[p + 1] < new:
+                        window[p] = window[p + 1]
+                        p += 1
+                else:
+                    while p > 0 and window[p - 1] > new:
+                        window[p] = window[p - 1]
+                        p -= 1
+                window[p] = new
+                out[r, i] = window[lo]
+
 
 def mono_audio(audio):    
     AudioOut = np.sum(audio, axis = 1)
@@ -58,28 +289,90 @@ def separate_audio (audio,
                    fftTrans = 1024, 
                    fftHarm = 2048, 
                    marginTrans = 2.14, 
-                   marginHarm = 3.0):
+                   marginHarm = 3.0,
+                   executor = None,
+                   numWorkers = None,
+                   mode = 'reference',
+                   hpss_backend = 'fast',
+                   numThreads = None,
+                   out = None,
+                   onsets = False,
+                   fs = 48000,
+                   spectrograms = False):
     
     #Separates audio file into separate components. 
+    # The channels are independent so can be separated in parallel (see parallel.py).
+    # mode is 'reference' or 'fast' (see separate_mono_audio_fast). hpss_backend and numThreads see hpss().
+    # out is an optional dictionary of arrays the same shape as the audio to write the components into, 
+    # e.g. temporary memmaps (see memmap_io.py). Run serially, only one channel is held in memory at a time.
+    # onsets = True adds 'Onsets', a list of the onset sample positions of each channel (see separate_mono_audio).
+    # spectrograms = True gives lists of the STFTs of each channel as 'HarmonicSpectrogram' and 'NoiseSpectrogram'
+    # rather than the 'Harmonic' and 'Noise' signals.
     multiAudio = dt.add_dimension(audio)
     numChans = multiAudio.shape[1]
-    Transients = np.zeros_like(multiAudio)
-    Harmonic = np.zeros_like(multiAudio)
-    Noise = np.zeros_like(multiAudio)
-    for i in range(numChans):
-        ComponentAudio = separate_mono_audio(multiAudio[:,i],
-                                             fftTrans = fftTrans, 
-                                             fftHarm = fftHarm, 
-                                             marginTrans = marginTrans, 
-                                             marginHarm = marginHarm)
-        
-        Transients[:ComponentAudio['Transients'].size,i] = ComponentAudio['Transients']
-        Harmonic[:ComponentAudio['Harmonic'].size,i] = ComponentAudio['Harmonic']
-        Noise[:ComponentAudio['Noise'].size,i] = ComponentAudio['Noise']
+    if out is None:
+        names = ('Transients',) if spectrograms else ('Transients', 'Harmonic', 'Noise')
+        out = {name: np.zeros_like(multiAudio) for name in names}
+    arguments = [(multiAudio[:,i], fftTrans, fftHarm, marginTrans, marginHarm, mode, hpss_backend, numThreads, onsets, fs, spectrograms) for i in range(numChans)]
+    # Components kept as a list of each channel's result rather than written into arrays.
+    listed = [name for name, wanted in (('Onsets', onsets), ('HarmonicSpectrogram', spectrograms), ('NoiseSpectrogram', spectrograms)) if wanted]
+    for name in listed:
+        out[name] = [None]*numChans
+    with instrumentation.stage('separation', multiAudio.size):
+        if executor is None:
+            separated = (separate_mono_audio(*args) for args in arguments)
+        else:
+            separated = parallel.parallel_map(separate_mono_audio, arguments, executor, numWorkers, prefer = 'processes')
+        for i, ComponentAudio in enumerate(separated):
+            for name in listed:
+                out[name][i] = ComponentAudio.pop(name)
+            for name, component in ComponentAudio.items():
+                length = min(component.size, len(out[name]))
+                out[name][:length,i] = component[:length]
+                out[name][length:,i] = 0
     
-    return {'Transients':Transients, 'Harmonic':Harmonic ,'Noise':Noise }
+    return out
+
+
+def decorrelate_spectrograms(spectrograms, decorrelators, length, nfft = 2048, out = None):
+    # STFT domain decorrelation of components that are added into the same outputs, e.g. the harmonic and noise.
+    # spectrograms is a list, for each component, of the STFTs (size nfft) of each input channel and decorrelators 
+    # the matching decorrelators made with audioIn = None. Each output channel is the sum of the components, delayed 
+    # by whole frames and multiplied bin by bin by the gains of their decorrelator (see Decorrelator.stftFilters), 
+    # so it takes a single istft. The STFTs must have librosa's default hop of nfft//4.
+    # The filters are normalised as when streaming rather than by the r.m.s of the signal.
+    # This approximates filtering the signals: the error against the time domain filters is about -25 dB 
+    # (-20 dB at worst over all outputs), as each filter partition is applied to a whole windowed frame.
+    # Returns the (length, numOutChans) output, written into out if given.
+    componentGains = [decorrelator.stftFilters(nfft) for decorrelator in decorrelators]
+    numOutChans = decorrelators[0].numOutChans
+    if out is None:
+        out = np.zeros((length, numOutChans), dtype = decorrelators[0].dtype)
+
+    with instrumentation.stage('stft_decorrelation', length*numOutChans):
+        frames = [[delayed_frames(spectrogram, len(gains)) for spectrogram in componentSpectrograms] 
+                  for componentSpectrograms, (gains, inputChannels) in zip(spectrograms, componentGains)]
+        for k in range(numOutChans):
+            D = 0
+            for componentFrames, (gains, inputChannels) in zip(frames, componentGains):
+                delayed = componentFrames[inputChannels[k]]
+                # Sum of the delayed frames times their gains for each bin, as a (bins, 1, numDelays) @ (bins, numDelays, frames) product.
+                D = D + np.matmul(gains[:,:,k].T[:,np.newaxis,:].astype(delayed.dtype), delayed)[:,0]
+            with instrumentation.stage('istft', length):
+                out[:,k] = librosa.istft(D, n_fft = nfft, length = length)
+
+    return out
 
 
+def delayed_frames(spectrogram, numDelays):
+    # Read only (bins, numDelays, frames) view of the spectrogram delayed by 0 to numDelays-1 frames, 
+    # with zeros before the first frame.
+    numBins, numFrames = spectrogram.shape
+    padded = np.zeros((numBins, numFrames+numDelays-1), dtype = spectrogram.dtype)
+    padded[:,numDelays-1:] = spectrogram
+    stride = padded.strides
+
+    return as_strided(padded[:,numDelays-1:], (numBins, numDelays, numFrames), (stride[0], -stride[1], stride[1]), writeable = False)
 
 
 def s3a_audio_decorrelator(audioIn, 
@@ -92,7 +385,16 @@ def s3a_audio_decorrelator(audioIn,
                            harmonic_decorrelation_method = dt.Lauridsen,
                            harmonic_decorrelation_arguments = dict(),
                            noise_decorrelation_method = dt.AllPassLauridsen, 
-                           noise_decorrelation_arguments = dict()):
+                           noise_decorrelation_arguments = dict(),
+                           separation_arguments = dict(),
+                           executor = None,
+                           numWorkers = None,
+                           seed = None,
+                           dtype = np.float64,
+                           out = None,
+                           memmap_directory = None,
+                           kernel = None,
+                           decorrelation_domain = 'time'):
     
        
         
@@ -100,16 +402,73 @@ def s3a_audio_decorrelator(audioIn,
   
 
     # Decorrelates the audio using using separate decorrelation methods for percussive harmonic and noise components.
+    # executor runs the separation of each channel and the three decorrelators in parallel (see parallel.py).
+    # seed makes the routing and filters reproducible.
+    # separation_arguments are passed to separate_audio, e.g. dict(mode = 'fast').
+    # dtype = np.float32 separates and decorrelates in single precision to save memory and time.
+    # out is an optional (length, num_out_chans) array to write the output into, e.g. a memmap.
+    # memmap_directory keeps the components and decorrelator outputs in temporary memmaps in that folder rather than
+    # in memory, for signals larger than RAM (see memmap_io.py). The output is then the length of the input.
+    # kernel is an s3a decorrelation kernel (or its directory) made by build_s3a_kernel, which gives the routing, 
+    # decorrelation methods and their filters.
+    # decorrelation_domain = 'stft' applies the harmonic and noise decorrelators to the STFTs from the separation
+    # as per bin phase and gain changes, with one istft per output channel (see decorrelate_spectrograms).
+    # This is an approximation of the time domain filtering, to about -25 dB (-20 dB at worst), with the 
+    # same output shape and length.
+    # Only decorrelators with short FIR filters are suitable, e.g. AllPass, Lauridsen, VelvetNoise or Copier.
+    if decorrelation_domain not in DECORRELATION_DOMAINS:
+        raise ValueError('decorrelation_domain must be one of {d}, not {s}'.format(d = DECORRELATION_DOMAINS, s = decorrelation_domain))
+    stftDomain = decorrelation_domain == 'stft'
+    if kernel is not None:
+        if isinstance(kernel, str):
+            kernel = fc.Kernel(kernel)
+        num_out_chans = kernel.settings['num_out_chans']
+        if transient_routing is None:
+            transient_routing = kernel.settings['transient_routing']
+        if steady_state_routing is None:
+            steady_state_routing = kernel.settings['steady_state_routing']
+        transient_decorrelation_method, transient_decorrelation_arguments = component_kernel(kernel, 'transient', transient_decorrelation_arguments)
+        harmonic_decorrelation_method, harmonic_decorrelation_arguments = component_kernel(kernel, 'harmonic', harmonic_decorrelation_arguments)
+        noise_decorrelation_method, noise_decorrelation_arguments = component_kernel(kernel, 'noise', noise_decorrelation_arguments)
+
+    # Mono input is handled as a single column so the component buffers have a channel axis.
+    audioIn = dt.add_dimension(np.asarray(audioIn, dtype = dtype))
+    if memmap_directory is None:
+        componentBuffers = None
+    else:
+        names = ('Transients',) if stftDomain else ('Transients', 'Harmonic', 'Noise')
+        componentBuffers = {name: memmap_io.temp_memmap(audioIn.shape, dtype, memmap_directory) for name in names}
     
+    # The transient panner uses the onsets found in the separation rather than analysing the transients again,
+    # unless it is given its own onsets (onsets = None detects them from the transients as before).
+    spectrogramOnsets = issubclass(transient_decorrelation_method, dt.TransientPanner) and 'onsets' not in transient_decorrelation_arguments
+
     #Separate audio into Transinets Harmonic and Noise components.
-    componentAudioIn = separate_audio(audioIn)
+    componentAudioIn = separate_audio(audioIn, executor = executor, numWorkers = numWorkers, out = componentBuffers, 
+                                      **{'onsets': spectrogramOnsets, 'fs': fs, 'spectrograms': stftDomain, **separation_arguments})
+    if spectrogramOnsets:
+        transient_decorrelation_arguments = {'onsets': componentAudioIn['Onsets'], **transient_decorrelation_arguments}
+
+    # Each component decorrelator gets its own seed so they are independent whichever process they run in.
+    if seed is None:
+        rng = np.random
+    else:
+        rng = np.random.default_rng(seed)
+    if seed is not None or executor is not None:
+        componentSeeds = parallel.task_seeds(seed, 3)
+        transient_decorrelation_arguments = {'seed': componentSeeds[0], 'cache_filters': seed is not None, **transient_decorrelation_arguments}
+        harmonic_decorrelation_arguments = {'seed': componentSeeds[1], 'cache_filters': seed is not None, **harmonic_decorrelation_arguments}
+        noise_decorrelation_arguments = {'seed': componentSeeds[2], 'cache_filters': seed is not None, **noise_decorrelation_arguments}
+    transient_decorrelation_arguments = {'dtype': dtype, **transient_decorrelation_arguments}
+    harmonic_decorrelation_arguments = {'dtype': dtype, **harmonic_decorrelation_arguments}
+    noise_decorrelation_arguments = {'dtype': dtype, **noise_decorrelation_arguments}
 
     # If not specified, the transients and steady-state components should be routed to random loudspeakers.
     if transient_routing is None:
-        transient_routing = np.random.permutation(num_out_chans)
+        transient_routing = rng.permutation(num_out_chans)
         
     if steady_state_routing is None:
-        steady_state_routing = np.random.permutation(num_out_chans)
+        steady_state_routing = rng.permutation(num_out_chans)
 
     # Number of output channels determined from the routing arrays.
     numTransOutChans = len(transient_routing)
@@ -117,18 +476,538 @@ def s3a_audio_decorrelator(audioIn,
         
     # Decorrelation+method can be used to override the default methods.
 
-    TransientsDecorr = transient_decorrelation_method (componentAudioIn['Transients'], numOutChans = numTransOutChans,**transient_decorrelation_arguments)
-    HarmonicDecorr = harmonic_decorrelation_method(componentAudioIn['Harmonic'], numOutChans = numSteadyOutChans, **harmonic_decorrelation_arguments)
-    NoiseDecorr = noise_decorrelation_method(componentAudioIn['Noise'], numOutChans = numSteadyOutChans, **noise_decorrelation_arguments)
+    if memmap_directory is not None:
+        transient_decorrelation_arguments = {'out': memmap_io.temp_memmap((len(audioIn), numTransOutChans), dtype, memmap_directory), **transient_decorrelation_arguments}
+        harmonic_decorrelation_arguments = {'out': memmap_io.temp_memmap((len(audioIn), numSteadyOutChans), dtype, memmap_directory), **harmonic_decorrelation_arguments}
+        if not stftDomain:
+            noise_decorrelation_arguments = {'out': memmap_io.temp_memmap((len(audioIn), numSteadyOutChans), dtype, memmap_directory), **noise_decorrelation_arguments}
+        if out is None:
+            out = memmap_io.temp_memmap((len(audioIn), num_out_chans), dtype, memmap_directory)
+
+    with instrumentation.stage('decorrelation', 3*audioIn.size):
+        if stftDomain:
+            # The harmonic and noise go to the same outputs so are decorrelated and summed before a single istft.
+            TransientsOut = run_decorrelator(transient_decorrelation_method, componentAudioIn['Transients'], numTransOutChans, transient_decorrelation_arguments)
+            steadyOut = harmonic_decorrelation_arguments.pop('out', None)
+            streamArguments = dict(fs = fs, numInChans = audioIn.shape[1], numOutChans = numSteadyOutChans)
+            decorrelators = [harmonic_decorrelation_method(None, **streamArguments, **harmonic_decorrelation_arguments),
+                             noise_decorrelation_method(None, **streamArguments, **noise_decorrelation_arguments)]
+            SteadyOut = decorrelate_spectrograms([componentAudioIn['HarmonicSpectrogram'], componentAudioIn['NoiseSpectrogram']], decorrelators, 
+                                                 len(audioIn), nfft = separation_arguments.get('fftHarm', 2048), out = steadyOut)
+            components = ((transient_routing, TransientsOut), (steady_state_routing, SteadyOut))
+        else:
+            # The three decorrelators are independent so can run in parallel.
+            TransientsOut, HarmonicOut, NoiseOut = parallel.parallel_map(run_decorrelator, 
+                [(transient_decorrelation_method, componentAudioIn['Transients'], numTransOutChans, transient_decorrelation_arguments),
+                 (harmonic_decorrelation_method, componentAudioIn['Harmonic'], numSteadyOutChans, harmonic_decorrelation_arguments),
+                 (noise_decorrelation_method, componentAudioIn['Noise'], numSteadyOutChans, noise_decorrelation_arguments)],
+                executor, numWorkers, prefer = 'processes')
+            components = ((transient_routing, TransientsOut), (steady_state_routing, HarmonicOut), (steady_state_routing, NoiseOut))
 
     # Different decorrelation filter lengths lead to different output lengths following the convolution.
     # Choose the minimum length and truncate the longer stimuli.
-    length = min(np.array([len(HarmonicDecorr.audio_out), len(NoiseDecorr.audio_out), len(TransientsDecorr.audio_out)]))
+    if out is None:
+        length = min(len(componentOut) for routing, componentOut in components)
+        audioOut = np.zeros((length,num_out_chans), dtype = dtype)
+    else:
+        audioOut = out
+        audioOut[:] = 0
     
     #Signals are routed to appropriate loudspeakers
-    audioOut = np.zeros((length,num_out_chans))
-    audioOut[:,transient_routing] = TransientsDecorr.audio_out[:length,:]
-    audioOut[:,steady_state_routing] += HarmonicDecorr.audio_out[:length,:] + NoiseDecorr.audio_out[:length,:]
+    # Each component is added straight into the output a channel at a time, so there are no temporary copies.
+    with instrumentation.stage('routing', audioOut.size):
+        for routing, componentOut in components:
+            length = min(len(componentOut), len(audioOut))
+            for k, chan in enumerate(routing):
+                audioOut[:length,chan] += componentOut[:length,k]
     
     
     return audioOut
+
+
+def build_s3a_kernel(directory,
+                     numInChans = 1,
+                     num_out_chans = 2,
+                     fs = 48000,
+                     seed = 0,
+                     blockSize = 1024,
+                     transient_routing = None,
+                     steady_state_routing = None,
+                     transient_decorrelation_method = dt.TransientPanner,
+                     transient_decorrelation_arguments = dict(),
+                     harmonic_decorrelation_method = dt.Lauridsen,
+                     harmonic_decorrelation_arguments = dict(),
+                     noise_decorrelation_method = dt.AllPassLauridsen,
+                     noise_decorrelation_arguments = dict()):
+    # Builds a decorrelation kernel for s3a_audio_decorrelator in directory: a kernel for each component decorrelator
+    # in the transient, harmonic and noise subfolders and the routing. The routing and filters are the same as
+    # s3a_audio_decorrelator gives with the same seed. Returns the loaded kernel, see filter_cache.Kernel.
+    rng = np.random.default_rng(seed)
+    if transient_routing is None:
+        transient_routing = rng.permutation(num_out_chans)
+    if steady_state_routing is None:
+        steady_state_routing = rng.permutation(num_out_chans)
+
+    componentSeeds = parallel.task_seeds(seed, 3)
+    for name, method, arguments, componentSeed, numOutChans in (
+            ('transient', transient_decorrelation_method, transient_decorrelation_arguments, componentSeeds[0], len(transient_routing)),
+            ('harmonic', harmonic_decorrelation_method, harmonic_decorrelation_arguments, componentSeeds[1], len(steady_state_routing)),
+            ('noise', noise_decorrelation_method, noise_decorrelation_arguments, componentSeeds[2], len(steady_state_routing))):
+        dt.build_kernel(os.path.join(directory, name), method, numInChans = numInChans, numOutChans = numOutChans, 
+                        fs = fs, seed = componentSeed, blockSize = blockSize, **arguments)
+
+    fc.write_kernel(directory, dict(decorrelator = 's3a_audio_decorrelator', fs = fs, seed = seed, numInChans = numInChans, 
+                                    num_out_chans = num_out_chans, blockSize = blockSize,
+                                    transient_routing = [int(chan) for chan in transient_routing],
+                                    steady_state_routing = [int(chan) for chan in steady_state_routing]))
+
+    return fc.Kernel(directory)
+
+
+def component_kernel(kernel, name, arguments):
+    # The decorrelation method and arguments of a component of an s3a kernel. arguments override the saved ones.
+    componentKernel = fc.Kernel(os.path.join(kernel.directory, name))
+    settings = componentKernel.settings
+    arguments = {'kernel': componentKernel, 'fs': settings['fs'], 'blockSize': settings['blockSize'], **settings['arguments'], **arguments}
+
+    return getattr(dt, settings['decorrelator']), arguments
+
+
+def run_decorrelator(decorrelation_method, audio, numOutChans, decorrelation_arguments):
+    # Task run by the executor in s3a_audio_decorrelator. Only the output audio is returned to the caller.
+    Decorr = decorrelation_method(audio, numOutChans = numOutChans, **decorrelation_arguments)
+
+    return Decorr.audio_out
+
+
+def separation_context(fftTrans = 1024, fftHarm = 2048, kernel_size = 31):
+    # Number of samples either side of a region that affect its separation by separate_audio().
+    # Each stage depends on an FFT frame and half the hpss median filter (in frames) either side.
+    context = 0
+    for nfft in (fftTrans, fftHarm):
+        context += nfft + (kernel_size//2) * (nfft//4)
+
+    return context
+
+
+class StreamingS3ADecorrelator(object):
+    # Chunked version of s3a_audio_decorrelator() that decorrelates arbitrarily long signals in bounded memory.
+    #
+    # Pass consecutive chunks of audio to process_chunk() and call flush() after the last one. 
+    # Each chunk is separated with enough context either side to match separate_audio() over the whole signal, 
+    # so process_chunk() returns the output of the previous chunk once the following chunk is available.
+    # The components are then decorrelated by the streaming decorrelators (process_block) which carry 
+    # the filter tails over the chunk boundaries so the output is seamless.
+    #
+    # All chunks except the last must be a multiple of chunkStep samples long.
+    # The output is the same length as the input, as with s3a_audio_decorrelator().
+
+    def __init__(self, 
+                 numInChans = 1, 
+                 num_out_chans = 2, 
+                 fs = 48000, 
+                 transient_routing = None, 
+                 steady_state_routing = None, 
+                 transient_decorrelation_method = dt.TransientPanner, 
+                 transient_decorrelation_arguments = dict(), 
+                 harmonic_decorrelation_method = dt.Lauridsen,
+                 harmonic_decorrelation_arguments = dict(),
+                 noise_decorrelation_method = dt.AllPassLauridsen, 
+                 noise_decorrelation_arguments = dict(),
+                 blockSize = 1024,
+                 fftTrans = 1024, 
+                 fftHarm = 2048,
+                 separation_arguments = dict(),
+                 seed = None,
+                 dtype = np.float64):
+        # seed and dtype are as for s3a_audio_decorrelator(), so the same seed gives the same routing and filters.
+
+        self.numInChans = numInChans
+        self.num_out_chans = num_out_chans
+        self.blockSize = blockSize
+        self.fftTrans = fftTrans
+        self.fftHarm = fftHarm
+        self.separation_arguments = separation_arguments
+        self.dtype = np.dtype(dtype)
+
+        # Each component decorrelator gets its own seed, as in s3a_audio_decorrelator().
+        if seed is None:
+            rng = np.random
+        else:
+            rng = np.random.default_rng(seed)
+            componentSeeds = parallel.task_seeds(seed, 3)
+            transient_decorrelation_arguments = {'seed': componentSeeds[0], **transient_decorrelation_arguments}
+            harmonic_decorrelation_arguments = {'seed': componentSeeds[1], **harmonic_decorrelation_arguments}
+            noise_decorrelation_arguments = {'seed': componentSeeds[2], **noise_decorrelation_arguments}
+        transient_decorrelation_arguments = {'dtype': dtype, **transient_decorrelation_arguments}
+        harmonic_decorrelation_arguments = {'dtype': dtype, **harmonic_decorrelation_arguments}
+        noise_decorrelation_arguments = {'dtype': dtype, **noise_decorrelation_arguments}
+
+        # If not specified, the transients and steady-state components should be routed to random loudspeakers.
+        if transient_routing is None:
+            transient_routing = rng.permutation(num_out_chans)
+        if steady_state_routing is None:
+            steady_state_routing = rng.permutation(num_out_chans)
+        self.transient_routing = transient_routing
+        self.steady_state_routing = steady_state_routing
+
+        # Chunks must start on an STFT frame of both separation stages and a decorrelator block.
+        self.chunkStep = int(np.lcm.reduce([blockSize, fftTrans//4, fftHarm//4]))
+        context = separation_context(fftTrans, fftHarm)
+        self.context = int(np.ceil(context/self.chunkStep))*self.chunkStep
+
+        # Decorrelators in streaming mode.
+        streamArguments = dict(fs = fs, numInChans = numInChans, blockSize = blockSize)
+        self.TransientsDecorr = transient_decorrelation_method(None, numOutChans = len(transient_routing), **streamArguments, **transient_decorrelation_arguments)
+        self.HarmonicDecorr = harmonic_decorrelation_method(None, numOutChans = len(steady_state_routing), **streamArguments, **harmonic_decorrelation_arguments)
+        self.NoiseDecorr = noise_decorrelation_method(None, numOutChans = len(steady_state_routing), **streamArguments, **noise_decorrelation_arguments)
+
+        # Context before the current chunk and the chunk waiting for its following context.
+        self.previous = np.zeros((0, numInChans), dtype = self.dtype)
+        self.current = None
+
+    def process_chunk(self, audio):
+        # Returns the decorrelated output of the previous chunk (empty for the first chunk).
+        audio = dt.add_dimension(np.asarray(audio, dtype = self.dtype))
+        if self.current is None:
+            audioOut = np.zeros((0, self.num_out_chans), dtype = self.dtype)
+        else:
+            audioOut = self.renderChunk(audio[:self.context])
+            self.previous = np.concatenate((self.previous, self.current))[-self.context:]
+        self.current = audio
+
+        return audioOut
+
+    def flush(self):
+        # Returns the decorrelated output of the last chunk.
+        if self.current is None:
+            return np.zeros((0, self.num_out_chans), dtype = self.dtype)
+        audioOut = self.renderChunk(np.zeros((0, self.numInChans), dtype = self.dtype))
+        self.current = None
+
+        return audioOut
+
+    def renderChunk(self, following):
+        # Separate the current chunk with the context either side and keep only the current chunk.
+        start = len(self.previous)
+        length = len(self.current)
+        segment = np.concatenate((self.previous, self.current, following))
+        componentAudioIn = separate_audio(segment, fftTrans = self.fftTrans, fftHarm = self.fftHarm, **self.separation_arguments)
+
+        # The streaming decorrelators take whole blocks. The last chunk is padded and truncated.
+        numBlocks = int(np.ceil(length/self.blockSize))
+        components = dict()
+        for name in ('Transients', 'Harmonic', 'Noise'):
+            components[name] = np.zeros((numBlocks*self.blockSize, self.numInChans), dtype = self.dtype)
+            components[name][:length] = componentAudioIn[name][start:start+length]
+
+        steadyState = np.zeros((numBlocks*self.blockSize, len(self.steady_state_routing)), dtype = self.dtype)
+        transients = np.zeros((numBlocks*self.blockSize, len(self.transient_routing)), dtype = self.dtype)
+        for n in range(numBlocks):
+            block = slice(n*self.blockSize, (n+1)*self.blockSize)
+            steadyState[block] = self.HarmonicDecorr.process_block(components['Harmonic'][block]) + self.NoiseDecorr.process_block(components['Noise'][block])
+            if not isinstance(self.TransientsDecorr, dt.TransientPanner):
+                transients[block] = self.TransientsDecorr.process_block(components['Transients'][block])
+
+        # The transient panner needs the context for onset detection.
+        if isinstance(self.TransientsDecorr, dt.TransientPanner):
+            transients[:length] = self.TransientsDecorr.process_chunk(componentAudioIn['Transients'], start, length)
+
+        #Signals are routed to appropriate loudspeakers
+        audioOut = np.zeros((length, self.num_out_chans), dtype = self.dtype)
+        audioOut[:,self.transient_routing] = transients[:length]
+        audioOut[:,self.steady_state_routing] += steadyState[:length]
+
+        return audioOut
+
+
+
+class DelayLine(object):
+    # Delays a stream of (samples, channels) blocks by delay samples.
+
+    def __init__(self, delay, numChans = 1):
+        self.buffer = np.zeros((delay, numChans))
+
+    def process(self, block):
+        stream = np.concatenate((self.buffer, block))
+        self.buffer = stream[len(block):]
+
+        return stream[:len(block)]
+
+
+class CausalHPSS(object):
+    # One stage of causal, frame by frame harmonic percussive separation.
+    #
+    # Each hop (nfft//4 samples) a Hann windowed frame ending at the latest sample is transformed and its 
+    # magnitude added to a ring buffer of the last kernel_size frames. The harmonic median (along time) of a 
+    # frame is taken over the ring buffer once lookahead more frames have arrived, and the percussive median 
+    # (along frequency) over the frame itself. The soft mask of the chosen component ('harmonic' or 'percussive') 
+    # is applied as in hpss() and the frame is overlap-added back to the time domain.
+    # With kernel_size = 31 and lookahead = 15 this is the same as hpss() away from the start of the signal.
+    #
+    # process() returns the component and the residual (the input minus the component) both delayed by 
+    # latency = nfft + (lookahead - 1)*hop samples. Blocks must be a multiple of the hop long.
+
+    def __init__(self, numChans = 1, nfft = 1024, margin = 1.0, component = 'percussive', kernel_size = 17, lookahead = 4, numThreads = None):
+        if np.isscalar(margin):
+            self.marginHarm = self.marginPerc = margin
+        else:
+            self.marginHarm, self.marginPerc = margin
+        if np.isscalar(kernel_size):
+            self.winHarm = self.winPerc = kernel_size
+        else:
+            self.winHarm, self.winPerc = kernel_size
+        if not 0 <= lookahead < self.winHarm:
+            raise ValueError('lookahead must be at least 0 and less than the kernel size ({k} frames), not {l}'.format(k = self.winHarm, l = lookahead))
+        if component not in ('harmonic', 'percussive'):
+            raise ValueError("component must be 'harmonic' or 'percussive', not {c}".format(c = component))
+
+        self.nfft = nfft
+        self.hop = nfft//4
+        self.component = component
+        self.lookahead = lookahead
+        self.numThreads = numThreads
+        self.latency = nfft + (lookahead - 1)*self.hop
+
+        # Synthesis window including the istft normalisation.
+        window = scipy.signal.get_window('hann', nfft)
+        self.window = window[:,np.newaxis]
+        self.synthesis = self.window / (np.sum(window**2)/self.hop)
+
+        numBins = nfft//2 + 1
+        self.frame = np.zeros((nfft, numChans))
+        self.spectra = np.zeros((lookahead + 1, numBins, numChans), dtype = complex)
+        self.magnitudes = np.zeros((self.winHarm, numBins, numChans), dtype = np.float32)
+        self.overlap = np.zeros((nfft, numChans))
+        self.frameCount = 0
+        self.delay = DelayLine(self.latency, numChans)
+
+    def process(self, block):
+        if len(block) % self.hop != 0:
+            raise ValueError('Blocks must be a multiple of {h} samples, not {l}'.format(h = self.hop, l = len(block)))
+
+        component = np.zeros_like(block)
+        for start in range(0, len(block), self.hop):
+            self.frame = np.concatenate((self.frame[self.hop:], block[start:start + self.hop]))
+            spectrum = np.fft.rfft(self.frame * self.window, axis = 0)
+            self.spectra[self.frameCount % len(self.spectra)] = spectrum
+            self.magnitudes[self.frameCount % len(self.magnitudes)] = np.abs(spectrum)
+
+            # The frame lookahead frames ago now has its harmonic median.
+            target = self.frameCount - self.lookahead
+            harm = np.median(self.magnitudes, axis = 0)
+            perc = median_filter(self.magnitudes[target % len(self.magnitudes)].T, self.winPerc, numThreads = self.numThreads).T
+            split_zeros = self.marginHarm == 1 and self.marginPerc == 1
+            if self.component == 'percussive':
+                mask = librosa.util.softmask(perc, harm * self.marginPerc, power = 2.0, split_zeros = split_zeros)
+            else:
+                mask = librosa.util.softmask(harm, perc * self.marginHarm, power = 2.0, split_zeros = split_zeros)
+
+            # Overlap-add. The first hop of the buffer now has all the frames that overlap it.
+            self.overlap += np.fft.irfft(self.spectra[target % len(self.spectra)] * mask, n = self.nfft, axis = 0) * self.synthesis
+            component[start:start + self.hop] = self.overlap[:self.hop]
+            self.overlap = np.concatenate((self.overlap[self.hop:], np.zeros_like(self.overlap[:self.hop])))
+            self.frameCount += 1
+
+        residual = self.delay.process(block) - component
+
+        return component, residual
+
+
+class CausalSeparator(object):
+    # Causal version of separate_audio() using two CausalHPSS stages: the transients are separated 
+    # with fftTrans and the harmonic and noise components from the residual with fftHarm.
+    # kernel_size and lookahead are in frames of each stage.
+    # The components returned by process_block() are delayed by latency samples. 
+    # Blocks must be a multiple of blockStep long.
+
+    def __init__(self, numChans = 1, fftTrans = 1024, fftHarm = 2048, marginTrans = 2.14, marginHarm = 3.0, kernel_size = 17, lookahead = 4, numThreads = None):
+        self.transientStage = CausalHPSS(numChans, fftTrans, margin = (1.0, marginTrans), component = 'percussive', 
+                                         kernel_size = kernel_size, lookahead = lookahead, numThreads = numThreads)
+        self.harmonicStage = CausalHPSS(numChans, fftHarm, margin = (marginHarm, 1.0), component = 'harmonic', 
+                                        kernel_size = kernel_size, lookahead = lookahead, numThreads = numThreads)
+        # The transients wait for the harmonic stage.
+        self.transientDelay = DelayLine(self.harmonicStage.latency, numChans)
+        self.latency = self.transientStage.latency + self.harmonicStage.latency
+        self.blockStep = int(np.lcm(self.transientStage.hop, self.harmonicStage.hop))
+
+    def process_block(self, audio):
+        audio = dt.add_dimension(audio)
+        Transients, Residual1 = self.transientStage.process(audio)
+        Harmonic, Noise = self.harmonicStage.process(Residual1)
+
+        return {'Transients':self.transientDelay.process(Transients), 'Harmonic':Harmonic ,'Noise':Noise }
+
+
+class OnsetEnvelope(object):
+    # Frame by frame version of librosa's onset strength (librosa.onset.onset_strength with its defaults) for 
+    # detecting the onsets of a stream.
+    #
+    # Each hop the Hann windowed frame ending at the latest sample is transformed to a mel power spectrum in dB, 
+    # and the spectra of the last length samples are kept, so each block of samples only analyses its new frames. 
+    # envelope() gives the spectral flux of the frames held, as librosa's onset strength of those samples 
+    # with the 80dB floor taken over the frames held. Before the first sample the stream is silent.
+    # onsets() picks the peaks of the envelope with librosa.onset.onset_detect.
+
+    def __init__(self, numChans = 1, fs = 48000, length = 24000, nfft = 2048, hop = 512):
+        self.fs = fs
+        self.nfft = nfft
+        self.hop = hop
+        self.window = scipy.signal.get_window('hann', nfft)[:,np.newaxis]
+        self.melBasis = librosa.filters.mel(sr = fs, n_fft = nfft)
+
+        # Samples of the last frame still needed by the next and those short of a whole hop.
+        self.tail = np.zeros((nfft - hop, numChans))
+        self.pending = np.zeros((0, numChans))
+        # Mel spectra in dB of the frames held, silence (librosa's amin) to start with.
+        numFrames = int(np.ceil(length/hop))
+        self.spectra = np.full((numFrames + 1, len(self.melBasis), numChans), 10*np.log10(1e-10))
+        # Number of samples received and the end of the latest frame.
+        self.length = 0
+        self.position = 0
+
+    def process(self, block):
+        self.pending = np.concatenate((self.pending, block))
+        self.length += len(block)
+        numHops = len(self.pending)//self.hop
+        if numHops == 0:
+            return
+        samples = np.concatenate((self.tail, self.pending[:numHops*self.hop]))
+        self.pending = self.pending[numHops*self.hop:]
+        self.tail = samples[numHops*self.hop:]
+
+        frames = np.stack([samples[n*self.hop:n*self.hop + self.nfft] for n in range(numHops)])
+        power = np.abs(np.fft.rfft(frames * self.window, axis = 1))**2
+        spectra = 10*np.log10(np.maximum(1e-10, np.matmul(self.melBasis, power)))
+        self.spectra = np.concatenate((self.spectra, spectra))[-len(self.spectra):]
+        self.position += numHops*self.hop
+
+    def envelope(self):
+        # (numFrames, numChans) onset strength of the frames ending at position - (numFrames - 1 - n)*hop.
+        spectra = np.maximum(self.spectra, np.max(self.spectra, axis = (0, 1)) - 80.0)
+        return np.mean(np.maximum(0.0, spectra[1:] - spectra[:-1]), axis = 1)
+
+    def onsets(self):
+        # Sample positions in the stream of the onsets of each channel over the frames held.
+        envelope = self.envelope()
+        start = self.position - (len(envelope) - 1)*self.hop
+        with instrumentation.stage('onset_detect', len(envelope)*self.hop):
+            return [start + self.hop*librosa.onset.onset_detect(onset_envelope = envelope[:,n], sr = self.fs, hop_length = self.hop, backtrack = True) 
+                    for n in range(envelope.shape[1])]
+
+
+class CausalS3ADecorrelator(object):
+    # Low latency, block by block version of s3a_audio_decorrelator().
+    #
+    # The input is separated by a CausalSeparator and each component is decorrelated by the 
+    # streaming decorrelators (process_block), so each call to process_block() returns a block 
+    # of output straight away. The output is the input delayed by latency samples:
+    #
+    # latency = fftTrans + fftHarm + (lookahead - 1)*(fftTrans + fftHarm)//4
+    #
+    # i.e. 5376 samples (112 ms at 48kHz) with the defaults, on top of the blockSize samples 
+    # needed to fill a block. Shorter lookahead or FFT sizes reduce the latency at the cost 
+    # of separation quality. The transient panner detects onsets over onsetContext samples of 
+    # past transients and the harmonic stage latency of future ones, which it gets for free. 
+    # The onset strength is kept between blocks (OnsetEnvelope) so each block only analyses its new frames.
+    # blockSize must be a multiple of fftHarm//4 (and fftTrans//4).
+
+    def __init__(self, 
+                 numInChans = 1, 
+                 num_out_chans = 2, 
+                 fs = 48000, 
+                 transient_routing = None, 
+                 steady_state_routing = None, 
+                 transient_decorrelation_method = dt.TransientPanner, 
+                 transient_decorrelation_arguments = dict(), 
+                 harmonic_decorrelation_method = dt.Lauridsen,
+                 harmonic_decorrelation_arguments = dict(),
+                 noise_decorrelation_method = dt.AllPassLauridsen, 
+                 noise_decorrelation_arguments = dict(),
+                 blockSize = 1024,
+                 fftTrans = 1024, 
+                 fftHarm = 2048,
+                 marginTrans = 2.14,
+                 marginHarm = 3.0,
+                 kernel_size = 17,
+                 lookahead = 4,
+                 onsetContext = 24000,
+                 numThreads = None,
+                 seed = None,
+                 dtype = np.float64):
+        # seed and dtype are as for s3a_audio_decorrelator(), so the same seed gives the same routing and filters.
+
+        self.numInChans = numInChans
+        self.num_out_chans = num_out_chans
+        self.blockSize = blockSize
+        self.dtype = np.dtype(dtype)
+
+        self.separator = CausalSeparator(numInChans, fftTrans, fftHarm, marginTrans, marginHarm, 
+                                         kernel_size = kernel_size, lookahead = lookahead, numThreads = numThreads)
+        if blockSize % self.separator.blockStep != 0:
+            raise ValueError('blockSize must be a multiple of {s}, not {b}'.format(s = self.separator.blockStep, b = blockSize))
+        self.latency = self.separator.latency
+
+        # Each component decorrelator gets its own seed, as in s3a_audio_decorrelator().
+        if seed is None:
+            rng = np.random
+        else:
+            rng = np.random.default_rng(seed)
+            componentSeeds = parallel.task_seeds(seed, 3)
+            transient_decorrelation_arguments = {'seed': componentSeeds[0], **transient_decorrelation_arguments}
+            harmonic_decorrelation_arguments = {'seed': componentSeeds[1], **harmonic_decorrelation_arguments}
+            noise_decorrelation_arguments = {'seed': componentSeeds[2], **noise_decorrelation_arguments}
+        transient_decorrelation_arguments = {'dtype': dtype, **transient_decorrelation_arguments}
+        harmonic_decorrelation_arguments = {'dtype': dtype, **harmonic_decorrelation_arguments}
+        noise_decorrelation_arguments = {'dtype': dtype, **noise_decorrelation_arguments}
+
+        # If not specified, the transients and steady-state components should be routed to random loudspeakers.
+        if transient_routing is None:
+            transient_routing = rng.permutation(num_out_chans)
+        if steady_state_routing is None:
+            steady_state_routing = rng.permutation(num_out_chans)
+        self.transient_routing = transient_routing
+        self.steady_state_routing = steady_state_routing
+
+        # Decorrelators in streaming mode.
+        streamArguments = dict(fs = fs, numInChans = numInChans, blockSize = blockSize)
+        self.TransientsDecorr = transient_decorrelation_method(None, numOutChans = len(transient_routing), **streamArguments, **transient_decorrelation_arguments)
+        self.HarmonicDecorr = harmonic_decorrelation_method(None, numOutChans = len(steady_state_routing), **streamArguments, **harmonic_decorrelation_arguments)
+        self.NoiseDecorr = noise_decorrelation_method(None, numOutChans = len(steady_state_routing), **streamArguments, **noise_decorrelation_arguments)
+
+        # Onset strength of the past transients for the transient panner, and of those still in the delay line.
+        self.onsetEnvelope = OnsetEnvelope(numInChans, fs, length = onsetContext + blockSize + self.separator.harmonicStage.latency)
+
+    def process_block(self, audio):
+        # Returns a block of (blockSize, num_out_chans) output, delayed by latency samples.
+        audio = dt.add_dimension(audio)
+        if audio.shape != (self.blockSize, self.numInChans):
+            raise ValueError('Blocks must be {b} samples by {c} channels, not {s}'.format(b = self.blockSize, c = self.numInChans, s = audio.shape))
+        components = self.separator.process_block(audio)
+
+        steadyState = self.HarmonicDecorr.process_block(components['Harmonic']) + self.NoiseDecorr.process_block(components['Noise'])
+        if isinstance(self.TransientsDecorr, dt.TransientPanner):
+            # The transients still waiting in the delay line are the look-ahead for the onset detection, 
+            # so the envelope is extended with the newest transients, the end of the delay line.
+            delayed = self.separator.transientDelay.buffer
+            self.onsetEnvelope.process(np.concatenate((components['Transients'], delayed))[-self.blockSize:])
+            start = self.onsetEnvelope.length - len(delayed) - self.blockSize
+            onsets = [channelOnsets - start for channelOnsets in self.onsetEnvelope.onsets()]
+            transients = self.TransientsDecorr.process_chunk(components['Transients'], 0, self.blockSize, onsets = onsets)
+        else:
+            transients = self.TransientsDecorr.process_block(components['Transients'])
+
+        #Signals are routed to appropriate loudspeakers
+        audioOut = np.zeros((self.blockSize, self.num_out_chans), dtype = self.dtype)
+        audioOut[:,self.transient_routing] = transients
+        audioOut[:,self.steady_state_routing] += steadyState
+
+        return audioOut
+
+    def flush(self):
+        # Returns the last latency samples of output, still in the separator after the last block.
+        numBlocks = int(np.ceil(self.latency/self.blockSize))
+        silence = np.zeros((self.blockSize, self.numInChans))
+        audioOut = np.concatenate([self.process_block(silence) for n in range(numBlocks)])
+
+        return audioOut[:self.latency]
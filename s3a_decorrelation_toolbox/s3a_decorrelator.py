@@ -9,27 +9,65 @@ Additional arguments can always be added to do anything custom.
 @author: Michael Cousins
 """
 
+import logging
+
 from . import percussive_harmonic_decorrelator as phdc
 import scipy.io.wavfile
 import soundfile as sf
 import numpy as np
 from . import decorr_toolbox as dt
+from . import instrumentation
+from . import memmap_io
+
+logger = logging.getLogger(__name__)
+
+
+# Bytes per sample of the soundfile subtypes used for the output.
+SUBTYPE_BYTES = {'PCM_16': 2, 'PCM_24': 3, 'PCM_32': 4, 'FLOAT': 4, 'DOUBLE': 8}
+
+# Arguments of s3a_decorrelator and s3a_audio_decorrelator that s3a_decorrelator_stream can't use. 
+# The sample rate is the file's and the chunks are already bounded in memory and processed in turn.
+STREAM_IGNORED_ARGUMENTS = ('fs', 'channels', 'memmap_directory', 'executor', 'numWorkers', 'out', 'kernel', 'decorrelation_domain')
 
+# Presets understood by preset_arguments.
+PRESETS = ('upmix', 'diffuse', 'upmix_mono_LRCSLsRs', 'upmix_stereo_LRCSLsRs', 'upmix_lauridsen4')
 
 
-def s3a_decorrelator(input_file, output_filename, preset = 'diffuse', duration = None, make_mono = False, fs = 48000, **kwargs):
+def s3a_decorrelator(input_file, output_filename, preset = 'diffuse', duration = None, make_mono = False, fs = 48000, dtype = 'float64', subtype = None, memmap_directory = None, channels = None, **kwargs):
+    # dtype = 'float32' processes in single precision. 
+    # subtype is the soundfile format of the output file, e.g. 'PCM_16', 'PCM_24' or 'FLOAT'. 
+    # By default the output is written as floats of the same precision as dtype.
+    # memmap_directory processes files larger than RAM with memory mapped files in that folder, see s3a_render.
     
     decorrelation_arguments = preset_parser (preset, **kwargs)
+
+    return s3a_render(input_file, output_filename, decorrelation_arguments, duration = duration, make_mono = make_mono, fs = fs, dtype = dtype, subtype = subtype, 
+                      memmap_directory = memmap_directory, channels = channels)
+
+
+def s3a_render(input_file, output_filename, decorrelation_arguments, duration = None, make_mono = False, fs = 48000, dtype = 'float64', subtype = None, memmap_directory = None, channels = None):
+    # Decorrelates input_file with already parsed decorrelation_arguments (see preset_parser).
+    # With memmap_directory the input file is memory mapped rather than read (a WAV/RF64, .npy or raw file of 
+    # channels interleaved samples of dtype) and the working buffers are temporary memmaps in memmap_directory. 
+    # 24 bit WAV files are converted to a temporary 32 bit file in memmap_directory first.
+    # The output file is written through a memmap too, so nothing the length of the file is held in memory. 
+    # The returned output is then a memmap with the same length as the input.
     
     if type(input_file)==str:
-        audioFile, fs = sf.read(input_file)
-    elif type(input_file)==np.ndarray:
+        with instrumentation.stage('read_input'):
+            if memmap_directory is None:
+                audioFile, fs = sf.read(input_file, dtype = dtype)
+            else:
+                audioFile, fileFs = memmap_io.open_input(input_file, channels = channels, dtype = dtype, directory = memmap_directory)
+                if fileFs is not None:
+                    fs = fileFs
+    elif isinstance(input_file, np.ndarray):
         audioFile = input_file
     
     if duration == None:
         l = audioFile.shape[0]
     else:
-        l = np.min([fs*duration, audioFile.shape[0]])
+        l = int(np.min([fs*duration, audioFile.shape[0]]))
 
     audioMulti = audioFile[:l]
     if make_mono == True:
@@ -37,17 +75,104 @@ def s3a_decorrelator(input_file, output_filename, preset = 'diffuse', duration =
     else:
         audioIn = audioMulti
 
+    if memmap_directory is not None:
+        # One sequential pass to make each channel contiguous, converting integer samples.
+        with instrumentation.stage('read_input', audioIn.size):
+            audioIn = memmap_io.channel_major(dt.add_dimension(audioIn), dtype = dtype, directory = memmap_directory)
+        decorrelation_arguments = {'memmap_directory': memmap_directory, **decorrelation_arguments}
+
     # Split either the mono audio into components or the stereo audio into components to compare mono and stereo upmixes.
-    audioOut = phdc.s3a_audio_decorrelator(audioIn, **decorrelation_arguments)
+    audioOut = phdc.s3a_audio_decorrelator(audioIn, **{'dtype': dtype, **decorrelation_arguments})
     
     if output_filename != None:
-        scipy.io.wavfile.write(output_filename, fs, audioOut)
+        with instrumentation.stage('write_output', audioOut.size):
+            write_output(output_filename, audioOut, fs, subtype, memmap_directory)
 
     return audioOut
 
 
+def write_output(output_filename, audioOut, fs, subtype = None, memmap_directory = None):
+    if memmap_directory is not None and (subtype is None or subtype in memmap_io.WAV_SUBTYPES):
+        memmap_io.write_wav(output_filename, audioOut, fs, subtype = subtype or {4: 'FLOAT', 8: 'DOUBLE'}[audioOut.dtype.itemsize])
+    elif memmap_directory is not None:
+        # Formats that can't be memory mapped (e.g. PCM_24) are written in blocks.
+        with sf.SoundFile(output_filename, 'w', samplerate = fs, channels = audioOut.shape[1], subtype = subtype) as outputFile:
+            for start in range(0, len(audioOut), memmap_io.BLOCK_FRAMES):
+                outputFile.write(np.ascontiguousarray(audioOut[start:start + memmap_io.BLOCK_FRAMES]))
+    elif subtype is None:
+        scipy.io.wavfile.write(output_filename, fs, audioOut)
+    else:
+        sf.write(output_filename, audioOut, fs, subtype = subtype)
+
+
+def s3a_decorrelator_stream(input_file, output_filename, preset = 'diffuse', duration = None, make_mono = False, chunkSize = 2**18, blockSize = 1024, subtype = 'DOUBLE', **kwargs):
+    # Bounded memory version of s3a_decorrelator for long files.
+    # The input file is read in chunks of about chunkSize samples, each chunk is separated and decorrelated 
+    # and the output is written to output_filename as it is produced, so the peak memory does not 
+    # depend on the length of the file. Returns the number of frames written.
+    # subtype is the soundfile format of the output file, e.g. 'PCM_16', 'PCM_24', 'FLOAT' or 'DOUBLE'.
+    # Other arguments are as for s3a_decorrelator, except those in STREAM_IGNORED_ARGUMENTS which are ignored.
+    # The output is close to s3a_decorrelator's with the same seed but not identical: the streaming decorrelators
+    # are normalised by their filters (dt.downmix_gain) rather than the r.m.s of the whole signal, and the transient
+    # panner finds onsets in each chunk with librosa rather than from the separation of the whole file, so transients
+    # may go to different loudspeakers. The separation and the routing and filters of the seed are the same.
+    
+    ignored = [name for name in STREAM_IGNORED_ARGUMENTS if name in kwargs]
+    if ignored:
+        logger.warning('s3a_decorrelator_stream ignores %s', ', '.join(ignored))
+    kwargs = {name: value for name, value in kwargs.items() if name not in STREAM_IGNORED_ARGUMENTS}
+    decorrelation_arguments = preset_parser (preset, **kwargs)
+
+    info = sf.info(input_file)
+    fs = info.samplerate
+    if duration == None:
+        l = info.frames
+    else:
+        l = int(np.min([fs*duration, info.frames]))
+
+    if make_mono == True:
+        numInChans = 1
+    else:
+        numInChans = info.channels
+
+    decorrelator = phdc.StreamingS3ADecorrelator(numInChans = numInChans, fs = fs, blockSize = blockSize, **decorrelation_arguments)
+    
+    # Chunks must be a whole number of steps long and at least as long as the separation context.
+    chunkSize = max(chunkSize, decorrelator.context)
+    chunkSize = int(np.ceil(chunkSize/decorrelator.chunkStep))*decorrelator.chunkStep
+
+    # WAV files are limited to 4GB. Use RF64 for larger outputs.
+    if l * decorrelator.num_out_chans * SUBTYPE_BYTES.get(subtype, 8) >= 2**32:
+        fileFormat = 'RF64'
+    else:
+        fileFormat = 'WAV'
+
+    framesWritten = 0
+    with sf.SoundFile(output_filename, 'w', samplerate = fs, channels = decorrelator.num_out_chans, subtype = subtype, format = fileFormat) as outputFile:
+        for chunk in sf.blocks(input_file, blocksize = chunkSize, frames = l, always_2d = True):
+            if make_mono == True:
+                chunk = phdc.mono_audio(chunk)
+            audioOut = decorrelator.process_chunk(chunk)
+            with instrumentation.stage('write_output', audioOut.size):
+                outputFile.write(audioOut)
+            framesWritten += len(audioOut)
+        audioOut = decorrelator.flush()
+        with instrumentation.stage('write_output', audioOut.size):
+            outputFile.write(audioOut)
+        framesWritten += len(audioOut)
+
+    return framesWritten
+
+
 def preset_parser (preset, **additional_kwargs):
     
+    allkwargs = preset_arguments(preset, **additional_kwargs)
+    logger.info('preset %s: %s', preset, allkwargs)
+    return allkwargs
+
+
+def preset_arguments (preset, **additional_kwargs):
+    # The arguments to s3a_audio_decorrelator for the given preset, updated with any additional arguments.
     
     preset_kwargs = dict()
     
@@ -81,7 +206,6 @@ def preset_parser (preset, **additional_kwargs):
     
     
     allkwargs = {**preset_kwargs, **additional_kwargs}
-    print (allkwargs)
     return allkwargs
 
     
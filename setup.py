@@ -14,7 +14,7 @@ setup(name='s3a_decorrelation_toolbox',
       license='ISC',
       packages=['s3a_decorrelation_toolbox'],
       install_requires=[
-                        'numpy >= 1.16.2',
+                        'numpy >= 1.17.0',
                         'scipy >= 1.2.1',
                         'soundfile >= 0.10.0',
                         'librosa >= 0.6.3',
@@ -0,0 +1,413 @@
+import pickle
+
+import numpy as np
+import pytest
+import scipy.signal
+
+import s3a_decorrelation_toolbox.decorr_toolbox as dt
+import s3a_decorrelation_toolbox.filter_cache as fc
+import s3a_decorrelation_toolbox.instrumentation as instrumentation
+
+from signals import example_signal, relative_error_db, stream_decorrelator, FLOAT32_TOLERANCE
+
+
+def reverb_filters(blockSize):
+    # The complete FauxReverb filters assembled from the partitions used with blockSize.
+    decorrelator = dt.FauxReverb(None, numOutChans = 2, seed = 1, blockSize = blockSize, filter_cache = fc.FilterCache())
+    decorrelator.startModule(0)
+    segments = decorrelator.reverbSegments(2)
+    filterLength = decorrelator.reverbLength()
+    layout = dt.partition_layout(filterLength, blockSize)
+    return np.vstack([segments(offset, length) for offset, length, size in layout])[:filterLength]
+
+
+def test_faux_reverb_filters_do_not_depend_on_block_size():
+    np.testing.assert_array_equal(reverb_filters(1024), reverb_filters(512))
+
+
+@pytest.mark.parametrize('method, arguments', [(dt.AllPass, dict()), (dt.Lauridsen, dict()), (dt.AllPassLauridsen, dict()), 
+                                               (dt.Fink, dict(filterLength = 20)), (dt.FreqLauridsen, dict()), (dt.VelvetNoise, dict()), 
+                                               (dt.FauxReverb, dict(reverbTime = 0.5)), (dt.Copier, dict()), (dt.TransientPanner, dict())])
+def test_float32_matches_float64(method, arguments):
+    audio = example_signal()
+    outputs = {dtype: method(audio, numOutChans = 6, seed = 1, dtype = dtype, **arguments).audio_out for dtype in (np.float32, np.float64)}
+
+    assert outputs[np.float32].dtype == np.float32
+    assert outputs[np.float32].shape == outputs[np.float64].shape
+    assert relative_error_db(outputs[np.float32], outputs[np.float64]) < FLOAT32_TOLERANCE
+
+
+def reference_convolve(audio, filters):
+    # Output k is audio column k % numInChans filtered by filters[:,k], as convolve().
+    audio = dt.add_dimension(audio)
+    return np.column_stack([scipy.signal.fftconvolve(audio[:,k % audio.shape[1]], filters[:,k]) for k in range(filters.shape[1])])
+
+
+def random_filters(filterLength, numFilters, seed = 0):
+    return np.random.default_rng(seed).standard_normal((filterLength, numFilters)) / np.sqrt(filterLength)
+
+
+# (numInChans, numFilters): a mono upmix and two inputs with two filters each.
+LAYOUTS = [(1, 3), (2, 4)]
+BLOCK_SIZE = 256
+
+
+@pytest.mark.parametrize('method', dt.CONVOLUTION_METHODS)
+@pytest.mark.parametrize('numInChans, numFilters', LAYOUTS)
+@pytest.mark.parametrize('filterLength', [1, 100, 3000])
+def test_convolve_methods_match_reference(method, numInChans, numFilters, filterLength):
+    # Filters shorter and longer than the block.
+    audio = np.random.default_rng(1).standard_normal((5000, numInChans))
+    filters = random_filters(filterLength, numFilters)
+
+    audioOut = dt.convolve(audio, filters, method = method, blockSize = BLOCK_SIZE)
+
+    assert audioOut.shape == (len(audio) + filterLength - 1, numFilters)
+    np.testing.assert_allclose(audioOut, reference_convolve(audio, filters), atol = 1e-10)
+
+
+@pytest.mark.parametrize('method', ['fft', 'overlap_add', 'overlap_save', 'partitioned'])
+def test_convolve_with_spectrum_cache(method):
+    audio = np.random.default_rng(1).standard_normal((5000, 2))
+    filters = random_filters(1500, 4)
+    cache = fc.FilterCache()
+
+    first = dt.convolve(audio, filters, method = method, blockSize = BLOCK_SIZE, spectrumCache = cache)
+    assert len(cache.entries) > 0
+    second = dt.convolve(audio, filters, method = method, blockSize = BLOCK_SIZE, spectrumCache = cache)
+
+    np.testing.assert_array_equal(first, second)
+    np.testing.assert_allclose(first, reference_convolve(audio, filters), atol = 1e-10)
+
+
+def test_convolve_float32():
+    audio = np.random.default_rng(1).standard_normal((5000, 1)).astype(np.float32)
+    filters = random_filters(300, 2).astype(np.float32)
+    for method in dt.CONVOLUTION_METHODS:
+        assert dt.convolve(audio, filters, method = method).dtype == np.float32
+
+
+def test_convolve_errors():
+    audio = np.zeros((100, 2))
+    with pytest.raises(ValueError):
+        dt.convolve(audio, np.zeros((10, 3)))
+    with pytest.raises(ValueError):
+        dt.convolve(audio, np.zeros((10, 2)), method = 'unknown')
+
+
+def test_select_convolution_method_boundaries():
+    assert dt.select_convolution_method(10000, dt.DIRECT_MAX_TAPS) == 'direct'
+    assert dt.select_convolution_method(dt.DIRECT_MAX_TAPS, 10000) == 'direct'
+    assert dt.select_convolution_method(4*(dt.DIRECT_MAX_TAPS + 1), dt.DIRECT_MAX_TAPS + 1) == 'fft'
+    assert dt.select_convolution_method(4*(dt.DIRECT_MAX_TAPS + 1) + 1, dt.DIRECT_MAX_TAPS + 1) == 'overlap_add'
+    assert dt.select_convolution_method(10, 10, sparse = True) == 'sparse'
+
+
+def sparse_test_filters(numTaps, numDelays, filterLength = 4096, numFilters = 4):
+    # numTaps nonzero taps spread over numDelays delays shared by the filters.
+    rng = np.random.default_rng(2)
+    delays = rng.choice(filterLength, numDelays, replace = False)
+    filters = np.zeros((filterLength, numFilters))
+    positions = rng.permutation(numDelays * numFilters)[:numTaps]
+    filters[delays[positions // numFilters], positions % numFilters] = rng.standard_normal(numTaps)
+    return filters
+
+
+def test_select_sparse_filters_boundaries():
+    # Up to SPARSE_MAX_TAPS taps on any delays.
+    assert dt.select_sparse_filters(sparse_test_filters(dt.SPARSE_MAX_TAPS, dt.SPARSE_MAX_TAPS))
+    assert not dt.select_sparse_filters(sparse_test_filters(dt.SPARSE_MAX_TAPS + 1, dt.SPARSE_MAX_TAPS + 1))
+    # More taps if they share up to SPARSE_MAX_DELAYS delays.
+    assert dt.select_sparse_filters(sparse_test_filters(4*dt.SPARSE_MAX_DELAYS, dt.SPARSE_MAX_DELAYS))
+    assert not dt.select_sparse_filters(sparse_test_filters(4*(dt.SPARSE_MAX_DELAYS + 1), dt.SPARSE_MAX_DELAYS + 1))
+    # Never when more than SPARSE_MAX_DENSITY of the taps are nonzero.
+    filterLength = 16
+    numTaps = int(dt.SPARSE_MAX_DENSITY * filterLength * 4)
+    assert dt.select_sparse_filters(sparse_test_filters(numTaps, filterLength, filterLength = filterLength))
+    assert not dt.select_sparse_filters(sparse_test_filters(numTaps + 1, filterLength, filterLength = filterLength))
+
+
+def test_auto_convolution_uses_sparse_filters():
+    audio = np.random.default_rng(1).standard_normal((5000, 1))
+    filters = sparse_test_filters(dt.SPARSE_MAX_TAPS, dt.SPARSE_MAX_TAPS)
+    with instrumentation.profile() as profile:
+        audioOut = dt.convolve(audio, filters)
+    assert 'convolution sparse' in profile.summary()
+    np.testing.assert_allclose(audioOut, reference_convolve(audio, filters), atol = 1e-10)
+
+
+def stream(convolver, audio, numBlocks):
+    # Output of numBlocks blocks of the audio followed by silence.
+    padded = np.zeros((numBlocks*convolver.blockSize, audio.shape[1]))
+    padded[:len(audio)] = audio
+    return np.concatenate([convolver.process(padded[n*convolver.blockSize:(n+1)*convolver.blockSize]) for n in range(numBlocks)])
+
+
+@pytest.mark.parametrize('method', ['auto', 'sparse'])
+@pytest.mark.parametrize('numInChans, numFilters', LAYOUTS)
+@pytest.mark.parametrize('filterLength', [100, 3000])
+def test_stream_convolver_matches_reference(method, numInChans, numFilters, filterLength):
+    audio = np.random.default_rng(1).standard_normal((5000, numInChans))
+    filters = random_filters(filterLength, numFilters)
+    inputMap = np.arange(numFilters) % numInChans
+
+    convolver = dt.stream_convolver(filters, BLOCK_SIZE, inputMap = inputMap, method = method, spectrumCache = fc.FilterCache())
+    outLength = len(audio) + filterLength - 1
+    audioOut = stream(convolver, audio, int(np.ceil(outLength/BLOCK_SIZE)))
+
+    np.testing.assert_allclose(audioOut[:outLength], reference_convolve(audio, filters), atol = 1e-10)
+    np.testing.assert_allclose(audioOut[outLength:], 0, atol = 1e-10)
+
+
+@pytest.mark.parametrize('filterLength', [100, 3000, 60000])
+def test_non_uniform_convolver_matches_reference(filterLength):
+    audio = np.random.default_rng(1).standard_normal((5000, 1))
+    filters = random_filters(filterLength, 2)
+
+    convolver = dt.NonUniformConvolver(filters, BLOCK_SIZE)
+    outLength = len(audio) + filterLength - 1
+    audioOut = stream(convolver, audio, int(np.ceil(outLength/BLOCK_SIZE)))
+
+    np.testing.assert_allclose(audioOut[:outLength], reference_convolve(audio, filters), atol = 1e-10)
+    np.testing.assert_allclose(dt.partitioned_convolve(audio, filters, BLOCK_SIZE), reference_convolve(audio, filters), atol = 1e-10)
+
+
+def test_stream_convolver_block_shape():
+    convolver = dt.stream_convolver(random_filters(100, 2), BLOCK_SIZE)
+    with pytest.raises(ValueError):
+        convolver.process(np.zeros((BLOCK_SIZE + 1, 1)))
+
+
+def edge_taps(filterLength, blockSize, numFilters, shared):
+    # Sparse filters with taps either side of the block edges, on delays shared by all the filters or not.
+    delays = [0, 1, blockSize - 1, blockSize, blockSize + 1, 2*blockSize - 1, filterLength - 1]
+    rng = np.random.default_rng(3)
+    filters = np.zeros((filterLength, numFilters))
+    for k in range(numFilters):
+        taps = delays if shared else [(d + k) % filterLength for d in delays]
+        filters[taps, k] = rng.choice([-1, 1, 0.5], len(taps))
+    return filters
+
+
+@pytest.mark.parametrize('shared', [True, False])
+@pytest.mark.parametrize('numInChans, numFilters', LAYOUTS)
+@pytest.mark.parametrize('audioLength', [1, 63, 64, 65, 1000])
+def test_sparse_convolve_matches_dense(shared, numInChans, numFilters, audioLength):
+    # Shared delays take the delay_mix_convolve() path, the others a shifted add per tap.
+    blockSize = 64
+    filters = edge_taps(200, blockSize, numFilters, shared)
+    audio = np.random.default_rng(1).standard_normal((audioLength, numInChans))
+    indices, gains = dt.dense_to_sparse(filters)
+
+    audioOut = dt.sparse_convolve(audio, indices, gains, len(filters), blockSize = blockSize)
+
+    np.testing.assert_allclose(audioOut, reference_convolve(audio, filters), atol = 1e-12)
+
+
+@pytest.mark.parametrize('audioLength', [1, 63, 64, 65, 1000])
+def test_delay_mix_convolve_matches_dense(audioLength):
+    blockSize = 64
+    filters = edge_taps(200, blockSize, 3, shared = True)
+    x = np.random.default_rng(1).standard_normal(audioLength)
+    indices, gains = dt.dense_to_sparse(filters)
+
+    audioOut = dt.delay_mix_convolve(x, indices, gains, len(filters), blockSize = blockSize)
+
+    np.testing.assert_allclose(audioOut, reference_convolve(x, filters), atol = 1e-12)
+
+
+def test_delay_mix_convolve_out():
+    # The output is written into out, a strided view here as in sparse_convolve(), overwriting what was there.
+    blockSize = 64
+    filters = edge_taps(200, blockSize, 3, shared = True)
+    x = np.random.default_rng(1).standard_normal(1000)
+    indices, gains = dt.dense_to_sparse(filters)
+    buffer = np.full((len(x) + len(filters) - 1, 6), np.nan)
+
+    audioOut = dt.delay_mix_convolve(x, indices, gains, len(filters), blockSize = blockSize, out = buffer[:,1::2])
+
+    assert np.shares_memory(audioOut, buffer)
+    np.testing.assert_allclose(buffer[:,1::2], reference_convolve(x, filters), atol = 1e-12)
+    assert np.all(np.isnan(buffer[:,0::2]))
+
+
+def test_delay_mix_convolve_zero_gain_padding():
+    # dense_to_sparse() pads filters with fewer taps with zero gains at index 0.
+    filters = np.zeros((300, 2))
+    filters[[5, 70, 299], 0] = [1, -1, 0.5]
+    filters[70, 1] = 2
+    x = np.random.default_rng(1).standard_normal(500)
+    indices, gains = dt.dense_to_sparse(filters)
+
+    np.testing.assert_allclose(dt.delay_mix_convolve(x, indices, gains, len(filters), blockSize = 64), reference_convolve(x, filters), atol = 1e-12)
+
+
+STREAMING_DECORRELATORS = [(dt.AllPass, dict()), (dt.Lauridsen, dict()), (dt.AllPassLauridsen, dict()), (dt.Fink, dict(filterLength = 20)), 
+                           (dt.FreqLauridsen, dict()), (dt.VelvetNoise, dict()), (dt.FauxReverb, dict(reverbTime = 0.2)), (dt.Copier, dict())]
+
+
+@pytest.mark.parametrize('method, arguments', STREAMING_DECORRELATORS)
+@pytest.mark.parametrize('blockSize', [256, 333, 1000])
+def test_streaming_matches_offline(method, arguments, blockSize):
+    # Two inputs to five outputs, modules of three and two outputs. The signal is not a whole number of blocks.
+    audio = np.random.default_rng(1).standard_normal((5000, 2))
+    offline = method(audio, numOutChans = 5, seed = 1, blockSize = blockSize, **arguments)
+    streaming = method(None, numInChans = 2, numOutChans = 5, seed = 1, blockSize = blockSize, **arguments)
+    streamed = stream_decorrelator(streaming, audio)
+    reference = offline.audio_out
+
+    # The stream is as long as the offline output and then silent.
+    assert len(streamed) >= len(reference)
+    np.testing.assert_allclose(streamed[len(reference):], 0, atol = 1e-10)
+    streamed = streamed[:len(reference)]
+
+    # The offline output of each module is normalised by the r.m.s of the signal, the stream by downmix_gain(), 
+    # so they only differ by a gain per module.
+    chan = 0
+    for numOuts in offline.moduleOutputs():
+        module = slice(chan, chan + numOuts)
+        gain = np.sum(streamed[:,module]*reference[:,module]) / np.sum(np.square(reference[:,module]))
+        np.testing.assert_allclose(streamed[:,module], gain*reference[:,module], atol = 1e-9*np.max(np.abs(streamed[:,module])))
+        chan += numOuts
+
+    # downmix_gain(): the downmix of each module's impulse response has unit energy. 
+    # The Copier keeps its -3dB panning gains instead, so its outputs have unit energy in total.
+    impulse = np.ones((1, 2))
+    response = stream_decorrelator(method(None, numInChans = 2, numOutChans = 5, seed = 1, blockSize = blockSize, **arguments), impulse)
+    for module in (response[:,:3], response[:,3:]):
+        if method is dt.Copier:
+            np.testing.assert_allclose(np.sum(np.square(module)), 1)
+        else:
+            np.testing.assert_allclose(np.sum(np.square(module.sum(axis=1))), 1)
+
+
+@pytest.mark.parametrize('method, arguments', [(dt.Lauridsen, dict()), (dt.AllPassLauridsen, dict()), (dt.Fink, dict(filterLength = 20)), (dt.FreqLauridsen, dict())])
+@pytest.mark.parametrize('numOutChans', [3, 5, 8])
+def test_cascade_modes_match(method, arguments, numOutChans):
+    audio = example_signal()
+    composite = method(audio, numOutChans = numOutChans, seed = 1, cascade_mode = 'composite', **arguments).audio_out
+    stages = method(audio, numOutChans = numOutChans, seed = 1, cascade_mode = 'stages', **arguments).audio_out
+
+    assert composite.shape == stages.shape
+    assert relative_error_db(composite, stages) < -200
+
+
+def test_invalid_cascade_mode():
+    with pytest.raises(ValueError):
+        dt.AllPassLauridsen(example_signal(), numOutChans = 4, cascade_mode = 'tree')
+    with pytest.raises(ValueError):
+        dt.AllPassLauridsen(None, numOutChans = 4, cascade_mode = 'tree')
+
+
+def sine_sweep_loop(filterLength, fs):
+    # The sample by sample sweep FreqLauridsen used before equalised_sine_sweep.
+    length = int(np.ceil(fs/20*filterLength))
+    intermediateLen = length+fs
+    previousphase = 0
+    SineSweep = np.zeros(intermediateLen)
+    for n in range(1, intermediateLen-1):
+        t = n/fs
+        f = filterLength*fs/n
+        SineSweep[n] = np.sin(2*np.pi*f*t+previousphase)
+        previousphase = (2*np.pi*f/fs)+previousphase
+    C = np.fft.fft(SineSweep)
+    YY = np.fft.ifft(np.exp(1j*np.angle(C)))
+    return np.real(YY[0:length])
+
+
+@pytest.mark.parametrize('filterLength, fs', [(8.4427, 48000), (13, 44100), (0.5, 16000)])
+def test_equalised_sine_sweep_matches_loop(filterLength, fs):
+    length = int(np.ceil(fs/20*filterLength))
+    reference = sine_sweep_loop(filterLength, fs)
+    np.testing.assert_allclose(dt.equalised_sine_sweep(filterLength, fs)[0:length], reference, rtol = 0, atol = 1e-12)
+
+    filters = dt.FreqLauridsen(None, numOutChans = 2, fs = fs).genFilter(filterLength)
+    np.testing.assert_allclose(filters[1:,0], reference[1:], rtol = 0, atol = 1e-12)
+    np.testing.assert_array_equal(filters[1:,1], -filters[1:,0])
+    np.testing.assert_array_equal(filters[0], [1, 1])
+
+
+def test_equalised_sine_sweep_cache_is_read_only():
+    sweep = dt.equalised_sine_sweep(8.4427, 48000)
+    assert dt.equalised_sine_sweep(8.4427, 48000) is sweep
+    with pytest.raises(ValueError):
+        sweep[0] = 1
+    filters = dt.FreqLauridsen(None, numOutChans = 2).genFilter()
+    filters[:] = 0
+    assert np.any(dt.equalised_sine_sweep(8.4427, 48000) != 0)
+
+
+def route_segments_loop(audio, boundaries, channels, numOuts, fadeLength = 0):
+    # route_segments() a segment and a fade at a time, as the loop it replaced.
+    audioOut = np.zeros((len(audio), numOuts))
+    for k, channel in enumerate(channels):
+        segment = slice(boundaries[k], boundaries[k+1])
+        if channel < 0:
+            audioOut[segment] = audio[segment, np.newaxis] / np.sqrt(numOuts)
+        else:
+            audioOut[segment, channel] = audio[segment]
+    for k in range(1, len(channels)):
+        onset = boundaries[k]
+        if fadeLength == 0 or channels[k-1] == channels[k] or channels[k-1] < 0 or channels[k] < 0:
+            continue
+        fadeStart = max(onset - fadeLength, boundaries[k-1])
+        for position in range(fadeStart, onset):
+            phase = (position - fadeStart + 0.5) / (onset - fadeStart) * np.pi/2
+            audioOut[position, channels[k-1]] = audio[position] * np.cos(phase)
+            audioOut[position, channels[k]] = audio[position] * np.sin(phase)
+    return audioOut
+
+
+ROUTINGS = [
+    # Audio before the first onset spread over the outputs.
+    ([0, 300, 700, 1000], [-1, 2, 0]),
+    # Back to back onsets closer than the fade, a repeated channel and an onset at the last sample.
+    ([0, 100, 110, 115, 400, 420, 999, 1000], [1, 0, 3, 3, 2, 0, 1]),
+    # A single segment and empty segments.
+    ([0, 1000], [2]),
+    ([0, 0, 500, 500, 1000], [1, 2, 0, 3]),
+]
+
+
+@pytest.mark.parametrize('boundaries, channels', ROUTINGS)
+@pytest.mark.parametrize('fadeLength', [0, 1, 16, 200])
+def test_route_segments_matches_loop(boundaries, channels, fadeLength):
+    audio = np.random.default_rng(1).standard_normal(1000)
+    np.testing.assert_allclose(dt.route_segments(audio, boundaries, channels, 4, fadeLength), 
+                               route_segments_loop(audio, boundaries, channels, 4, fadeLength), atol = 1e-15)
+
+
+@pytest.mark.parametrize('boundaries, channels', ROUTINGS)
+@pytest.mark.parametrize('fadeLength', [0, 16, 200])
+def test_route_segments_keeps_power(boundaries, channels, fadeLength):
+    # The squared gains of every sample sum to one, through the crossfades and the spread segments.
+    audioOut = dt.route_segments(np.ones(1000), boundaries, channels, 4, fadeLength)
+    np.testing.assert_allclose(np.sum(np.square(audioOut), axis=1), 1)
+
+
+class PicklingExecutor(object):
+    # Runs the tasks in this process after a pickle round trip, as a process pool would, and records their sizes.
+
+    def __init__(self):
+        self.taskBytes = []
+
+    def map(self, function, *iterables):
+        results = []
+        for args in zip(*iterables):
+            data = pickle.dumps(args)
+            self.taskBytes.append(len(data))
+            results.append(function(*pickle.loads(data)))
+        return results
+
+
+@pytest.mark.parametrize('method, arguments', [(dt.AllPass, dict()), (dt.AllPassLauridsen, dict()), (dt.VelvetNoise, dict())])
+def test_executor_tasks_only_get_their_channel(method, arguments):
+    audio = np.random.default_rng(1).standard_normal((48000, 4))
+    executor = PicklingExecutor()
+
+    parallel = method(audio, numOutChans = 8, seed = 1, executor = executor, **arguments).audio_out
+    serial = method(audio, numOutChans = 8, seed = 1, **arguments).audio_out
+
+    np.testing.assert_array_equal(parallel, serial)
+    assert len(executor.taskBytes) == 4
+    assert max(executor.taskBytes) < 1.5 * audio[:,0].nbytes
@@ -0,0 +1,169 @@
+import os
+import subprocess
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pytest
+
+import s3a_decorrelation_toolbox.batch as batch
+import s3a_decorrelation_toolbox.decorr_toolbox as dt
+import s3a_decorrelation_toolbox.filter_cache as fc
+
+
+def worker_filters(directory):
+    # The seeded filters as designed (or loaded) by a batch worker sharing directory with the others.
+    batch.init_worker(directory, fftSizes = ())
+    filters = []
+    for seed in range(20):
+        decorrelator = dt.AllPass(None, numOutChans = 8, seed = seed, filter_cache = batch.workerCache)
+        decorrelator.startModule(0)
+        filters.append(decorrelator.streamFilters(8))
+    return filters
+
+
+def test_workers_share_a_cache_directory(tmp_path):
+    directory = str(tmp_path)
+    with ProcessPoolExecutor(4) as pool:
+        results = list(pool.map(worker_filters, [directory]*8))
+
+    for filters in results[1:]:
+        for a, b in zip(results[0], filters):
+            np.testing.assert_array_equal(a, b)
+    assert not [name for name in os.listdir(directory) if not name.endswith('.npy')]
+    # Every saved file is complete.
+    cache = fc.FilterCache(directory = directory)
+    for name in os.listdir(directory):
+        assert cache.load(name[:-len('.npy')]) is not None
+
+
+class RecordingCache(fc.FilterCache):
+    # Records the keys of the filters asked for.
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.keys = []
+
+    def filters(self, key, generator):
+        self.keys.append(key)
+        return super().filters(key, generator)
+
+
+def allpass_keys(**arguments):
+    cache = RecordingCache()
+    settings = dict(numOutChans = 4, seed = 1, fs = 48000)
+    settings.update(arguments)
+    dt.AllPass(np.random.default_rng(0).standard_normal((1000, 2)), filter_cache = cache, **settings)
+    return cache.keys
+
+
+def test_filter_keys():
+    # The decorrelator, generator, fs, arguments, seed, module and call number.
+    assert allpass_keys() == [('AllPass', 'genAllPass', 48000, 9.213, 2, 1, 0, 1), ('AllPass', 'genAllPass', 48000, 9.213, 2, 1, 1, 1)]
+    assert allpass_keys(fs = 44100)[0][2] == 44100
+    assert allpass_keys(filterLength = 5)[0][3] == 5
+    assert allpass_keys(seed = 2)[0][5] == 2
+    assert allpass_keys(seed = None) == []
+    assert allpass_keys(cache_filters = False) == []
+
+
+def test_key_hash_is_stable():
+    # The file names are the same in every run and process, whatever the Python hash seed.
+    key = ('AllPass', 'genAllPass', 48000, 1024, 1, 0, 1)
+    assert fc.key_hash(key) == '133cc5a9439a6fbdcf933110e100f69ec8babe90'
+    command = 'import s3a_decorrelation_toolbox.filter_cache as fc; print(fc.key_hash({k!r}))'.format(k = key)
+    output = subprocess.run([sys.executable, '-c', command], capture_output = True, text = True, check = True,
+                            env = dict(os.environ, PYTHONHASHSEED = '123', PYTHONPATH = os.pathsep.join(sys.path)))
+    assert output.stdout.strip() == fc.key_hash(key)
+
+
+def counting_generator(value):
+    calls = []
+    def generator():
+        calls.append(value)
+        return np.ones(4)
+    return generator, calls
+
+
+def test_cache_hits_and_read_only_values():
+    cache = fc.FilterCache()
+    generator, calls = counting_generator(1)
+
+    first = cache.filters('a', generator)
+    second = cache.filters('a', generator)
+
+    assert second is first
+    assert calls == [1]
+    with pytest.raises(ValueError):
+        first[0] = 2
+
+
+def test_least_recently_used_eviction():
+    cache = fc.FilterCache(maxsize = 2)
+    generators = {key: counting_generator(key) for key in 'abc'}
+    for key in 'aba':
+        cache.filters(key, generators[key][0])
+    # a was used more recently than b, so b is evicted.
+    cache.filters('c', generators['c'][0])
+    assert list(cache.entries) == ['filters_' + fc.key_hash('a'), 'filters_' + fc.key_hash('c')]
+
+    cache.filters('b', generators['b'][0])
+    cache.filters('c', generators['c'][0])
+    assert generators['b'][1] == ['b', 'b']
+    assert generators['c'][1] == ['c']
+    assert generators['a'][1] == ['a']
+
+
+def test_directory_reloads(tmp_path):
+    directory = str(tmp_path)
+    generator, calls = counting_generator(1)
+    pair = lambda: (np.zeros(3), np.ones(2))
+    fc.FilterCache(directory = directory).filters('a', generator)
+    fc.FilterCache(directory = directory).filters('pair', pair)
+
+    # A new cache loads the files rather than generating the filters.
+    loaded = fc.FilterCache(directory = directory).filters('a', generator)
+    mapped = fc.FilterCache(directory = directory, mmap_mode = 'r').filters('a', generator)
+    loadedPair = fc.FilterCache(directory = directory, mmap_mode = 'r').filters('pair', lambda: None)
+    assert calls == [1]
+    np.testing.assert_array_equal(loaded, np.ones(4))
+    assert isinstance(mapped, np.memmap)
+    np.testing.assert_array_equal(loadedPair[1], np.ones(2))
+
+    # A read only cache uses the files but never adds any.
+    readOnly = fc.FilterCache(directory = directory, read_only = True)
+    files = sorted(os.listdir(directory))
+    readOnly.filters('a', generator)
+    readOnly.filters('b', counting_generator(2)[0])
+    assert sorted(os.listdir(directory)) == files
+    assert calls == [1]
+
+
+def test_unreadable_file_is_a_miss(tmp_path):
+    cache = fc.FilterCache(directory = str(tmp_path))
+    cache.filters('a', lambda: np.ones(1000))
+    filename = os.path.join(str(tmp_path), 'filters_{h}.npy'.format(h = fc.key_hash('a')))
+    with open(filename, 'r+b') as f:
+        f.truncate(100)
+
+    generator, calls = counting_generator(1)
+    np.testing.assert_array_equal(fc.FilterCache(directory = str(tmp_path)).filters('a', generator), np.ones(4))
+    assert calls == [1]
+
+
+def test_save_array_is_atomic(tmp_path, monkeypatch):
+    filename = str(tmp_path / 'array.npy')
+    fc.save_array(filename, np.ones(3))
+    assert os.listdir(str(tmp_path)) == ['array.npy']
+
+    # A failed save leaves the previous file as it was and no temporary file.
+    def failing_save(f, array):
+        f.write(b'partial')
+        raise OSError('disk full')
+    monkeypatch.setattr(np, 'save', failing_save)
+    with pytest.raises(OSError):
+        fc.save_array(filename, np.zeros(3))
+    monkeypatch.undo()
+
+    assert os.listdir(str(tmp_path)) == ['array.npy']
+    np.testing.assert_array_equal(np.load(filename), np.ones(3))
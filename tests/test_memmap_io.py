@@ -0,0 +1,58 @@
+import numpy as np
+import pytest
+import soundfile as sf
+
+import s3a_decorrelation_toolbox.memmap_io as memmap_io
+
+
+SUBTYPES = ['PCM_16', 'PCM_24', 'PCM_32', 'FLOAT', 'DOUBLE']
+
+
+def example_audio(frames = 10000, channels = 3):
+    return 0.5*np.random.default_rng(0).uniform(-1, 1, (frames, channels))
+
+
+@pytest.mark.parametrize('subtype', SUBTYPES)
+def test_open_input_matches_soundfile(tmp_path, subtype):
+    filename = str(tmp_path / 'input.wav')
+    sf.write(filename, example_audio(), 48000, subtype = subtype)
+
+    audio, fs = memmap_io.open_input(filename, directory = str(tmp_path))
+    converted = memmap_io.channel_major(audio, directory = str(tmp_path), blockFrames = 4096)
+
+    assert fs == 48000
+    np.testing.assert_array_equal(converted, sf.read(filename)[0])
+
+
+@pytest.mark.parametrize('subtype', list(memmap_io.WAV_SUBTYPES))
+def test_write_wav_round_trip(tmp_path, subtype):
+    filename = str(tmp_path / 'output.wav')
+    audio = example_audio()
+
+    memmap_io.write_wav(filename, audio, 48000, subtype = subtype, blockFrames = 4096)
+    written, fs = sf.read(filename)
+
+    assert fs == 48000
+    assert sf.info(filename).subtype == subtype
+    # Within half a step of the integer formats.
+    tolerance = {'PCM_16': 2.0**-16, 'PCM_32': 2.0**-32, 'FLOAT': 1e-7, 'DOUBLE': 0}[subtype]
+    np.testing.assert_allclose(written, audio, rtol = 0, atol = tolerance)
+    np.testing.assert_array_equal(memmap_io.channel_major(memmap_io.open_input(filename)[0]), written)
+
+
+def test_copy_blocks_integer_to_integer():
+    source = np.array([[-32768], [-1], [0], [1], [32767]], dtype = np.int16)
+
+    wider = np.zeros(source.shape, dtype = np.int32)
+    memmap_io.copy_blocks(source, wider, blockFrames = 2)
+    np.testing.assert_array_equal(wider, source.astype(np.int32) * 2**16)
+
+    narrower = np.zeros(source.shape, dtype = np.int16)
+    memmap_io.copy_blocks(wider, narrower, blockFrames = 2)
+    np.testing.assert_array_equal(narrower, source)
+
+
+def test_copy_blocks_clips_floats():
+    destination = np.zeros((3, 1), dtype = np.int16)
+    memmap_io.copy_blocks(np.array([[-2.0], [0.5], [2.0]]), destination)
+    np.testing.assert_array_equal(destination[:,0], [-32768, 16384, 32767])
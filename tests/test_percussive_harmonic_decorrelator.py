@@ -0,0 +1,159 @@
+import librosa
+import numpy as np
+import pytest
+import scipy.ndimage
+
+import s3a_decorrelation_toolbox.decorr_toolbox as dt
+import s3a_decorrelation_toolbox.percussive_harmonic_decorrelator as phdc
+
+from signals import example_signal, relative_error_db, stream_decorrelator, FLOAT32_TOLERANCE
+
+
+def test_mono_input_with_memmap_directory(tmp_path):
+    audio = np.random.default_rng(0).standard_normal(48000)
+
+    memmapped = phdc.s3a_audio_decorrelator(audio, seed = 1, memmap_directory = str(tmp_path))
+    inMemory = phdc.s3a_audio_decorrelator(audio, seed = 1)
+
+    assert memmapped.shape == (len(audio), 2)
+    np.testing.assert_array_equal(np.asarray(memmapped), inMemory[:len(memmapped)])
+
+
+def test_onset_envelope_matches_librosa():
+    rng = np.random.default_rng(0)
+    audio = 0.05*rng.standard_normal(46*1024)
+    for position in (10000, 30000):
+        audio[position:position + 300] += rng.standard_normal(300)
+
+    onsetEnvelope = phdc.OnsetEnvelope(1, 48000, length = len(audio))
+    for start in range(0, len(audio), 1024):
+        onsetEnvelope.process(audio[start:start + 1024, np.newaxis])
+
+    # Frame n of the envelope ends at sample (n + 1)*512, frame n + 1 of librosa's. 
+    # The frames at either end differ as librosa pads the signal.
+    envelope = onsetEnvelope.envelope()[:,0]
+    librosaEnvelope = librosa.onset.onset_strength(y = audio, sr = 48000)
+    np.testing.assert_allclose(envelope[4:-4], librosaEnvelope[5:-4], atol = 1e-9)
+
+
+# Row lengths and kernel sizes, including kernels reflected over most of the row and even kernels.
+# scipy's reflected edges are only valid for kernels up to twice the row length.
+MEDIAN_SIZES = [(1, 1), (40, 1), (40, 2), (40, 7), (200, 31), (200, 32), (17, 31), (16, 32), (5, 9)]
+
+
+@pytest.fixture(params = ['numba', 'scipy'])
+def median_backend(request, monkeypatch):
+    # Without numba median_filter falls back to scipy.
+    if request.param == 'scipy':
+        monkeypatch.setattr(phdc, 'numba', None)
+    elif phdc.numba is None:
+        pytest.skip('numba is not installed')
+    return request.param
+
+
+@pytest.mark.parametrize('length, kernel_size', MEDIAN_SIZES)
+@pytest.mark.parametrize('quantised', [False, True])
+def test_median_filter_matches_scipy(median_backend, length, kernel_size, quantised):
+    S = np.random.default_rng(length).standard_normal((5, length)).astype(np.float32)
+    if quantised:
+        # Repeated values in the window.
+        S = np.round(S)
+
+    np.testing.assert_array_equal(phdc.median_filter(S, kernel_size), scipy.ndimage.median_filter(S, size = (1, kernel_size), mode = 'reflect'))
+    np.testing.assert_array_equal(phdc.median_filter(S.T, kernel_size, axis = 0), scipy.ndimage.median_filter(S.T, size = (kernel_size, 1), mode = 'reflect'))
+    np.testing.assert_array_equal(phdc.median_filter(S, kernel_size, numThreads = 3), phdc.median_filter(S, kernel_size))
+
+
+@pytest.mark.parametrize('margin', [1.0, (1.0, 3.0)])
+@pytest.mark.parametrize('kernel_size', [31, (17, 31)])
+def test_hpss_backends_match(median_backend, margin, kernel_size):
+    D = librosa.stft(example_signal()[:,0], n_fft = 1024)
+
+    fast = phdc.hpss_masks(np.abs(D), margin = margin, kernel_size = kernel_size, backend = 'fast', numThreads = 2)
+    reference = phdc.hpss_masks(np.abs(D), margin = margin, kernel_size = kernel_size, backend = 'librosa')
+    for mask, referenceMask in zip(fast, reference):
+        # The fast backend filters float32 magnitudes.
+        np.testing.assert_allclose(mask, referenceMask, rtol = 0, atol = 1e-6)
+
+    for component, referenceComponent in zip(phdc.hpss(D, margin = margin, kernel_size = kernel_size), phdc.hpss(D, margin = margin, kernel_size = kernel_size, backend = 'librosa')):
+        assert relative_error_db(component, referenceComponent) < FLOAT32_TOLERANCE
+
+
+def test_invalid_hpss_backend():
+    with pytest.raises(ValueError):
+        phdc.hpss_masks(np.ones((4, 4)), backend = 'median')
+
+
+@pytest.mark.parametrize('arguments', [dict(transient_decorrelation_method = dt.Copier), dict()])
+def test_float32_matches_float64(arguments):
+    audio = example_signal()
+    outputs = {dtype: phdc.s3a_audio_decorrelator(audio, num_out_chans = 6, seed = 1, dtype = dtype, **arguments) for dtype in (np.float32, np.float64)}
+
+    assert outputs[np.float32].dtype == np.float32
+    assert outputs[np.float32].shape == outputs[np.float64].shape
+    assert relative_error_db(outputs[np.float32], outputs[np.float64]) < FLOAT32_TOLERANCE
+
+
+def causal_output(audio, **arguments):
+    decorrelator = phdc.CausalS3ADecorrelator(numInChans = 2, num_out_chans = 6, blockSize = 1024, **arguments)
+    blocks = [decorrelator.process_block(audio[start:start + 1024]) for start in range(0, len(audio), 1024)]
+    return np.concatenate(blocks + [decorrelator.flush()]), decorrelator
+
+
+def test_causal_decorrelator_seed():
+    audio = example_signal(0.5)[:23*1024]
+
+    first, decorrelator = causal_output(audio, seed = 3)
+    second, _ = causal_output(audio, seed = 3)
+    other, _ = causal_output(audio, seed = 4)
+    single, _ = causal_output(audio, seed = 3, dtype = np.float32)
+
+    np.testing.assert_array_equal(first, second)
+    assert not np.allclose(first, other)
+    assert single.dtype == np.float32
+    assert relative_error_db(single, first) < FLOAT32_TOLERANCE
+    # The same routing as the other s3a decorrelators with the seed.
+    streaming = phdc.StreamingS3ADecorrelator(numInChans = 2, num_out_chans = 6, seed = 3)
+    np.testing.assert_array_equal(decorrelator.transient_routing, streaming.transient_routing)
+    np.testing.assert_array_equal(decorrelator.steady_state_routing, streaming.steady_state_routing)
+
+
+# Error of the STFT domain decorrelation relative to the time domain filters over all outputs. It is about -25 dB.
+STFT_TOLERANCE = -20
+
+STFT_DECORRELATORS = [(dt.AllPass, dict()), (dt.Lauridsen, dict()), (dt.AllPassLauridsen, dict()), (dt.Fink, dict(filterLength = 20)), 
+                      (dt.FreqLauridsen, dict()), (dt.VelvetNoise, dict())]
+
+
+@pytest.mark.parametrize('method, arguments', STFT_DECORRELATORS + [(dt.Copier, dict())])
+def test_stft_decorrelation_matches_time_domain(method, arguments):
+    audio = example_signal()
+    decorrelator = lambda: method(None, numInChans = 2, numOutChans = 5, seed = 2, **arguments)
+    spectrograms = [librosa.stft(audio[:,i], n_fft = 2048) for i in range(2)]
+
+    stftOut = phdc.decorrelate_spectrograms([spectrograms], [decorrelator()], len(audio))
+    timeOut = stream_decorrelator(decorrelator(), audio)[:len(audio)]
+
+    assert stftOut.shape == (len(audio), 5)
+    # Copier's filters are a single tap so are exact.
+    tolerance = FLOAT32_TOLERANCE if method is dt.Copier else STFT_TOLERANCE
+    assert relative_error_db(stftOut, timeOut) < tolerance
+
+
+@pytest.mark.parametrize('length, num_out_chans', [(48000, 2), (47001, 6)])
+def test_stft_domain_matches_time_domain(length, num_out_chans):
+    audio = example_signal()[:length]
+
+    timeOut = phdc.s3a_audio_decorrelator(audio, num_out_chans = num_out_chans, seed = 1)
+    stftOut = phdc.s3a_audio_decorrelator(audio, num_out_chans = num_out_chans, seed = 1, decorrelation_domain = 'stft')
+
+    assert stftOut.shape == timeOut.shape == (length, num_out_chans)
+    assert relative_error_db(stftOut, timeOut) < STFT_TOLERANCE
+
+
+def test_stft_domain_errors():
+    audio = example_signal(0.25)
+    with pytest.raises(ValueError):
+        phdc.s3a_audio_decorrelator(audio, seed = 1, decorrelation_domain = 'frequency')
+    with pytest.raises(NotImplementedError):
+        phdc.s3a_audio_decorrelator(audio, num_out_chans = 4, seed = 1, decorrelation_domain = 'stft', noise_decorrelation_method = dt.FauxReverb)
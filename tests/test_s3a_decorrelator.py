@@ -0,0 +1,50 @@
+import numpy as np
+import soundfile as sf
+
+import s3a_decorrelation_toolbox.s3a_decorrelator as s3a
+
+from signals import example_signal, relative_error_db
+
+
+def stream_and_whole_file(tmp_path, preset):
+    # Three seconds of stereo upmixed to six channels by s3a_decorrelator_stream and s3a_decorrelator with the same seed.
+    inputFile = str(tmp_path / 'input.wav')
+    sf.write(inputFile, 0.5*example_signal(3.0), 48000, subtype = 'DOUBLE')
+
+    wholeFile = s3a.s3a_decorrelator(inputFile, None, preset = preset, num_out_chans = 6, seed = 3)
+    s3a.s3a_decorrelator_stream(inputFile, str(tmp_path / 'output.wav'), preset = preset, num_out_chans = 6, seed = 3, fs = 48000, chunkSize = 2**16)
+    streamed, fs = sf.read(str(tmp_path / 'output.wav'))
+
+    return streamed, wholeFile
+
+
+def test_stream_matches_whole_file_upmix(tmp_path):
+    # The chunks are separated as the whole file, and the routing and filters are the same, but the streaming
+    # decorrelators are normalised by their filters rather than the signal. The error is about -48 dB.
+    streamed, wholeFile = stream_and_whole_file(tmp_path, 'upmix')
+
+    assert streamed.shape == wholeFile.shape
+    assert relative_error_db(streamed, wholeFile) < -40
+
+
+def test_stream_matches_whole_file_diffuse(tmp_path):
+    # The transients are panned at onsets found in each chunk by librosa rather than from the separation 
+    # of the whole file, so may go to different loudspeakers. The downmix is the same as with the upmix preset,
+    # and the level of each loudspeaker about the same.
+    streamed, wholeFile = stream_and_whole_file(tmp_path, 'diffuse')
+
+    assert streamed.shape == wholeFile.shape
+    assert relative_error_db(np.sum(streamed, axis=1), np.sum(wholeFile, axis=1)) < -40
+    np.testing.assert_allclose(10*np.log10(np.mean(np.square(streamed), axis=0) / np.mean(np.square(wholeFile), axis=0)), 0, atol = 1)
+
+
+def test_pcm24_input_with_memmap_directory(tmp_path):
+    audio = 0.1*np.random.default_rng(0).standard_normal((48000, 2))
+    inputFile = str(tmp_path / 'input.wav')
+    sf.write(inputFile, audio, 48000, subtype = 'PCM_24')
+
+    memmapped = s3a.s3a_decorrelator(inputFile, str(tmp_path / 'output.wav'), preset = 'upmix', seed = 3, memmap_directory = str(tmp_path), subtype = 'PCM_24')
+    inMemory = s3a.s3a_decorrelator(inputFile, None, preset = 'upmix', seed = 3)
+
+    np.testing.assert_allclose(np.asarray(memmapped), inMemory, atol = 1e-12)
+    np.testing.assert_allclose(sf.read(str(tmp_path / 'output.wav'))[0], inMemory, atol = 2.0**-23)